@@ -1,56 +1,136 @@
 import json
 import logging
 import os
-import re
+import random
 import threading
-from typing import Callable, List, Set
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 
 from const import IMG_DIR
-from conf import get_config
+from conf import get_config, get_config_version
+from dedup import dedup_index
+from eviction import NO_EVICTION, plan_eviction, validate_policy
+from jobs import DELETION, DIFFUSION, JOB_RETENTION_SECONDS, LANE_BACKGROUND, LANE_MANUAL, job_queue
+from library import SIDECAR_EXT, ImageLibrary, get_basename, get_preset_name
 from models import ConfigSaveRequest
-from utils import get_old_files
+from utils import decode_cursor, encode_cursor
+from store import metadata_store
 
-from diffuse.api import DiffuseApiPayload, diffuse
+from diffuse.api import DiffuseApiPayload, diffuse, get_static_req_body_provider
+from diffuse.client import get_client
 from diffuse.collection import DiffusePreset, DiffusePresetCollection
+from diffuse.preset import get_job_rng
+from diffuse.progress import progress_monitor
+from diffuse.dispatcher import Backend, Dispatcher
+from diffuse.pacer import RoundPacer
+from diffuse.planner import DiffusionJob, plan_round
+from diffuse.writer import RENDITION_SIZES, image_writer
+from metrics import checkpoint_swaps, cleanup_deletions, evictions, images_generated, stage_seconds
 
 os.makedirs(IMG_DIR, exist_ok=True)
 
 logger = logging.getLogger("corganize")
 lock = threading.Lock()
+collection_lock = threading.Lock()
+_collection_cache = dict(version=None, collection=None)
 
 
-def select_presets(count: int) -> List[DiffusePreset]:
-    logger.info("Accessing local FS for diffusion presets...")
-    collection = DiffusePresetCollection.from_dict(get_config())
-    return collection.select(count)
+def get_preset_collection() -> DiffusePresetCollection:
+    """
+    Returns the compiled preset collection, rebuilding it only when the config file changes.
+    """
+    version = get_config_version()
+    with collection_lock:
+        if _collection_cache["version"] != version:
+            logger.info(f"Compiling diffusion presets... {version=}")
+            with stage_seconds.time(stage="config"):
+                _collection_cache["collection"] = DiffusePresetCollection.from_dict(get_config())
+            _collection_cache["version"] = version
+        return _collection_cache["collection"]
+
+
+def invalidate_preset_collection():
+    with collection_lock:
+        _collection_cache["version"] = None
+        _collection_cache["collection"] = None
 
 
 class Corganize:
-    filenames_to_delete: Set[str] = set()
+    filenames_to_delete: Set[str] = set()  # Mirrors the unfinished deletion jobs
+    wake = threading.Event()  # Cuts the pause between rounds short
     envvars = dict(
         diffusion_enabled=True,
         notes="",
         auto_delete_days=int(os.getenv("AUTO_DELETE_DAYS", "1")),
         max_images_allowed=int(os.getenv("MAX_IMAGES_ALLOWED", "500")),
         diffusion_url=os.getenv("DIFFUSION_URL", "").strip("/"),
-        diffusion_sample_size=int(os.getenv("DIFFUSION_SAMPLE_SIZE", "4"))
+        diffusion_sample_size=int(os.getenv("DIFFUSION_SAMPLE_SIZE", "4")),
+        eviction_policy=os.getenv("EVICTION_POLICY", NO_EVICTION),
+        max_library_mb=int(os.getenv("MAX_LIBRARY_MB", "0")),
+        eviction_low_water=float(os.getenv("EVICTION_LOW_WATER", "0.9"))
     )
+    library = ImageLibrary(rendition_sizes=RENDITION_SIZES)
+    dispatcher = Dispatcher()
+    pacer = RoundPacer()
     _broadcast_diffusion: Callable
     _broadcast_cleanup: Callable
 
-    def get_image_filenames(self):
-        def _is_valid(filename: str) -> bool:
-            return filename not in self.filenames_to_delete and filename.endswith(".crgimg")
-        return [filename for filename in os.listdir(IMG_DIR) if _is_valid(filename)]
-
-    def get_recent_image_filenames(self):
-        return sorted(
-            self.get_image_filenames(),
-            key=lambda filename: os.path.getctime(
-                os.path.join(IMG_DIR, filename)),
-            reverse=True
-        )
+    def get_image_count(self) -> int:
+        return self.library.count(exclude=self.filenames_to_delete)
+
+    def get_blocker(self) -> Optional[str]:
+        """
+        Why rounds are being skipped, if they are. Queued jobs wait for as long.
+        """
+        if not self.envvars["diffusion_enabled"]:
+            return "diffusion is disabled in the app config"
+        image_count = self.get_image_count()
+        if self.envvars["eviction_policy"] == NO_EVICTION and image_count > self.envvars["max_images_allowed"]:
+            return f"the library is over max_images_allowed ({image_count} > {self.envvars['max_images_allowed']})" \
+                   " and the eviction policy is 'none'"
+        return None
+
+    def get_shuffled_image_filenames(self, limit: int, cursor: str = None, seed: int = None) -> Tuple[List[str], Optional[str]]:
+        """
+        Returns a page and the cursor to the next one. The first page picks the seed unless given.
+        """
+        state = None
+        if cursor:
+            values = decode_cursor(cursor)
+            assert len(values) == 4, f"invalid cursor {cursor=}"
+            seed, state = values[0], tuple(values[1:])
+        elif seed is None:
+            seed = random.getrandbits(32)
+
+        filenames, state = self.library.shuffled(limit, seed, exclude=self.filenames_to_delete, state=state)
+        return filenames, state and encode_cursor([seed, *state])
+
+    def get_image_renditions(self, filenames: List[str]) -> List[dict]:
+        """
+        Where to find each image at gallery sizes: the smallest rendition as the thumbnail and the
+        largest as the preview, falling back to the original until its renditions exist.
+        """
+        images = []
+        for filename in filenames:
+            entry = self.library.get(filename)
+            sizes = entry.renditions if entry else ()
+            images.append(dict(
+                filename=filename,
+                thumbnail=self.library.get_rendition_path(filename, sizes[0]) if sizes else filename,
+                preview=self.library.get_rendition_path(filename, sizes[-1]) if sizes else filename,
+                original=filename
+            ))
+        return images
+
+    def get_recent_image_filenames(self, limit: int, cursor: str = None) -> Tuple[List[str], Optional[str]]:
+        before = None
+        if cursor:
+            before = decode_cursor(cursor)
+            assert len(before) == 2, f"invalid cursor {cursor=}"
+
+        filenames, last = self.library.recent(limit, exclude=self.filenames_to_delete, before=before)
+        return filenames, last and encode_cursor(list(last))
 
     def diffuse(self):
         if not self.envvars["diffusion_enabled"]:
@@ -62,97 +142,454 @@ class Corganize:
 
         logger.info("Diffusing...")
 
-        filenames = self.get_image_filenames()
-        if len(filenames) > self.envvars["max_images_allowed"]:
-            msg = f"Library size is too big. {len(filenames)=} {self.envvars['max_images_allowed']=}"
+        image_count = self.get_image_count()
+        if self.envvars["eviction_policy"] != NO_EVICTION:
+            self.evict()
+        elif image_count > self.envvars["max_images_allowed"]:
+            msg = f"Library size is too big. {image_count=} {self.envvars['max_images_allowed']=}"
             logger.info(msg)
             self.broadcast_diffusion("skipped", dict(
                 message="Library size is too big",
                 metadata=dict(
-                    size=len(filenames),
+                    size=image_count,
                     limit=self.envvars['max_images_allowed']
                 )
             ))
             return
 
-        base_url = self.envvars["diffusion_url"]
+        backends = self.dispatcher.configure(self.envvars["diffusion_url"])
         sample_size = self.envvars["diffusion_sample_size"]
-        for _ in range(sample_size):
-            # Doing this in a for loop because the # of presets may be lower than sample_size
-            presets = select_presets(1)
+        round_started = time.time()
+        snapshot = self.get_metrics_snapshot()
+        collection = get_preset_collection()
+        # Unfinished background jobs, e.g. from before a restart, make up for part of the sample
+        backlog = job_queue.count(DIFFUSION, lane=LANE_BACKGROUND)
+        leased: Set[int] = set()  # Handed back to the queue if the round stops before finishing them
+        try:
+            queued = self.claim_diffusion_jobs(collection)
+            leased.update(job.id for job in queued)
+            with stage_seconds.time(stage="plan"):
+                plan = plan_round(collection, max(sample_size - backlog, 0), current_model=backends[0].current_model, queued=queued)
+            sampled = [job for job in plan.jobs if job.id is None]
+            for job, id in zip(sampled, job_queue.enqueue(DIFFUSION, [job.to_payload() for job in sampled], claim=True)):
+                job.id = id
+                leased.add(id)
+            logger.info(f"Round planned. {len(plan.jobs)=} {len(queued)=} {plan.swaps=} {plan.swaps_avoided=} {len(backends)=}")
 
-            for preset in presets:
-                self.broadcast_diffusion("processing", dict(
-                    preset_name=preset.preset_name,
-                ))
-                logger.info(f"Starting {preset.preset_name=}")
-                diffuse(base_url, DiffuseApiPayload(preset))
-                logger.info(f"Generation done: {preset.preset_name=}")
-                self.broadcast_diffusion("partially-done", dict(
-                    preset_name=preset.preset_name,
+            # Manual jobs submitted mid-round go ahead of the sampled ones at the next job boundary
+            fed = []
+
+            def feed() -> List[DiffusionJob]:
+                jobs = self.claim_diffusion_jobs(collection)
+                fed.extend(jobs)
+                leased.update(job.id for job in jobs)
+                return jobs
+
+            failed = self.dispatcher.run(plan.jobs, lambda job: job.model, self.run_job, get_priority=lambda job: job.lane, feed=feed)
+            for job, e in failed:
+                retry = job_queue.fail(job.id, repr(e))
+                leased.discard(job.id)
+                logger.error(f"Generation failed: {job.preset.preset_name=} {retry=} {e=}")
+                self.broadcast_diffusion("failed", dict(
+                    job_id=job.id,
+                    preset_name=job.preset.preset_name,
+                    retry=retry
                 ))
 
-        self.broadcast_diffusion("done")
+            image_writer.flush()
+            job_queue.complete(sorted(leased))
+            leased.clear()
+        finally:
+            for id in leased:
+                job_queue.fail(id, "round aborted", retry=True)
+        self.broadcast_diffusion("done", dict(
+            swaps=plan.swaps,
+            swaps_avoided=plan.swaps_avoided,
+            summary=self.get_round_summary(snapshot, time.time() - round_started, len(failed))
+        ))
         logger.info("Generation done: all")
 
+        dispatched = len(plan.jobs) + len(fed)
+        if dispatched and len(failed) == dispatched:
+            raise RuntimeError(f"Every job in the round failed. {len(failed)=}")
+
+    @staticmethod
+    def claim_diffusion_jobs(collection: DiffusePresetCollection) -> List[DiffusionJob]:
+        jobs = []
+        for queued in job_queue.claim(DIFFUSION):
+            preset_name = queued.payload["preset_name"]
+            preset_spec = queued.payload.get("preset")
+            try:
+                preset = collection.build_preset(preset_spec) if preset_spec else collection.get_preset(preset_name)
+            except Exception as e:
+                logger.error(f"Dropping queued job, its preset doesn't build. {queued.id=} {preset_name=} {e=}")
+                job_queue.fail(queued.id, repr(e), retry=False)
+                continue
+            if not preset:
+                logger.error(f"Dropping queued job, its preset is gone. {queued.id=} {preset_name=}")
+                job_queue.fail(queued.id, f"preset not found: {preset_name}", retry=False)
+                continue
+            jobs.append(DiffusionJob(preset, queued.payload["req_body"], queued.payload["seed"], queued.lane, queued.id,
+                                     preset_spec=preset_spec, replay=queued.payload.get("replay", False)))
+        return jobs
+
+    def submit_jobs(self, count: int, preset_name: str = None, preset: dict = None) -> List[int]:
+        """
+        Queues 'count' jobs of either a preset from the config or an inline one, ahead of background sampling.
+        Their request bodies get resolved right away, so that a broken preset fails here rather than in a round.
+        """
+        assert (preset_name is None) != (preset is None), "either 'preset_name' or 'preset' must be set"
+        collection = get_preset_collection()
+        if preset is None:
+            diffuse_preset = collection.get_preset(preset_name)
+            assert diffuse_preset, f"preset not found {preset_name=}"
+        else:
+            assert preset.get("preset_name"), "inline presets must have a 'preset_name'"
+            diffuse_preset = collection.build_preset(preset)
+
+        jobs = []
+        for _ in range(count):
+            seed = random.getrandbits(32)
+            req_body = diffuse_preset.get_req_body(get_job_rng(seed))
+            jobs.append(DiffusionJob(diffuse_preset, req_body, seed, LANE_MANUAL, preset_spec=preset))
+
+        ids = job_queue.enqueue(DIFFUSION, [job.to_payload() for job in jobs], LANE_MANUAL)
+        logger.info(f"Jobs queued. {diffuse_preset.preset_name=} {ids=}")
+        self.broadcast_diffusion("queued", dict(
+            job_ids=ids,
+            preset_name=diffuse_preset.preset_name
+        ))
+        self.wake.set()
+        return ids
+
+    @staticmethod
+    def get_job(id: int) -> Optional[dict]:
+        job = job_queue.get(id)
+        if not job or job["kind"] != DIFFUSION:
+            return None
+        payload = job.pop("payload")
+        return dict(job, preset_name=payload["preset_name"], seed=payload["seed"])
+
+    def evict(self) -> int:
+        """
+        Makes room for generation by deleting images according to the eviction policy,
+        in one batch, once the library reaches its count or byte budget.
+        """
+        policy = self.envvars["eviction_policy"]
+        with lock:
+            entries = self.library.entries(exclude=self.filenames_to_delete)
+            victims, freed = plan_eviction(
+                entries,
+                policy,
+                max_count=self.envvars["max_images_allowed"],
+                max_bytes=self.envvars["max_library_mb"] * 1000 * 1000,
+                low_water=self.envvars["eviction_low_water"]
+            )
+            if victims:
+                self._enqueue_deletion([e.filename for e in victims])
+
+        if not victims:
+            return 0
+
+        evictions.inc(len(victims), policy=policy)
+        logger.info(f"Evicting. {policy=} {len(victims)=} {freed=}")
+        self.cleanup()
+        return len(victims)
+
+    def run_job(self, backend: Backend, job: DiffusionJob):
+        preset = job.preset
+        self.broadcast_diffusion("processing", dict(
+            job_id=job.id,
+            preset_name=preset.preset_name,
+            backend=backend.url
+        ))
+        logger.info(f"Starting {preset.preset_name=} {backend.url=}")
+        payload = DiffuseApiPayload(preset, get_static_req_body_provider(job.req_body), job_seed=job.seed,
+                                    preset_spec=job.preset_spec, replay=job.replay)
+        with progress_monitor.watch(backend.url, job.id, lambda update: self.broadcast_diffusion("progress", update)) as progress:
+            diffuse(backend.url, payload, on_saved=self.get_on_saved(preset), interrupted=progress.interrupted)
+        logger.info(f"Generation done: {preset.preset_name=}")
+        self.broadcast_diffusion("partially-done", dict(
+            job_id=job.id,
+            preset_name=preset.preset_name,
+            backend=backend.url
+        ))
+
+    def replay(self, filename: str, overrides: dict = None) -> Optional[dict]:
+        """
+        Queues the job behind an image for the next round exactly as it was recorded, without sampling
+        it again. 'overrides' go on top of its first stage, e.g. dict(enable_hr=True) to upscale.
+        Returns None if the image has no recorded job.
+        """
+        basename = get_basename(filename)
+        recorded = basename and metadata_store.get_job(basename)
+        if not recorded:
+            return None
+
+        preset_name = recorded["preset_name"]
+        preset_spec = recorded.get("preset")
+        collection = get_preset_collection()
+        preset = collection.build_preset(preset_spec) if preset_spec else collection.get_preset(preset_name)
+        assert preset, f"preset not found, it may have been renamed or removed {preset_name=}"
+
+        job = DiffusionJob(preset, {**recorded["req_body"], **(overrides or {})}, recorded["seed"], LANE_MANUAL,
+                           preset_spec=preset_spec, replay=True)
+        job.id = job_queue.enqueue(DIFFUSION, [job.to_payload()], LANE_MANUAL)[0]
+        logger.info(f"Replay queued. {filename=} {preset_name=} {job.seed=} {job.id=}")
+        self.wake.set()
+        return dict(id=job.id, preset_name=preset_name, seed=job.seed)
+
+    @staticmethod
+    def get_metrics_snapshot() -> dict:
+        return dict(
+            images=images_generated.total(),
+            swaps=checkpoint_swaps.total(),
+            stage_seconds=stage_seconds.sums()
+        )
+
+    def get_round_summary(self, snapshot: dict, duration_seconds: float, failures: int) -> dict:
+        """
+        failures: Jobs of the round that failed on every attempt
+        """
+        current = self.get_metrics_snapshot()
+        return dict(
+            duration_seconds=round(duration_seconds, 3),
+            images=current["images"] - snapshot["images"],
+            swaps=current["swaps"] - snapshot["swaps"],
+            failures=failures,
+            stage_seconds={
+                stage: round(seconds - snapshot["stage_seconds"].get(stage, 0), 3)
+                for stage, seconds in current["stage_seconds"].items()
+            }
+        )
+
+    def get_on_saved(self, preset: DiffusePreset) -> Callable[[str], None]:
+        def on_saved(filename: str):
+            entry = self.library.add(filename, preset_name=preset.preset_name)
+            if not entry:
+                dedup_index.remove(filename)
+                return
+            metadata_store.add_image(filename, get_basename(filename), entry.ctime, dhash=dedup_index.get(filename))
+            dedup_index.mark_stored(filename)
+        return on_saved
+
+    def rescan_library(self):
+        """
+        Reconciles the library with the disk, and then the search index with the library.
+        """
+        self.library.rescan()
+        images = [(e.filename, get_basename(e.filename) or e.json_path[:-len(SIDECAR_EXT)], e.ctime)
+                  for e in self.library.entries()]
+        missing = metadata_store.sync_images(images)
+        self.library.restore_usage(metadata_store.get_usage())
+        for basename in missing:
+            self._load_sidecar(basename)
+        dedup_index.rebuild(metadata_store.get_hashes())
+        logger.info(f"Search index synced. {len(images)=} {len(missing)=}")
+
+    def search_images(self, limit: int, cursor: str = None, **filters) -> Tuple[List[dict], Optional[str]]:
+        images, next_cursor = metadata_store.search(cursor=cursor, limit=limit, **filters)
+        return [image for image in images if image["filename"] not in self.filenames_to_delete], next_cursor
+
+    def refresh_models(self) -> dict:
+        models = dict()
+        for backend in self.dispatcher.configure(self.envvars["diffusion_url"]):
+            client = get_client(backend.url)
+            client.forget_checkpoint()
+            models[backend.url] = client.refresh_models()
+        return models
+
+    def get_next_pause(self, error: Exception = None) -> float:
+        """
+        Seconds to wait before the next round, based on how the last one went and the backends' state.
+        """
+        backends = self.dispatcher.backends
+        healthy = [b for b in backends if b.healthy]
+        cooldown_seconds = 0
+        if backends and not healthy:
+            cooldown_seconds = min(b.disabled_until for b in backends) - time.time()
+
+        busy = False
+        if self.envvars["diffusion_enabled"] and healthy and not error:
+            try:
+                busy = all(get_client(b.url).is_busy() for b in healthy)
+            except Exception as e:
+                logger.warning(f"Failed to check backend progress. {e=}")
+
+        library_ratio = 0
+        if self.envvars["eviction_policy"] == NO_EVICTION:
+            # Otherwise eviction makes room as needed
+            max_images = self.envvars["max_images_allowed"]
+            library_ratio = self.get_image_count() / max_images if max_images > 0 else 1
+
+        pause = self.pacer.next_pause(
+            error=error,
+            enabled=self.envvars["diffusion_enabled"],
+            busy=busy,
+            library_ratio=library_ratio,
+            cooldown_seconds=cooldown_seconds
+        )
+        logger.info(f"Next round. {pause=} {busy=} {self.pacer.consecutive_errors=}")
+        return pause
+
+    def get_backends(self) -> List[dict]:
+        return [backend.to_dict() for backend in self.dispatcher.backends]
+
     def override_envvars(self, config: ConfigSaveRequest):
+        validate_policy(config.eviction_policy)
         self.envvars = config.__dict__
 
+    def mark_viewed(self, filenames: List[str]):
+        viewed = time.time()
+        self.library.mark_viewed(filenames, viewed)
+        metadata_store.mark_viewed(filenames, viewed)
+
+    def set_rating(self, filename: str, rating: Optional[int]) -> bool:
+        if self.library.set_rating(filename, rating) is None:
+            return False
+        metadata_store.set_rating(filename, rating)
+        return True
+
     def get_metadata_by_filename(self, filename: str):
-        def _get():
-            matches = re.findall("^(.+)\-[0-9]\.crgimg$", filename)
-            assert matches, "filename must be "
+        return self.get_metadata_by_filenames([filename]).get(filename)
 
-            json_filename = matches[0] + ".json"
-            json_fullpath = os.path.join(IMG_DIR, json_filename)
+    def get_metadata_by_filenames(self, filenames: List[str]) -> Dict[str, dict]:
+        """
+        Looks the images up in the metadata store, falling back to the .json sidecars
+        for images generated before the store existed. Unknown filenames are left out.
+        """
+        basenames = {filename: get_basename(filename) for filename in filenames}
+        found = metadata_store.get_many(b for b in basenames.values() if b)
 
-            with open(json_fullpath) as fp:
-                return json.load(fp)
+        metadata = dict()
+        for filename, basename in basenames.items():
+            if not basename:
+                continue
+            if basename not in found:
+                found[basename] = self._load_sidecar(basename)
+            if found[basename] is not None:
+                metadata[filename] = found[basename]
+        return metadata
 
+    @staticmethod
+    def _load_sidecar(basename: str) -> Optional[dict]:
         try:
-            return _get()
+            with open(os.path.join(IMG_DIR, f"{basename}{SIDECAR_EXT}")) as fp:
+                body = json.load(fp)
+        except FileNotFoundError:
+            # Expected for images without a sidecar, which every rescan comes across again
+            logger.debug(f"No metadata sidecar {basename=}")
+            return None
         except Exception as e:
-            logger.error("Failed to get metadata by filename", e)
-
-        return None
+            logger.error(f"Failed to get metadata by filename {basename=} {e=}")
+            return None
 
+        metadata_store.put(basename, body, preset_name=get_preset_name(basename))
+        return body
 
     def delete(self, filenames: List[str]):
-        lock.acquire()
+        with lock:
+            self._enqueue_deletion(filenames)
+
+    def _enqueue_deletion(self, filenames: List[str]):
+        # Callers hold the lock, so that cleanup can't claim the job before the filenames are hidden
+        job_queue.enqueue(DELETION, [dict(filenames=filenames)])
         self.filenames_to_delete.update(filenames)
-        lock.release()
+
+    def restore_deletions(self):
+        """
+        Hides the images of the deletion jobs that a previous process didn't get to, until cleanup deletes them.
+        """
+        with lock:
+            for job in job_queue.unfinished(DELETION):
+                self.filenames_to_delete.update(job.payload["filenames"])
+        logger.info(f"Deletions restored. {len(self.filenames_to_delete)=}")
 
     def cleanup(self):
-        def _cleanup():
+        logger.info("Cleanup in progress...")
+        self.broadcast_cleanup("in progress")
+        cutoff = time.time() - self.envvars["auto_delete_days"]*24*3600
+
+        # Only the bookkeeping happens under the lock, the files get deleted after
+        with lock:
+            claimed = job_queue.claim(DELETION)
+            requested = sorted({filename for job in claimed for filename in job.payload["filenames"]})
+            self.filenames_to_delete.difference_update(requested)
+            _, requested_sidecars = self.library.remove_many(requested)
+            expired, expired_sidecars = self.library.pop_expired(cutoff)
+            strays = self.library.pop_strays(cutoff)
+
+        leased = {job.id: job for job in claimed}  # Handed back to the queue if cleanup stops before finishing them
+        try:
             deleted_filenames = []
-            logger.info("Cleanup in progress...")
-            self.broadcast_cleanup("in progress")
-            threshold = self.envvars["auto_delete_days"]*24*3600
-            old_filenames = get_old_files(IMG_DIR, age_seconds=threshold)
-            self.filenames_to_delete.update(old_filenames)
-            for filename in self.filenames_to_delete:
-                path = os.path.join(IMG_DIR, filename)
-                if os.path.exists(path):
-                    os.remove(path)
-                    logger.info(f"Deleted. {filename=}")
-                    deleted_filenames.append(filename)
-                else:
-                    logger.warning(f"Not found {path=}")
-            self.filenames_to_delete.clear()
-            logger.info("Cleanup done")
-            self.broadcast_cleanup(
-                "done",
-                dict(
-                    filenames=deleted_filenames,
-                    count=len(deleted_filenames)
-                )
+            undeleted = set()
+            for filename in requested + [e.filename for e in expired]:
+                try:
+                    if self._delete_file(filename, strict=True):
+                        logger.info(f"Deleted. {filename=}")
+                        deleted_filenames.append(filename)
+                except OSError:
+                    undeleted.add(filename)
+                    continue
+                dedup_index.remove(filename)
+                for rendition_path in self.library.get_rendition_paths(filename):
+                    self._delete_file(rendition_path, missing_ok=True)
+            metadata_store.remove_images([f for f in requested + [e.filename for e in expired] if f not in undeleted])
+            sidecars = requested_sidecars + expired_sidecars
+            for filename in sidecars:
+                self._delete_file(filename, missing_ok=True)
+            metadata_store.delete_many(f[:-len(SIDECAR_EXT)] for f in sidecars)
+            for path in strays:
+                self._delete_file(path, missing_ok=True)
+
+            # The jobs of the images that couldn't be deleted get retried, and so do expired ones, as a new job
+            with lock:
+                for job in claimed:
+                    failed = sorted(undeleted.intersection(job.payload["filenames"]))
+                    if not failed:
+                        continue
+                    del leased[job.id]
+                    if job_queue.fail(job.id, f"failed to delete {failed}"):
+                        self.filenames_to_delete.update(failed)
+                if undeleted.difference(requested):
+                    self._enqueue_deletion(sorted(undeleted.difference(requested)))
+            job_queue.complete(list(leased))
+            leased.clear()
+        finally:
+            with lock:
+                for job in leased.values():
+                    if job_queue.fail(job.id, "cleanup aborted"):
+                        self.filenames_to_delete.update(job.payload["filenames"])
+        job_queue.prune(time.time() - JOB_RETENTION_SECONDS)
+
+        logger.info(f"Cleanup done. {len(deleted_filenames)=} {len(strays)=}")
+        self.broadcast_cleanup(
+            "done",
+            dict(
+                filenames=deleted_filenames,
+                count=len(deleted_filenames)
             )
+        )
 
-        lock.acquire()
+    @staticmethod
+    def _delete_file(filename: str, missing_ok: bool = False, strict: bool = False) -> bool:
+        """
+        Returns whether the file got deleted. strict: Raise the OSError if it can't be, rather than log it
+        """
+        path = os.path.join(IMG_DIR, filename)
         try:
-            _cleanup()
-        finally:
-            lock.release()
+            os.remove(path)
+        except FileNotFoundError:
+            if not missing_ok:
+                logger.warning(f"Not found {path=}")
+            return False
+        except OSError as e:
+            logger.error(f"Failed to delete {path=} {e=}")
+            if strict:
+                raise
+            return False
+        cleanup_deletions.inc()
+        return True
 
     def broadcast_diffusion(self, message: dict, metadata: dict = None):
         if not self._broadcast_diffusion:
@@ -0,0 +1,66 @@
+"""
+Generates the missing renditions of an existing library, in parallel.
+
+    python backfill_renditions.py [--workers N] [--force]
+
+The running server picks the new renditions up on its next library rescan.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+import time
+
+from PIL import Image
+
+from const import IMG_DIR
+from diffuse.writer import RENDITION_SIZES, get_rendition_path, save_renditions
+from library import IMG_EXT
+
+logger = logging.getLogger("corganize")
+
+
+def is_missing_renditions(filename: str) -> bool:
+    return any(not os.path.exists(get_rendition_path(filename, size)) for size in RENDITION_SIZES)
+
+
+def render(filename: str) -> int:
+    with Image.open(os.path.join(IMG_DIR, filename)) as pillow_image:
+        # JPEGs can be decoded straight at a fraction of their size
+        pillow_image.draft("RGB", (max(RENDITION_SIZES), max(RENDITION_SIZES)))
+        pillow_image.load()
+        return save_renditions(pillow_image, filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--force", action="store_true", help="Regenerate renditions that already exist")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    assert RENDITION_SIZES, "renditions are disabled, set RENDITION_SIZES"
+
+    filenames = sorted(f for f in os.listdir(IMG_DIR) if f.endswith(IMG_EXT))
+    if not args.force:
+        filenames = [f for f in filenames if is_missing_renditions(f)]
+    logger.info(f"Backfilling renditions. {len(filenames)=} {RENDITION_SIZES=} {args.workers=}")
+
+    started = time.time()
+    done = failed = written = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {filename: executor.submit(render, filename) for filename in filenames}
+        for filename, future in futures.items():
+            try:
+                written += future.result()
+                done += 1
+            except Exception as e:
+                logger.error(f"Failed to render {filename=} {e=}")
+                failed += 1
+
+    duration_seconds = round(time.time() - started, 1)
+    logger.info(f"Backfill done. {done=} {failed=} {written=} {duration_seconds=}")
+
+
+if __name__ == "__main__":
+    main()
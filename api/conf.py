@@ -4,15 +4,25 @@ import os
 from const import BACKUP_DIR, DEFAULT_CONFIG_PATH, DEFAULT_OVERRIDE_CONFIG_PATH, OVERRIDE_CONFIG_PATH
 
 
+def get_config_path(default_path=DEFAULT_CONFIG_PATH, override_path=OVERRIDE_CONFIG_PATH or DEFAULT_OVERRIDE_CONFIG_PATH) -> str:
+    for path in (override_path, default_path):
+        if path and os.path.exists(path):
+            return path
+    raise RuntimeError("Config files not found")
+
+
 def get_config(default_path=DEFAULT_CONFIG_PATH, override_path=OVERRIDE_CONFIG_PATH or DEFAULT_OVERRIDE_CONFIG_PATH):
-    def _get_config():
-        for path in (override_path, default_path):
-            if path and os.path.exists(path):
-                with open(path) as fp:
-                    return json.load(fp)
-        raise RuntimeError("Config files not found")
-
-    return _get_config()
+    with open(get_config_path(default_path, override_path)) as fp:
+        return json.load(fp)
+
+
+def get_config_version(default_path=DEFAULT_CONFIG_PATH, override_path=OVERRIDE_CONFIG_PATH or DEFAULT_OVERRIDE_CONFIG_PATH) -> tuple:
+    """
+    Cheap fingerprint of the active config file. Changes whenever the file gets rewritten.
+    """
+    path = get_config_path(default_path, override_path)
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
 
 
 def save_config(config: dict, path=OVERRIDE_CONFIG_PATH or DEFAULT_OVERRIDE_CONFIG_PATH):
@@ -7,3 +7,5 @@ BACKUP_DIR = os.path.join(DATA_DIR, "backups")
 DEFAULT_CONFIG_PATH = "./default_config.json"
 OVERRIDE_CONFIG_PATH = os.getenv("OVERRIDE_CONFIG_PATH")
 DEFAULT_OVERRIDE_CONFIG_PATH = os.path.join(DATA_DIR, "config.json")
+DB_PATH = os.getenv("DB_PATH", os.path.join(DATA_DIR, "corganize.db"))
+RENDITIONS_DIR = os.path.join(IMG_DIR, "renditions")
@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Set
+
+from PIL import Image
+
+# Max Hamming distance between the dHashes of two images for them to count as duplicates. -1 disables dedup
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE", "4"))
+HASH_SIZE = 8  # 8x8 gradients -> 64 bit hashes
+
+logger = logging.getLogger("corganize")
+
+
+def dhash(pillow_image: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """
+    Difference hash: whether each pixel of a tiny grayscale copy is brighter than its right neighbour.
+    Survives re-encoding and small changes, unlike a hash of the bytes.
+    """
+    small = pillow_image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            i = row * (hash_size + 1) + col
+            value = (value << 1) | (pixels[i] > pixels[i + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class MultiIndexHash:
+    """
+    Splits hashes into max_distance + 1 chunks with an exact-match table per chunk. Two hashes within
+    max_distance of each other agree on at least one whole chunk (pigeonhole), so a query only has
+    to verify the few hashes sharing one of its chunks rather than walk the whole library.
+    """
+
+    def __init__(self, max_distance: int, bits: int = HASH_SIZE * HASH_SIZE):
+        chunks = min(max(max_distance, 0) + 1, bits)
+        self._layout = []  # (shift, mask) per chunk
+        shift = 0
+        for i in range(chunks):
+            width = bits // chunks + (i < bits % chunks)
+            self._layout.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables: List[Dict[int, Set[str]]] = [dict() for _ in self._layout]
+
+    def _parts(self, value: int) -> List[int]:
+        return [(value >> shift) & mask for shift, mask in self._layout]
+
+    def add(self, key: str, value: int):
+        for table, part in zip(self._tables, self._parts(value)):
+            table.setdefault(part, set()).add(key)
+
+    def remove(self, key: str, value: int):
+        for table, part in zip(self._tables, self._parts(value)):
+            bucket = table.get(part)
+            if bucket:
+                bucket.discard(key)
+                if not bucket:
+                    del table[part]
+
+    def candidates(self, value: int) -> Set[str]:
+        found = set()
+        for table, part in zip(self._tables, self._parts(value)):
+            found.update(table.get(part, ()))
+        return found
+
+
+class DedupIndex:
+    """
+    dHashes of the library's images, for finding near-duplicates of a new image.
+    """
+
+    def __init__(self, max_distance: int = DEDUP_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._index = MultiIndexHash(max_distance)
+        self._hashes: Dict[str, int] = dict()  # filename -> hash
+        self._unstored: Set[str] = set()  # Indexed here but not yet in the metadata store, which rebuild() reads from
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_distance >= 0
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def get(self, filename: str) -> Optional[int]:
+        return self._hashes.get(filename)
+
+    def _find(self, value: int) -> Optional[str]:
+        best = None
+        for key in self._index.candidates(value):
+            distance = hamming(self._hashes[key], value)
+            if distance <= self.max_distance and (best is None or distance < best[1]):
+                best = key, distance
+        return best and best[0]
+
+    def _add(self, filename: str, value: int):
+        self._remove(filename)
+        self._hashes[filename] = value
+        self._index.add(filename, value)
+
+    def _remove(self, filename: str):
+        value = self._hashes.pop(filename, None)
+        if value is not None:
+            self._index.remove(filename, value)
+
+    def check_and_add(self, filename: str, value: int) -> Optional[str]:
+        """
+        Returns the closest existing duplicate, or indexes the image and returns None.
+        Atomic, so two near-identical images saved at the same time can't both get in.
+        """
+        with self._lock:
+            duplicate_of = self._find(value) if self.enabled else None
+            if duplicate_of is None:
+                self._add(filename, value)
+                self._unstored.add(filename)
+            return duplicate_of
+
+    def add(self, filename: str, value: int):
+        """
+        Indexes the image without checking it, so later images can still be matched against it.
+        """
+        with self._lock:
+            self._add(filename, value)
+            self._unstored.add(filename)
+
+    def mark_stored(self, filename: str):
+        with self._lock:
+            self._unstored.discard(filename)
+
+    def remove(self, filename: str):
+        with self._lock:
+            self._remove(filename)
+            self._unstored.discard(filename)
+
+    def rebuild(self, hashes: Dict[str, int]):
+        """
+        Replaces the index with the stored hashes, keeping the ones of images still being written.
+        """
+        with self._lock:
+            unstored = {filename: self._hashes[filename] for filename in self._unstored}
+            self._index = MultiIndexHash(self.max_distance)
+            self._hashes = dict()
+            for filename, value in {**hashes, **unstored}.items():
+                self._add(filename, value)
+        logger.info(f"Dedup index rebuilt. {len(hashes)=} {len(unstored)=}")
+
+
+dedup_index = DedupIndex()
@@ -1,25 +1,28 @@
-from typing import Callable
-from diffuse.preset import DiffusePreset
+from typing import Callable, List, Optional
+from diffuse.client import DiffusionClient, get_client
+from diffuse.preset import DiffusePreset, get_job_rng
+from diffuse.stream import iter_response_images
+from diffuse.writer import image_writer
 from const import IMG_DIR
-from PIL import Image
-from urllib.parse import urljoin
-import requests
 import base64
-import io
 import logging
 import os
 import json
 import threading
 import re
 import json
+import uuid
+import requests
 
+from metrics import checkpoint_swaps, diffusion_failures, stage_seconds
+from store import metadata_store
 from utils import get_epoch_millis
 
 MAX_FILENAME_LEN = 64
+BASENAME_NONCE_LEN = 8
 REDIFFUSE_DEFAULT_DENOISING_STRENGTH = 0.35
+I2I_MAX_BATCH_SIZE = int(os.getenv("DIFFUSION_I2I_BATCH_SIZE", "4"))
 
-MODELS_PATH = "sdapi/v1/sd-models"
-OPTIONS_PATH = "sdapi/v1/options"
 REFESH_LORAS_PATH = "sdapi/v1/refresh-loras"
 TXT2IMG_PATH = "sdapi/v1/txt2img"
 IMG2IMG_PATH = "sdapi/v1/img2img"
@@ -30,29 +33,30 @@ logger = logging.getLogger("corganize")
 lock = threading.Lock()
 
 
-def t2i_req_body_provider(preset: DiffusePreset):
-    return preset.get_req_body()
+def t2i_req_body_provider(preset: DiffusePreset, rng=None):
+    return preset.get_req_body(rng)
 
 
-def get_i2i_req_body_provider(img_b64: str):
-    def provider(preset: DiffusePreset):
-        req_body = preset.get_req_body()
-        assert "denoising_strength" in req_body, "denoising_strength must be set"
-        req_body.update(dict(
-            init_images=[img_b64]
-        ))
+def get_static_req_body_provider(req_body: dict):
+    def provider(*_):
         return req_body
 
     return provider
 
 
-def get_rediffuse_req_body_provider(org_req_body: dict, img_b64: str):
-    def provider(_):
+def i2i_req_body_provider(preset: DiffusePreset, rng=None):
+    req_body = preset.get_req_body(rng)
+    assert "denoising_strength" in req_body, "denoising_strength must be set"
+    return req_body
+
+
+def get_rediffuse_req_body_provider(org_req_body: dict):
+    def provider(*_):
         # Note: not calling preset.get_req_body()
         # Just reusing the old req body.
         req_body = json.loads(json.dumps(org_req_body))
         req_body.update(dict(
-            init_images=[img_b64],
+            n_iter=1,  # One output per init image
             denoising_strength=REDIFFUSE_DEFAULT_DENOISING_STRENGTH,
             alwayson_scripts=dict(
                 ADetailer=dict(
@@ -70,14 +74,33 @@ class DiffuseApiPayload:
     preset_name: str
     api_path: str
     req_body: dict
+    init_images: List[str]  # base64, sent along with req_body in batches
+    encoder: dict
+    job_seed: Optional[int]  # Seeds every stage, see get_job_rng()
+    stage: int
+    job_req_body: dict  # The request body of the first stage
+    preset_spec: Optional[dict]  # Inline presets, which replays can't look up by name
+    replay: bool  # The final images skip dedup, see DiffusionJob.replay
     _timestamp: int
+    _nonce: str  # Tells apart the payloads that start within the same millisecond
 
-    def __init__(self, preset: DiffusePreset, req_body_provider: Callable = None, api_path: str = None, preset_name_override: str = None):
+    def __init__(self, preset: DiffusePreset, req_body_provider: Callable = None, api_path: str = None, preset_name_override: str = None, encoder: dict = None, init_images: List[str] = None,
+                 job_seed: int = None, stage: int = 0, job_req_body: dict = None, preset_spec: dict = None,
+                 replay: bool = False):
         self.preset = preset
         self.api_path = api_path or TXT2IMG_PATH
-        self.req_body = (req_body_provider or t2i_req_body_provider)(preset)
+        self.job_seed = job_seed
+        self.stage = stage
+        rng = get_job_rng(job_seed, stage) if job_seed is not None else None
+        self.req_body = (req_body_provider or t2i_req_body_provider)(preset, rng)
+        self.job_req_body = job_req_body or self.req_body
+        self.preset_spec = preset_spec
+        self.replay = replay
+        self.init_images = init_images or []
         self._timestamp = get_epoch_millis()
+        self._nonce = uuid.uuid4().hex[:BASENAME_NONCE_LEN]
         self.preset_name = preset_name_override or preset.preset_name
+        self.encoder = encoder or (preset and preset.encoder)
 
     @property
     def has_next(self):
@@ -87,50 +110,86 @@ class DiffuseApiPayload:
     def should_rediffuse(self):
         return self.preset and self.preset.should_rediffuse
 
+    @property
+    def is_final(self):
+        return not self.has_next and not self.should_rediffuse
+
+    def iter_req_bodies(self):
+        if not self.init_images:
+            yield self.req_body
+            return
+
+        for i in range(0, len(self.init_images), I2I_MAX_BATCH_SIZE):
+            batch = self.init_images[i:i + I2I_MAX_BATCH_SIZE]
+            yield {**self.req_body, "init_images": batch, "batch_size": len(batch)}
+
+    @property
+    def job(self) -> Optional[dict]:
+        """
+        What it takes to replay the whole job: the first stage's request body as it was sent,
+        and the seed that the following stages draw from.
+        """
+        if self.job_seed is None:
+            return None
+        job = dict(preset_name=self.preset_name, seed=self.job_seed, req_body=self.job_req_body)
+        if self.preset_spec is not None:
+            job["preset"] = self.preset_spec
+        return job
+
+    def _get_stage_args(self) -> dict:
+        return dict(
+            preset_name_override=self.preset_name,
+            encoder=self.encoder,
+            job_seed=self.job_seed,
+            stage=self.stage + 1,
+            job_req_body=self.job_req_body,
+            preset_spec=self.preset_spec,
+            replay=self.replay
+        )
+
     @property
     def basename(self):
         pname = self.preset_name
         assert pname, "'preset_name' must exist"
         bn = re.sub(r'[^a-zA-Z0-9]', '-', pname)
-        return f"{bn[:MAX_FILENAME_LEN]}-{self._timestamp}"
+        return f"{bn[:MAX_FILENAME_LEN]}-{self._timestamp}-{self._nonce}"
 
-    def get_next_payload(self, b64_img: str):
+    def get_next_payload(self, b64_imgs: List[str]):
         return DiffuseApiPayload(
             api_path=IMG2IMG_PATH,
             preset=self.preset.next,
-            req_body_provider=get_i2i_req_body_provider(b64_img),
-            preset_name_override=self.preset_name
+            req_body_provider=i2i_req_body_provider,
+            init_images=b64_imgs,
+            **self._get_stage_args()
         )
 
-    def get_rediffuse_payload(self, org_req_body: dict, b64_img: str):
+    def get_rediffuse_payload(self, b64_imgs: List[str]):
         return DiffuseApiPayload(
             api_path=IMG2IMG_PATH,
             preset=None,
-            req_body_provider=get_rediffuse_req_body_provider(
-                org_req_body, b64_img),
-            preset_name_override=self.preset_name
+            req_body_provider=get_rediffuse_req_body_provider(self.req_body),
+            init_images=b64_imgs,
+            **self._get_stage_args()
         )
 
+    def get_following_payload(self, b64_imgs: List[str]):
+        if self.has_next:
+            logger.info(f"Next preset found. {len(b64_imgs)=}")
+            return self.get_next_payload(b64_imgs)
+        if self.should_rediffuse:
+            logger.info(f"Rediffuse flag found. {len(b64_imgs)=}")
+            return self.get_rediffuse_payload(b64_imgs)
+        return None
 
-def _set_model_checkpoint(base_url: str, desired_model_name: str):
-    def get_checkpoint_name():
-        r = requests.get(urljoin(base_url, MODELS_PATH))
-        r.raise_for_status()
-        return [m["title"] for m in r.json() if m["model_name"] == desired_model_name][0]
 
-    try:
-        desired_checkpoint = get_checkpoint_name()
-    except:
+def _set_model_checkpoint(client: DiffusionClient, desired_model_name: str):
+    desired_checkpoint = client.get_checkpoint_title(desired_model_name)
+    if not desired_checkpoint:
         msg = f"Model/checkpoint not found: {desired_model_name=}"
         logger.error(msg)
         raise RuntimeError(msg)
 
-    url = urljoin(base_url, OPTIONS_PATH)
-    r = requests.get(url)
-    r.raise_for_status()
-    rjson: dict = r.json()
-
-    current_checkpoint = rjson.get("sd_model_checkpoint")
+    current_checkpoint = client.get_checkpoint()
 
     msg = f"{desired_model_name=} {desired_checkpoint=} {current_checkpoint=}"
     logger.info(msg)
@@ -139,54 +198,74 @@ def _set_model_checkpoint(base_url: str, desired_model_name: str):
         logger.info("No need to change checkpoint")
         return
 
-    r = requests.post(url, json=dict(
-        sd_model_checkpoint=desired_checkpoint
-    ))
-    if r.status_code >= 400:
-        logger.error(r.text)
-    r.raise_for_status()
-
-
-def diffuse(base_url: str, api_payload: DiffuseApiPayload):
-    basename = api_payload.basename
-    req_body = api_payload.req_body
-
-    with open(os.path.join(IMG_DIR, f"{basename}.json"), "w") as fp:
-        json.dump(req_body, fp, indent=2)
-
-    _set_model_checkpoint(base_url, req_body["model"])
-
-    url = urljoin(base_url, api_payload.api_path)
-    r = requests.post(url, json=req_body)
-    if r.status_code >= 400:
-        logger.error(r.text)
-    r.raise_for_status()
-
-    for i, img_b64_str in enumerate(r.json().get("images", [])):
-        if api_payload.has_next:
-            logger.info("Next preset found. Calling diffuse again...")
-            next_payload = api_payload.get_next_payload(img_b64_str)
-            return diffuse(base_url, next_payload)
-        if api_payload.should_rediffuse:
-            logger.info("Rediffuse flag found. Calling diffuse again...")
-            rediffuse_payload = api_payload.get_rediffuse_payload(
-                req_body, img_b64_str)
-            return diffuse(base_url, rediffuse_payload)
-
-        img_file_buffer = io.BytesIO()
-        pillow_image = Image.open(io.BytesIO(base64.b64decode(img_b64_str)))
-        pillow_image.save(
-            img_file_buffer,
-            format="jpeg",
-            quality=70,
-            optimize=True,
-            progressive=True
-        )
-        content_length = img_file_buffer.tell() // 1000
+    client.set_checkpoint(desired_checkpoint)
+    checkpoint_swaps.inc()
 
-        img_path = os.path.join(IMG_DIR, f"{basename}-{i}.crgimg")
-        with open(img_path, 'wb') as fp:
-            img_file_buffer.seek(0)
-            fp.write(img_file_buffer.read())
 
-        logger.info(f"Image saved. {content_length=} kB, {img_path=}")
+def diffuse(base_url: str, api_payload: DiffuseApiPayload, on_saved: Callable[[str], None] = None,
+            interrupted: threading.Event = None):
+    """
+    Runs the payload and then its 'next'/rediffuse stages, if any.
+    Every image of a stage is carried over to the following stage, in img2img batches.
+    Once 'interrupted' is set, the images still coming back are thrown away and the generation fails.
+    """
+    try:
+        _diffuse(get_client(base_url), api_payload, on_saved, interrupted)
+    except requests.HTTPError as e:
+        diffusion_failures.inc(status=e.response.status_code)
+        raise
+    except requests.RequestException:
+        diffusion_failures.inc(status="connection")
+        raise
+
+
+def _storing_metadata(api_payload: DiffuseApiPayload, on_saved: Callable[[str], None] = None) -> Callable[[str], None]:
+    """
+    Stores the batch's metadata along with its first saved image,
+    so that a batch whose images all got dropped as duplicates doesn't leave a row behind.
+    """
+    lock = threading.Lock()
+    stored = []
+
+    def on_image_saved(filename: str):
+        with lock:
+            if not stored:
+                metadata_store.put(api_payload.basename, api_payload.req_body, preset_name=api_payload.preset_name,
+                                   job=api_payload.job)
+                stored.append(filename)
+        if on_saved:
+            on_saved(filename)
+    return on_image_saved
+
+
+def _diffuse(client: DiffusionClient, api_payload: DiffuseApiPayload, on_saved: Callable[[str], None] = None,
+             interrupted: threading.Event = None):
+    while api_payload:
+        basename = api_payload.basename
+        req_body = api_payload.req_body
+
+        with open(os.path.join(IMG_DIR, f"{basename}.json"), "w") as fp:
+            json.dump(req_body, fp, indent=2)
+        on_image_saved = _storing_metadata(api_payload, on_saved) if api_payload.is_final else None
+
+        with stage_seconds.time(stage="checkpoint"):
+            _set_model_checkpoint(client, req_body["model"])
+
+        b64_imgs = []
+        i = 0
+        for batched_req_body in api_payload.iter_req_bodies():
+            with stage_seconds.time(stage="inference"), client.post(api_payload.api_path, json=batched_req_body, stream=True) as r:
+                if interrupted and interrupted.is_set():
+                    raise RuntimeError("Generation interrupted")
+                for img_bytes in iter_response_images(r):
+                    if api_payload.is_final:
+                        img_path = os.path.join(IMG_DIR, f"{basename}-{i}.crgimg")
+                        image_writer.submit(img_bytes, img_path, api_payload.encoder, on_image_saved,
+                                            dedup=not api_payload.replay)
+                    else:
+                        b64_imgs.append(base64.b64encode(img_bytes).decode())
+                    i += 1
+
+        if not b64_imgs:
+            return
+        api_payload = api_payload.get_following_payload(b64_imgs)
@@ -0,0 +1,176 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CONNECT_TIMEOUT_SECONDS = float(os.getenv("DIFFUSION_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT_SECONDS = float(os.getenv("DIFFUSION_READ_TIMEOUT", "900"))
+MAX_RETRIES = int(os.getenv("DIFFUSION_MAX_RETRIES", "3"))
+RETRY_BACKOFF_FACTOR = 2
+RETRY_STATUSES = (500, 502, 503, 504)
+POOL_SIZE = 4
+MODELS_TTL_SECONDS = int(os.getenv("DIFFUSION_MODELS_TTL", "3600"))
+CHECKPOINT_TTL_SECONDS = int(os.getenv("DIFFUSION_CHECKPOINT_TTL", "300"))
+
+MODELS_PATH = "sdapi/v1/sd-models"
+OPTIONS_PATH = "sdapi/v1/options"
+PROGRESS_PATH = "sdapi/v1/progress"
+INTERRUPT_PATH = "sdapi/v1/interrupt"
+PROBE_TIMEOUT_SECONDS = 10
+
+logger = logging.getLogger("corganize")
+
+
+class DiffusionClient:
+    """
+    HTTP client for a single Stable Diffusion backend.
+    Keeps connections alive in a pool and retries with backoff on 5xx and connection errors.
+    Blocking on purpose: generations run on the dispatcher's worker threads, one per backend slot,
+    so the event loop never waits on the backend.
+    """
+    base_url: str
+    session: requests.Session
+    _model_titles: Dict[str, str]  # model_name -> checkpoint title
+    _models_refreshed_at: float = 0
+    _checkpoint: Optional[str] = None  # The checkpoint title last seen or set on the backend
+    _checkpoint_verified_at: float = 0
+
+    def __init__(self, base_url: str,
+                 connect_timeout: float = CONNECT_TIMEOUT_SECONDS,
+                 read_timeout: float = READ_TIMEOUT_SECONDS,
+                 max_retries: int = MAX_RETRIES,
+                 pool_size: int = POOL_SIZE):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,  # A read timeout means the backend may still be generating, resubmitting would repeat the GPU work
+            status=max_retries,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None,  # txt2img/img2img are POSTs, resubmitting them after a refused connection or a 5xx is safe
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._model_titles = dict()
+        self._lock = threading.Lock()
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            r = self.session.request(method, urljoin(self.base_url, path), **kwargs)
+        except requests.RequestException:
+            self.forget_checkpoint()  # The backend may have restarted
+            raise
+        if r.status_code >= 400:
+            logger.error(r.text)
+            if r.status_code >= 500:
+                self.forget_checkpoint()
+        r.raise_for_status()
+        return r
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, json: dict = None, **kwargs) -> requests.Response:
+        return self.request("POST", path, json=json, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def refresh_models(self) -> Dict[str, str]:
+        r = self.get(MODELS_PATH)
+        model_titles = {m["model_name"]: m["title"] for m in r.json()}
+        with self._lock:
+            self._model_titles = model_titles
+            self._models_refreshed_at = time.time()
+        logger.info(f"Model list refreshed. {len(model_titles)=}")
+        return model_titles
+
+    def get_checkpoint_title(self, model_name: str) -> Optional[str]:
+        """
+        Looks up the checkpoint title from the cached model list. Refreshes on a miss or after the TTL.
+        """
+        expired = time.time() - self._models_refreshed_at > MODELS_TTL_SECONDS
+        if expired or model_name not in self._model_titles:
+            self.refresh_models()
+        return self._model_titles.get(model_name)
+
+    def get_checkpoint(self) -> Optional[str]:
+        """
+        The loaded checkpoint. Only asks the backend when the last known value is unknown or stale,
+        i.e. when something other than this process may have changed it.
+        """
+        if self._checkpoint is None or time.time() - self._checkpoint_verified_at > CHECKPOINT_TTL_SECONDS:
+            checkpoint = self.get(OPTIONS_PATH).json().get("sd_model_checkpoint")
+            with self._lock:
+                self._checkpoint = checkpoint
+                self._checkpoint_verified_at = time.time()
+        return self._checkpoint
+
+    def set_checkpoint(self, checkpoint: str):
+        self.post(OPTIONS_PATH, json=dict(sd_model_checkpoint=checkpoint))
+        with self._lock:
+            self._checkpoint = checkpoint
+            self._checkpoint_verified_at = time.time()
+
+    def forget_checkpoint(self):
+        with self._lock:
+            self._checkpoint = None
+
+    def is_busy(self) -> bool:
+        """
+        Whether the backend is in the middle of a job, i.e. someone else is using the GPU right now.
+        """
+        r = self.get(PROGRESS_PATH, params=dict(skip_current_image="true"),
+                     timeout=(self.timeout[0], PROBE_TIMEOUT_SECONDS))
+        state = r.json().get("state") or dict()
+        return bool(state.get("job_count")) or bool(state.get("job"))
+
+    def get_progress(self, with_image: bool = False) -> dict:
+        """
+        Progress of the current job, with the live preview (base64) as 'current_image' if with_image=True.
+        """
+        r = self.get(PROGRESS_PATH, params=dict(skip_current_image=str(not with_image).lower()),
+                     timeout=(self.timeout[0], PROBE_TIMEOUT_SECONDS))
+        return r.json()
+
+    def interrupt(self):
+        """
+        Stops the current job. The backend responds to it with whatever it has generated so far.
+        """
+        self.post(INTERRUPT_PATH, timeout=(self.timeout[0], PROBE_TIMEOUT_SECONDS))
+
+    @property
+    def current_model(self) -> Optional[str]:
+        """
+        model_name of the last known checkpoint. Never hits the network.
+        """
+        for model_name, title in self._model_titles.items():
+            if title == self._checkpoint:
+                return model_name
+        return None
+
+
+_clients: Dict[str, DiffusionClient] = dict()
+_clients_lock = threading.Lock()
+
+
+def get_client(base_url: str) -> DiffusionClient:
+    with _clients_lock:
+        if base_url not in _clients:
+            _clients[base_url] = DiffusionClient(base_url)
+        return _clients[base_url]
+
@@ -1,10 +1,12 @@
 from collections import defaultdict
-from random import choices
+import copy
+from itertools import accumulate
+import random
 import re
-from typing import List
+from typing import List, Optional, Tuple
 import json
 
-from diffuse.preset import DiffusePreset
+from diffuse.preset import DiffusePreset, get_job_rng, get_resolve_func
 
 
 def _get_tag_dictionary(templates: dict) -> dict:
@@ -31,16 +33,53 @@ class DiffusePresetCollection:
 
         self.preset_root["config"] = conf
 
-    def select(self, count: int) -> List[DiffusePreset]:
-        conf = self.preset_root.get("config", dict())
-        preset_dicts = self.preset_root.get("presets", [])
-        presets = [DiffusePreset(p, conf) for p in preset_dicts]
-        selected = choices(
-            presets,
-            weights=[p._specs.get("weight", 1) for p in presets],
-            k=count
-        )
-        return [DiffusePreset(p._specs, conf) for p in selected]
+        # Presets are never mutated after this point, so they can be handed out as they are.
+        self._resolve = get_resolve_func(conf.get("saved_prompts"))
+        self.presets = [DiffusePreset(p, conf, self._resolve) for p in self.preset_root.get("presets", [])]
+        self._cum_weights = list(accumulate(p._specs.get("weight", 1) for p in self.presets))
+
+    def select(self, count: int, rng=None) -> List[DiffusePreset]:
+        return (rng or random).choices(self.presets, cum_weights=self._cum_weights, k=count)
+
+    def sample(self, count: int, rng=None) -> List[Tuple[DiffusePreset, int, dict]]:
+        """
+        Selects 'count' presets in a single weighted draw and resolves a request body for each.
+        Each body comes from its own job seed, drawn from 'rng', so that it can be resolved again.
+        """
+        rng = rng or random
+        sampled = []
+        for preset in self.select(count, rng):
+            job_seed = rng.getrandbits(32)
+            sampled.append((preset, job_seed, preset.get_req_body(get_job_rng(job_seed))))
+        return sampled
+
+    def get_preset(self, preset_name: str) -> Optional[DiffusePreset]:
+        return next((p for p in self.presets if p.preset_name == preset_name), None)
+
+    def build_preset(self, preset: dict) -> DiffusePreset:
+        """
+        A preset that isn't part of the collection, with access to its templates and saved prompts.
+        'preset' is left as is, DiffusePreset fills in its copy.
+        """
+        return DiffusePreset(copy.deepcopy(preset), self.preset_root["config"], self._resolve)
+
+    def sample_bodies(self, count: int, seed: int = None, dedupe: bool = False) -> List[dict]:
+        """
+        Produces 'count' fully resolved request bodies. The same seed yields the same bodies.
+        With dedupe=True, bodies that only differ by their seed are dropped.
+        """
+        bodies = [body for _, _, body in self.sample(count, random.Random(seed))]
+        if not dedupe:
+            return bodies
+
+        seen = set()
+        unique_bodies = []
+        for body in bodies:
+            key = json.dumps({k: v for k, v in body.items() if k != "seed"}, sort_keys=True)
+            if key not in seen:
+                seen.add(key)
+                unique_bodies.append(body)
+        return unique_bodies
 
     @staticmethod
     def from_dict(config: dict):
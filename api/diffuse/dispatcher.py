@@ -0,0 +1,241 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Generic, List, Optional, Tuple, TypeVar
+
+import requests
+
+from diffuse.client import get_client
+
+BACKEND_MAX_FAILURES = int(os.getenv("DIFFUSION_BACKEND_MAX_FAILURES", "3"))
+BACKEND_COOLDOWN_SECONDS = int(os.getenv("DIFFUSION_BACKEND_COOLDOWN", "300"))
+BACKEND_SLOW_SECONDS = int(os.getenv("DIFFUSION_BACKEND_SLOW_SECONDS", "600"))
+JOB_MAX_ATTEMPTS = 2
+# Errors that say something about the backend rather than the job, e.g. not a broken preset
+BACKEND_ERRORS = (requests.RequestException,)
+
+logger = logging.getLogger("corganize")
+
+T = TypeVar("T")
+
+
+class Backend:
+    """
+    A Stable Diffusion server along with its concurrency limit and health state.
+    """
+    url: str
+    concurrency: int
+    active: int = 0
+    active_model: Optional[str] = None
+    failures: int = 0  # Consecutive
+    disabled_until: float = 0
+
+    def __init__(self, url: str, concurrency: int = 1):
+        assert concurrency > 0, f"backend concurrency must be positive {url=}"
+        self.url = url
+        self.concurrency = concurrency
+
+    @property
+    def healthy(self) -> bool:
+        return time.time() >= self.disabled_until
+
+    @property
+    def idle(self) -> bool:
+        return self.active < self.concurrency
+
+    @property
+    def current_model(self) -> Optional[str]:
+        return self.active_model or get_client(self.url).current_model
+
+    def record_success(self, duration_seconds: float):
+        if duration_seconds > BACKEND_SLOW_SECONDS:
+            logger.warning(f"Slow backend. {self.url=} {duration_seconds=}")
+            self.record_failure()
+            return
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= BACKEND_MAX_FAILURES:
+            logger.error(f"Taking backend out of rotation. {self.url=} {BACKEND_COOLDOWN_SECONDS=}")
+            self.disabled_until = time.time() + BACKEND_COOLDOWN_SECONDS
+            self.failures = 0
+
+    def to_dict(self) -> dict:
+        return dict(
+            url=self.url,
+            concurrency=self.concurrency,
+            active=self.active,
+            healthy=self.healthy,
+            current_model=self.current_model
+        )
+
+
+def parse_backends(urls: str) -> List[Tuple[str, int]]:
+    """
+    'http://gpu1:7860*2,http://gpu2:7860' -> [('http://gpu1:7860', 2), ('http://gpu2:7860', 1)]
+    """
+    backends = []
+    for spec in urls.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        url, _, concurrency = spec.partition("*")
+        backends.append((url.strip().strip("/"), int(concurrency or 1)))
+    return backends
+
+
+class _PendingJob(Generic[T]):
+    def __init__(self, job: T, model: str, priority: int = 0):
+        self.job = job
+        self.model = model
+        self.priority = priority  # Lower goes first
+        self.attempts = 0
+        self.failed_on = set()
+
+
+class Dispatcher:
+    """
+    Routes jobs to whichever backend has a free slot, preferring jobs whose checkpoint the backend
+    already has loaded, within the highest priority among the pending jobs.
+    Backends that keep failing or are too slow sit out for a cooldown period.
+    """
+    _backends: Dict[str, Backend]
+
+    def __init__(self):
+        self._backends = dict()
+        self._cond = threading.Condition()
+
+    def configure(self, urls: str) -> List[Backend]:
+        backends = dict()
+        for url, concurrency in parse_backends(urls):
+            backend = self._backends.get(url) or Backend(url, concurrency)
+            backend.concurrency = concurrency
+            backends[url] = backend
+        assert backends, "at least 1 diffusion backend is required"
+        self._backends = backends
+        return list(backends.values())
+
+    @property
+    def backends(self) -> List[Backend]:
+        return list(self._backends.values())
+
+    def _pick(self, backend: Backend, backends: List[Backend], pending: List[_PendingJob],
+              others_available: bool) -> Optional[_PendingJob]:
+        if others_available:
+            # Leave retries to the other backends
+            pending = [p for p in pending if backend.url not in p.failed_on]
+            if not pending:
+                return None
+
+        top = min(p.priority for p in pending)
+        pending = [p for p in pending if p.priority == top]
+
+        if backend.active:
+            # Don't make a backend swap checkpoints under its own in-flight jobs
+            return next((p for p in pending if p.model == backend.active_model), None)
+
+        loaded_model = backend.current_model
+        for p in pending:
+            if p.model == loaded_model:
+                return p
+
+        loaded_elsewhere = {b.current_model for b in backends if b is not backend and b.healthy}
+        return next((p for p in pending if p.model not in loaded_elsewhere), pending[0])
+
+    def run(self, jobs: List[T], get_model: Callable[[T], str], func: Callable[[Backend, T], None],
+            get_priority: Callable[[T], int] = None, feed: Callable[[], List[T]] = None) -> List[Tuple[T, Exception]]:
+        """
+        Runs func(backend, job) for every job and blocks until all of them are done.
+        'feed' gets called at every job boundary for jobs to add to the run, which then go ahead
+        of the pending ones if they have a higher priority.
+        Returns the jobs that failed on every attempt, along with their last errors.
+        """
+        get_priority = get_priority or (lambda _: 0)
+
+        def to_pending(job: T) -> _PendingJob:
+            return _PendingJob(job, get_model(job), get_priority(job))
+
+        pending = [to_pending(job) for job in jobs]
+        failed: List[Tuple[T, Exception]] = []
+        in_flight = [0]
+        # configure() may swap the backends mid-run, this run sticks to the ones it started with
+        backends = self.backends
+        workers = {backend.url: 0 for backend in backends}  # Live worker threads per backend
+
+        def others_available(backend: Backend) -> bool:
+            return any(b.healthy and workers[b.url] for b in backends if b is not backend)
+
+        def next_job(backend: Backend) -> Optional[_PendingJob]:
+            # Idle workers stick around while jobs are in flight, for their retries and for fed jobs
+            while backend.healthy:
+                if feed:
+                    pending.extend(to_pending(job) for job in feed())
+                p = pending and self._pick(backend, backends, pending, others_available(backend))
+                if p:
+                    return p
+                if not in_flight[0]:
+                    return None  # Nothing left, or only retries meant for other backends
+                self._cond.wait()
+            return None
+
+        def work(backend: Backend):
+            try:
+                while True:
+                    with self._cond:
+                        p = next_job(backend)
+                        if not p:
+                            return
+
+                        pending.remove(p)
+                        p.attempts += 1
+                        in_flight[0] += 1
+                        backend.active += 1
+                        backend.active_model = p.model
+
+                    started = time.time()
+                    error = None
+                    try:
+                        func(backend, p.job)
+                    except Exception as e:
+                        logger.error(f"Job failed. {backend.url=} {p.attempts=} {e=}")
+                        error = e
+
+                    with self._cond:
+                        in_flight[0] -= 1
+                        backend.active -= 1
+                        if not backend.active:
+                            backend.active_model = None
+                        if error is None:
+                            backend.record_success(time.time() - started)
+                        else:
+                            if isinstance(error, BACKEND_ERRORS):
+                                backend.record_failure()
+                            p.failed_on.add(backend.url)
+                            if p.attempts < JOB_MAX_ATTEMPTS:
+                                pending.insert(0, p)
+                            else:
+                                failed.append((p.job, error))
+                        self._cond.notify_all()
+            finally:
+                with self._cond:
+                    workers[backend.url] -= 1
+                    self._cond.notify_all()
+
+        threads = []
+        for backend in backends:
+            if not backend.healthy:
+                continue
+            for i in range(backend.concurrency):
+                workers[backend.url] += 1
+                threads.append(threading.Thread(target=work, args=(backend,), name=f"dispatch-{backend.url}-{i}"))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Whatever is left couldn't be placed on any healthy backend
+        failed.extend((p.job, RuntimeError("No healthy backends")) for p in pending)
+        return failed
@@ -0,0 +1,57 @@
+import logging
+import os
+from typing import Optional
+
+MIN_PAUSE_SECONDS = float(os.getenv("DIFFUSION_MIN_PAUSE", "0"))
+BUSY_PAUSE_SECONDS = float(os.getenv("DIFFUSION_BUSY_PAUSE", "15"))
+ERROR_BACKOFF_SECONDS = float(os.getenv("DIFFUSION_ERROR_BACKOFF", "30"))
+MAX_PAUSE_SECONDS = float(os.getenv("DIFFUSION_MAX_PAUSE", "1800"))
+LIBRARY_THROTTLE_RATIO = float(os.getenv("LIBRARY_THROTTLE_RATIO", "0.9"))
+LIBRARY_FULL_PAUSE_SECONDS = 60  # Roughly how often cleanup gets to make room
+IDLE_PAUSE_SECONDS = 30  # While diffusion is disabled
+
+logger = logging.getLogger("corganize")
+
+
+class RoundPacer:
+    """
+    Decides how long to wait before the next round of diffusion.
+    Rounds run back to back while the backends are idle, back off exponentially on errors
+    and slow down as the library fills up.
+    """
+    consecutive_errors: int = 0
+    last_pause: float = 0
+
+    def next_pause(self,
+                   error: Optional[Exception] = None,
+                   enabled: bool = True,
+                   busy: bool = False,
+                   library_ratio: float = 0,
+                   cooldown_seconds: float = 0) -> float:
+        """
+        error: Raised by the last round, if any
+        busy: Every backend is running someone else's jobs
+        library_ratio: Library size over max_images_allowed
+        cooldown_seconds: How long until a backend comes back into rotation, when none are healthy
+        """
+        if error:
+            self.consecutive_errors += 1
+            pause = ERROR_BACKOFF_SECONDS * 2 ** (self.consecutive_errors - 1)
+        else:
+            self.consecutive_errors = 0
+            pause = MIN_PAUSE_SECONDS
+
+        if not enabled:
+            pause = max(pause, IDLE_PAUSE_SECONDS)
+        if busy:
+            pause = max(pause, BUSY_PAUSE_SECONDS)
+        if library_ratio >= 1:
+            pause = max(pause, LIBRARY_FULL_PAUSE_SECONDS)
+        elif library_ratio > LIBRARY_THROTTLE_RATIO:
+            # Grows linearly from 0 at the throttle ratio to the full pause at the limit
+            fullness = (library_ratio - LIBRARY_THROTTLE_RATIO) / (1 - LIBRARY_THROTTLE_RATIO)
+            pause = max(pause, LIBRARY_FULL_PAUSE_SECONDS * fullness)
+        pause = max(pause, cooldown_seconds)
+
+        self.last_pause = min(pause, MAX_PAUSE_SECONDS)
+        return self.last_pause
@@ -0,0 +1,88 @@
+from typing import Dict, List, Optional
+
+from diffuse.collection import DiffusePresetCollection
+from diffuse.preset import DiffusePreset
+from jobs import LANE_BACKGROUND
+
+
+class DiffusionJob:
+    preset: DiffusePreset
+    req_body: dict
+    seed: int  # Derives the RNG of every stage, see get_job_rng()
+    lane: int
+    id: Optional[int] = None  # In the job queue
+    preset_spec: Optional[dict] = None  # Inline presets, which can't be looked up by name
+    replay: bool = False  # Re-renders an existing image, which dedup would otherwise drop as a duplicate of it
+
+    def __init__(self, preset: DiffusePreset, req_body: dict, seed: int = None, lane: int = LANE_BACKGROUND, id: int = None,
+                 preset_spec: dict = None, replay: bool = False):
+        self.preset = preset
+        self.req_body = req_body
+        self.seed = seed
+        self.lane = lane
+        self.id = id
+        self.preset_spec = preset_spec
+        self.replay = replay
+
+    def to_payload(self) -> dict:
+        """
+        What the job queue keeps of the job, enough to run it again after a restart without sampling it again.
+        """
+        payload = dict(preset_name=self.preset.preset_name, seed=self.seed, req_body=self.req_body)
+        if self.preset_spec is not None:
+            payload["preset"] = self.preset_spec
+        if self.replay:
+            payload["replay"] = True
+        return payload
+
+    @property
+    def model(self) -> str:
+        return self.req_body.get("model")
+
+
+class RoundPlan:
+    jobs: List[DiffusionJob]
+    swaps: int
+    swaps_avoided: int
+
+    def __init__(self, jobs: List[DiffusionJob], swaps: int, swaps_avoided: int):
+        self.jobs = jobs
+        self.swaps = swaps
+        self.swaps_avoided = swaps_avoided
+
+
+def count_swaps(models: List[str], current_model: str = None) -> int:
+    swaps = 0
+    for model in models:
+        if model != current_model:
+            swaps += 1
+            current_model = model
+    return swaps
+
+
+def plan_round(collection: DiffusePresetCollection, count: int, current_model: str = None, rng=None,
+               queued: List[DiffusionJob] = None) -> RoundPlan:
+    """
+    Samples the whole round up front and groups the jobs by checkpoint so that each model gets
+    loaded at most once. Only the order changes, so the preset weights are honoured as before.
+    The checkpoint that's already loaded goes first. Jobs already in the job queue join the round as they are.
+    Higher priority lanes go before lower ones, and are grouped by checkpoint on their own.
+    """
+    sampled = list(queued or [])
+    sampled += [DiffusionJob(preset, req_body, seed) for preset, seed, req_body in collection.sample(count, rng)]
+
+    jobs = []
+    model = current_model
+    for lane in sorted({job.lane for job in sampled}):
+        groups: Dict[str, List[DiffusionJob]] = dict()
+        if model:
+            groups[model] = []
+        for job in sampled:
+            if job.lane == lane:
+                groups.setdefault(job.model, []).append(job)
+        jobs += [job for group in groups.values() for job in group]
+        model = jobs[-1].model
+
+    naive_swaps = count_swaps([job.model for job in sampled], current_model)
+    swaps = count_swaps([job.model for job in jobs], current_model)
+    return RoundPlan(jobs, swaps=swaps, swaps_avoided=naive_swaps - swaps)
@@ -1,6 +1,7 @@
-from random import randint
+import random
 import re
 import json
+from typing import Callable, Dict, List
 
 from diffuse.prompt_concatenator import PromptConcatenator
 from diffuse.template_consumer import TemplateConsumer
@@ -9,36 +10,90 @@ from diffuse.randomizer import Randomizer
 
 MAX_FILENAME_LEN = 64
 
+SAVED_PROMPT_REF_PATTERN = re.compile(r"(\/[a-zA-Z0-9_]+)")
+
 randomize = Randomizer.apply
 
 
-def get_resolve_func(prompt_lookup: dict):
-    def _resolve(prompt: str):
-        prompt = randomize(prompt)
-        matches = re.findall(r"(\/[a-zA-Z0-9_]+)", prompt)
-        for match in matches:
-            key = match.strip("/")
-            if key in prompt_lookup:
-                resolved = _resolve(prompt_lookup[key])
-                prompt = prompt.replace(match, resolved, 1)
+def _find_cycle(graph: Dict[str, set]) -> List[str]:
+    visiting, visited = [], set()
+
+    def visit(key: str):
+        if key in visited:
+            return None
+        if key in visiting:
+            return visiting[visiting.index(key):] + [key]
+        visiting.append(key)
+        for ref in sorted(graph[key]):
+            cycle = visit(ref)
+            if cycle:
+                return cycle
+        visiting.pop()
+        visited.add(key)
+        return None
+
+    for key in graph:
+        cycle = visit(key)
+        if cycle:
+            return cycle
+    return None
+
+
+class SavedPromptResolver:
+    """
+    Randomizes a prompt and substitutes its '/saved_prompt' references, recursively.
+    The reference graph is validated once up front so that cyclic references fail fast.
+    """
+    prompt_lookup: dict
+
+    def __init__(self, prompt_lookup: dict) -> None:
+        self.prompt_lookup = prompt_lookup or dict()
+
+        graph = {
+            key: {ref[1:] for ref in SAVED_PROMPT_REF_PATTERN.findall(str(prompt))} & self.prompt_lookup.keys()
+            for key, prompt in self.prompt_lookup.items()
+        }
+        cycle = _find_cycle(graph)
+        assert not cycle, f"saved prompts must not reference each other cyclically {cycle=}"
 
-        return prompt
+    def __call__(self, prompt: str, rng=None) -> str:
+        prompt = randomize(prompt, rng)
+        if "/" not in prompt:
+            return prompt
 
-    return _resolve
+        def _substitute(match: re.Match) -> str:
+            key = match.group(0)[1:]
+            if key in self.prompt_lookup:
+                return self(self.prompt_lookup[key], rng)
+            return match.group(0)
 
+        return SAVED_PROMPT_REF_PATTERN.sub(_substitute, prompt)
 
-def _get_req_body(preset: dict, conf: dict) -> dict:
+
+def get_resolve_func(prompt_lookup: dict) -> Callable[[str], str]:
+    return SavedPromptResolver(prompt_lookup)
+
+
+def get_job_rng(job_seed: int, stage: int = 0) -> random.Random:
+    """
+    The RNG behind stage 'stage' of a job. Everything random about a job (templates, prompt
+    alternatives, the SD seed) derives from its recorded seed, so the job can be regenerated.
+    """
+    return random.Random(f"{job_seed}-{stage}")
+
+
+def _get_req_body(preset: dict, conf: dict, resolve: Callable[[str], str], rng=None) -> dict:
     """
     See https://github.com/AUTOMATIC1111/stable-diffusion-webui/wiki/API
     """
+    rng = rng or random
     allowed_keys = conf.get("allowed_keys")
-    resolve = get_resolve_func(conf.get("saved_prompts"))
-    template_consumer = TemplateConsumer(conf.get("templates"), resolve)
+    template_consumer = TemplateConsumer(conf.get("templates"), resolve, rng)
     preset = template_consumer.consume(preset)
 
     assert preset.get("model"), "'model' must be set"
 
-    prompt_concatenator = PromptConcatenator(resolve)
+    prompt_concatenator = PromptConcatenator(resolve, rng)
     preset["prompt"] = prompt_concatenator.concatenate(
         preset.get("prompt_elements"),
         preset.get("prompt"),
@@ -46,19 +101,21 @@ def _get_req_body(preset: dict, conf: dict) -> dict:
     )
 
     return {
-        **{k: randomize(v) for k, v in preset.items() if allowed_keys is None or k in allowed_keys},
-        "seed": randint(0, 2**32 - 1)
+        **{k: randomize(v, rng) for k, v in preset.items() if allowed_keys is None or k in allowed_keys},
+        "seed": rng.randint(0, 2**32 - 1)
     }
 
 
 class DiffusePreset:
     _specs: dict
     _conf: dict
+    _resolve: Callable[[str], str]
     next = None  # type: DiffusePreset
     should_rediffuse: bool = False
 
-    def __init__(self, preset: dict, conf: dict):
+    def __init__(self, preset: dict, conf: dict, resolve: Callable[[str], str] = None):
         conf = conf or dict()
+        resolve = resolve or get_resolve_func(conf.get("saved_prompts"))
 
         preset = json.loads(json.dumps(preset))
         preset["prompt"] = preset.get("prompt", "")
@@ -75,15 +132,23 @@ class DiffusePreset:
 
         self._specs = preset
         self._conf = conf
+        self._resolve = resolve
         self.should_rediffuse = preset.get("rediffuse") is True
 
         next = preset.get("next")
         if next:
-            self.next = DiffusePreset(next, conf)
+            self.next = DiffusePreset(next, conf, resolve)
 
-    def get_req_body(self):
-        return _get_req_body(self._specs, self._conf)
+    def get_req_body(self, rng=None):
+        return _get_req_body(self._specs, self._conf, self._resolve, rng)
 
     @property
     def preset_name(self) -> str:
         return self._specs.get("preset_name")
+
+    @property
+    def encoder(self) -> dict:
+        """
+        Pillow save() options for the generated images, e.g. {"format": "webp", "quality": 80}
+        """
+        return self._specs.get("encoder")
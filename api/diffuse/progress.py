@@ -0,0 +1,198 @@
+import base64
+from contextlib import contextmanager
+import io
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from diffuse.client import get_client
+from metrics import stuck_jobs
+
+PROGRESS_INTERVAL_SECONDS = float(os.getenv("DIFFUSION_PROGRESS_INTERVAL", "1"))
+PREVIEW_INTERVAL_SECONDS = float(os.getenv("DIFFUSION_PREVIEW_INTERVAL", "5"))  # 0 disables previews
+STUCK_SECONDS = float(os.getenv("DIFFUSION_STUCK_SECONDS", "300"))  # 0 disables stuck detection
+PREVIEW_SIZE = 128
+PREVIEW_QUALITY = 70
+
+logger = logging.getLogger("corganize")
+
+
+def encode_preview(b64_image: str, size: int = PREVIEW_SIZE) -> str:
+    """
+    Shrinks the backend's live preview into a small JPEG data URL.
+    """
+    _, _, data = b64_image.rpartition(",")  # Some backends send a data URL
+    with Image.open(io.BytesIO(base64.b64decode(data))) as pillow_image:
+        pillow_image.thumbnail((size, size))
+        buffer = io.BytesIO()
+        pillow_image.convert("RGB").save(buffer, format="JPEG", quality=PREVIEW_QUALITY)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def get_fields(progress: dict) -> dict:
+    state = progress.get("state") or dict()
+    return dict(
+        progress=round(progress.get("progress") or 0, 2),
+        eta_seconds=round(progress.get("eta_relative") or 0),
+        step=state.get("sampling_step", 0),
+        steps=state.get("sampling_steps", 0),
+        job_no=state.get("job_no", 0),
+        job_count=state.get("job_count", 0)
+    )
+
+
+class JobProgress:
+    """
+    A running job as seen through the progress endpoint of its backend.
+    """
+    job_id: Optional[int]
+    backend_url: str
+    on_update: Callable[[dict], None]
+    interrupted: threading.Event  # Set once the job got interrupted for being stuck
+    errors: int = 0  # Failed polls
+    _sent: dict  # The fields as of the last update, only the changed ones get sent again
+    _preview_key: Optional[int] = None
+    _preview_polled_at: float = 0
+    _advanced_at: float
+    _marker: Optional[tuple] = None
+
+    def __init__(self, job_id: Optional[int], backend_url: str, on_update: Callable[[dict], None]):
+        self.job_id = job_id
+        self.backend_url = backend_url
+        self.on_update = on_update
+        self.interrupted = threading.Event()
+        self._sent = dict()
+        self._advanced_at = time.time()
+
+    def wants_preview(self, now: float, preview_interval: float) -> bool:
+        return preview_interval > 0 and now - self._preview_polled_at >= preview_interval
+
+    def update(self, progress: dict, now: float, with_image: bool = False) -> Optional[dict]:
+        """
+        Returns what changed since the last update, if anything.
+        with_image: Whether the live preview was asked for
+        """
+        fields = get_fields(progress)
+        delta = {k: v for k, v in fields.items() if self._sent.get(k) != v}
+        self._sent = fields
+
+        marker = (progress.get("state") or dict()).get("job_timestamp"), fields["job_no"], fields["step"]
+        if marker != self._marker:
+            self._marker = marker
+            self._advanced_at = now
+
+        if not with_image:
+            return delta or None
+
+        self._preview_polled_at = now
+        b64_image = progress.get("current_image")
+        if b64_image and hash(b64_image) != self._preview_key:
+            self._preview_key = hash(b64_image)
+            try:
+                delta["preview"] = encode_preview(b64_image)
+            except Exception as e:
+                logger.warning(f"Failed to encode preview. {self.job_id=} {e=}")
+
+        return delta or None
+
+    def is_stuck(self, now: float, stuck_seconds: float) -> bool:
+        # Only while sampling, the backend reports no job while it loads a checkpoint
+        sampling = bool(self._sent.get("job_count")) and bool(self._sent.get("steps"))
+        return stuck_seconds > 0 and sampling and now - self._advanced_at >= stuck_seconds
+
+
+class ProgressMonitor:
+    """
+    Polls the backends of the running jobs from a single thread, however many clients are watching,
+    and pushes rate-limited updates that only carry what changed, plus a small preview now and then.
+    Interrupts jobs that stop advancing.
+    The progress endpoint doesn't say which request it's about, so it only goes to a job, and only
+    gets it interrupted, while that job is the only one watched on its backend. Otherwise it's sent
+    for the backend as a whole.
+    """
+
+    def __init__(self,
+                 interval: float = PROGRESS_INTERVAL_SECONDS,
+                 preview_interval: float = PREVIEW_INTERVAL_SECONDS,
+                 stuck_seconds: float = STUCK_SECONDS):
+        self.interval = interval
+        self.preview_interval = preview_interval
+        self.stuck_seconds = stuck_seconds
+        self._watched: Dict[str, List[JobProgress]] = dict()  # backend_url -> oldest first
+        self._shared: Dict[str, JobProgress] = dict()  # backend_url -> progress of backends with several jobs watched
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    @contextmanager
+    def watch(self, backend_url: str, job_id: int = None, on_update: Callable[[dict], None] = None):
+        progress = JobProgress(job_id, backend_url, on_update or (lambda _: None))
+        with self._cond:
+            self._watched.setdefault(backend_url, []).append(progress)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="progress-monitor", daemon=True)
+                self._thread.start()
+        try:
+            yield progress
+        finally:
+            with self._cond:
+                self._watched[backend_url].remove(progress)
+                if not self._watched[backend_url]:
+                    del self._watched[backend_url]
+                    self._shared.pop(backend_url, None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._watched:
+                    self._thread = None
+                    return
+                current = [self._get_polled(url, watched) for url, watched in self._watched.items()]
+
+            for progress, exclusive in current:
+                self._poll(progress, exclusive)
+            time.sleep(self.interval)
+
+    def _get_polled(self, backend_url: str, watched: List[JobProgress]) -> Tuple[JobProgress, bool]:
+        """
+        The progress to poll the backend for, and whether it belongs to a single job.
+        """
+        if len(watched) == 1:
+            self._shared.pop(backend_url, None)
+            return watched[0], True
+        shared = self._shared.get(backend_url)
+        if shared is None:
+            shared = self._shared[backend_url] = JobProgress(None, backend_url, watched[0].on_update)
+        return shared, False
+
+    def _poll(self, progress: JobProgress, exclusive: bool = True):
+        now = time.time()
+        client = get_client(progress.backend_url)
+        with_image = progress.wants_preview(now, self.preview_interval)
+        try:
+            response = client.get_progress(with_image=with_image)
+        except Exception as e:
+            if not progress.errors:
+                logger.warning(f"Failed to poll progress. {progress.backend_url=} {e=}")
+            progress.errors += 1
+            return
+
+        delta = progress.update(response, now, with_image)
+        if delta:
+            progress.on_update(dict(job_id=progress.job_id, backend=progress.backend_url, **delta))
+
+        if exclusive and not progress.interrupted.is_set() and progress.is_stuck(now, self.stuck_seconds):
+            logger.error(f"Interrupting stuck job. {progress.job_id=} {progress.backend_url=} {self.stuck_seconds=}")
+            progress.interrupted.set()
+            stuck_jobs.inc()
+            progress.on_update(dict(job_id=progress.job_id, stuck=True))
+            try:
+                client.interrupt()
+            except Exception as e:
+                logger.error(f"Failed to interrupt. {progress.backend_url=} {e=}")
+
+
+progress_monitor = ProgressMonitor()
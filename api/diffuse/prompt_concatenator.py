@@ -1,22 +1,22 @@
 import json
 from typing import Callable, List, Union
-from random import choices, uniform
+import random
 
 from utils import find_duplicates
 
 
-def _randomize_lora(loras: List[dict]) -> List[dict]:
+def _randomize_lora(loras: List[dict], rng=random) -> List[dict]:
     ret_loras = []
     for lora in loras:
         if "one_of" in lora:
             candidates: List[dict] = lora["one_of"]
-            lora = choices(candidates, k=1)[0]
+            lora = rng.choices(candidates, k=1)[0]
         assert isinstance(lora, dict), f"lora must be a dictionary, {lora=}"
         ret_loras.append({**lora})
     return ret_loras
 
 
-def _randomize_weights(loras: List[dict]) -> List[dict]:
+def _randomize_weights(loras: List[dict], rng=random) -> List[dict]:
     """
     Converts weight=[float, float] to a single float.
     """
@@ -30,15 +30,15 @@ def _randomize_weights(loras: List[dict]) -> List[dict]:
             continue
 
         assert len(weight) == 2, "a weight range must be 2"
-        picked_weight = uniform(weight[0], weight[1])
+        picked_weight = rng.uniform(weight[0], weight[1])
         lora["weight"] = picked_weight
 
     return loras
 
 
-def _get_lora_tags(loras: List[dict]) -> str:
-    loras = _randomize_lora(loras)  # process "one_of"s
-    loras = _randomize_weights(loras)  # process weight ranges
+def _get_lora_tags(loras: List[dict], rng=random) -> str:
+    loras = _randomize_lora(loras, rng)  # process "one_of"s
+    loras = _randomize_weights(loras, rng)  # process weight ranges
 
     # A little set of validations
     for lora in loras:
@@ -55,19 +55,20 @@ def _get_lora_tags(loras: List[dict]) -> str:
 
 
 class PromptConcatenator:
-    def __init__(self, resolve: Callable) -> None:
+    def __init__(self, resolve: Callable, rng=None) -> None:
         self.resolve = resolve
+        self.rng = rng or random
 
     def select_and_resolve(self, kw: Union[dict, str]):
         def select():
             if isinstance(kw, dict):
                 assert "one_of" in kw, f"'one_of' needs to be present {kw=}"
-                return choices(kw["one_of"], k=1)[0]
+                return self.rng.choices(kw["one_of"], k=1)[0]
             return kw
 
-        return self.resolve(select())
+        return self.resolve(select(), self.rng)
 
     def concatenate(self, prompt_elements: Union[List[str], None], prompt: str, loras: Union[List[dict], None]) -> str:
         kws = [self.select_and_resolve(kw) for kw in prompt_elements or []]
         prompt = ",".join([kw for kw in kws if kw] + [prompt])
-        return self.resolve(prompt) + _get_lora_tags(loras or [])
+        return self.resolve(prompt, self.rng) + _get_lora_tags(loras or [], self.rng)
@@ -1,12 +1,18 @@
-from functools import reduce
-from random import choices
+from functools import lru_cache, reduce
+from itertools import accumulate
+import random
 import re
-from typing import Any, List
+from typing import Any, List, Union
+
+GROUP_PATTERN = re.compile(r"(\[[^\[\]]+\])")
+WEIGHT_PATTERN = re.compile(r"^\s*((0|[1-9]\d*)(\.\d+)?)\:(.+)*$")
+WEIGHT_PREFIX_PATTERN = re.compile(r"^\s*((0|[1-9]\d*)(\.\d+)?)\:")
+COMPILED_PROMPT_CACHE_SIZE = 8192
 
 
 def _deconstruct_candidate(candidates: List[str]):
     def _get_value_weight(candidate: str):
-        matches = re.findall(r"^\s*((0|[1-9]\d*)(\.\d+)?)\:(.+)*$", candidate)
+        matches = WEIGHT_PATTERN.findall(candidate)
         if not matches:
             return candidate, 1
         return matches[0][-1], float(matches[0][0])
@@ -20,21 +26,121 @@ def _deconstruct_candidate(candidates: List[str]):
     return reduce(_reducer, candidates, ([], []))
 
 
+def _randomize_legacy(s: str, rng) -> str:
+    """
+    The original two-pass regex implementation. Only used for the prompts that the compiler
+    can't represent, i.e. ones with nested or unbalanced brackets, or with line breaks.
+    """
+    def _randomize(s: str) -> str:
+        matches = GROUP_PATTERN.findall(s)
+        for match in matches:
+            candidates = match.strip("[").strip("]").split("|")
+            values, weights = _deconstruct_candidate(candidates)
+            s = s.replace(match, rng.choices(values, weights, k=1)[0], 1)
+        return s
+
+    first_pass = _randomize(s)
+    if not first_pass:
+        return ""
+    return _randomize(f"[{first_pass}]")
+
+
+class _Choice:
+    """
+    A '[a|0.5:b]' group with its cumulative weight table.
+    """
+
+    def __init__(self, group: str):
+        values, weights = _deconstruct_candidate(group[1:-1].split("|"))
+        self.values = values
+        self.cum_weights = list(accumulate(weights))
+
+    def sample(self, rng) -> str:
+        if len(self.values) == 1:
+            return self.values[0]
+        return rng.choices(self.values, cum_weights=self.cum_weights, k=1)[0]
+
+
+Segment = Union[str, _Choice]
+
+
+class CompiledPrompt:
+    """
+    A prompt parsed once into weighted top level alternatives ('a|0.5:b'), each of which is
+    a sequence of literals and '[...]' groups. Equivalent to the two-pass regex randomization
+    where each pass replaces the innermost groups and then treats the whole string as a group.
+    """
+    source: str
+    alternatives: List[List[Segment]]
+    cum_weights: List[float]
+    constant: str = None  # Set when there is nothing to sample
+    legacy: bool = False
+
+    def __init__(self, source: str):
+        self.source = source
+        self.alternatives = []
+        self.cum_weights = []
+
+        parts = GROUP_PATTERN.split(source)
+        literals = parts[0::2]
+        if "\n" in source or any("[" in literal or "]" in literal for literal in literals):
+            self.legacy = True
+            return
+
+        alternative: List[Segment] = []
+        alternatives = [alternative]
+        for i, part in enumerate(parts):
+            if i % 2:
+                alternative.append(_Choice(part))
+                continue
+            head, *tail = part.split("|")
+            alternative.append(head)
+            for piece in tail:
+                alternative = [piece]
+                alternatives.append(alternative)
+
+        weights = []
+        for alternative in alternatives:
+            alternative[:] = [segment for segment in alternative if segment != ""]
+            weight = 1
+            if alternative and isinstance(alternative[0], str):
+                match = WEIGHT_PREFIX_PATTERN.match(alternative[0])
+                if match:
+                    weight = float(match.group(1))
+                    alternative[0] = alternative[0][match.end():]
+            weights.append(weight)
+
+        self.alternatives = alternatives
+        self.cum_weights = list(accumulate(weights))
+
+        if len(alternatives) == 1 and all(isinstance(s, str) for s in alternatives[0]):
+            self.constant = "".join(alternatives[0])
+
+    def sample(self, rng=None) -> str:
+        if self.constant is not None:
+            return self.constant
+
+        rng = rng or random
+        if self.legacy:
+            return _randomize_legacy(self.source, rng)
+
+        if len(self.alternatives) == 1:
+            alternative = self.alternatives[0]
+        else:
+            alternative = rng.choices(self.alternatives, cum_weights=self.cum_weights, k=1)[0]
+
+        return "".join(s if isinstance(s, str) else s.sample(rng) for s in alternative)
+
+
+@lru_cache(maxsize=COMPILED_PROMPT_CACHE_SIZE)
+def compile_prompt(s: str) -> CompiledPrompt:
+    return CompiledPrompt(s)
+
+
 class Randomizer:
     @staticmethod
-    def apply(obj: Any):
+    def apply(obj: Any, rng=None):
         if isinstance(obj, str):
-            def _randomize(s: str) -> str:
-                matches = re.findall(r"(\[[^\[\]]+\])", s)
-                for match in matches:
-                    candidates = match.strip("[").strip("]").split("|")
-                    values, weights = _deconstruct_candidate(candidates)
-                    s = s.replace(match, choices(values, weights, k=1)[0], 1)
-                return s
-
-            first_pass = _randomize(obj)
-            if not first_pass:
-                return ""
-            return _randomize(f"[{first_pass}]")
+            return compile_prompt(obj).sample(rng)
 
         return obj
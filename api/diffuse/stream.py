@@ -0,0 +1,134 @@
+import base64
+from typing import Iterable, Iterator, List, Tuple
+
+CHUNK_SIZE = 64 * 1024
+
+_ESCAPES = {
+    ord('"'): b'"',
+    ord("\\"): b"\\",
+    ord("/"): b"/",
+    ord("b"): b"\b",
+    ord("f"): b"\f",
+    ord("n"): b"\n",
+    ord("r"): b"\r",
+    ord("t"): b"\t",
+}
+_WHITESPACE = b" \t\r\n"
+
+Event = Tuple[str, bytes]
+
+
+def iter_array_strings(chunks: Iterable[bytes], key: str) -> Iterator[Event]:
+    """
+    Incrementally scans a JSON document and streams the string items of the top level array
+    under 'key', without ever holding the whole document or a whole string in memory.
+    Yields ("data", content) for each piece of a string and ("end", b"") when it closes.
+    """
+    target_key = key.encode()
+    stack = bytearray()  # Open containers, b"{" or b"["
+    target_depth = -1  # Depth of the target array once it's been found
+    in_string = False
+    streaming = False  # True while inside a string item of the target array
+    captured: List[bytes] = []  # Content of a top level string, i.e. potentially a key
+    expect_key = False
+    last_key = None
+    carry = b""
+
+    for chunk in chunks:
+        buf = carry + chunk
+        carry = b""
+        i, n = 0, len(buf)
+
+        while i < n:
+            if in_string:
+                quote = buf.find(b'"', i)
+                backslash = buf.find(b"\\", i, quote if quote >= 0 else n)
+                end = backslash if backslash >= 0 else (quote if quote >= 0 else n)
+                if end > i:
+                    if streaming:
+                        yield "data", buf[i:end]
+                    elif len(stack) == 1:
+                        captured.append(buf[i:end])
+                i = end
+                if i >= n:
+                    break
+
+                if buf[i] == ord("\\"):
+                    if i + 1 >= n or (buf[i + 1] == ord("u") and i + 6 > n):
+                        carry = buf[i:]
+                        break
+                    if buf[i + 1] == ord("u"):
+                        unescaped = chr(int(buf[i + 2:i + 6], 16)).encode("utf-8", "surrogatepass")
+                        i += 6
+                    else:
+                        unescaped = _ESCAPES[buf[i + 1]]
+                        i += 2
+                    if streaming:
+                        yield "data", unescaped
+                    elif len(stack) == 1:
+                        captured.append(unescaped)
+                    continue
+
+                # Closing quote
+                i += 1
+                in_string = False
+                if streaming:
+                    streaming = False
+                    yield "end", b""
+                elif len(stack) == 1 and expect_key:
+                    last_key = b"".join(captured)
+                    expect_key = False
+                captured = []
+                continue
+
+            c = buf[i]
+            i += 1
+            if c in _WHITESPACE:
+                continue
+            if c == ord('"'):
+                in_string = True
+                streaming = len(stack) == target_depth
+                continue
+            if c in b"{[":
+                if len(stack) == 1 and c == ord("[") and last_key == target_key:
+                    target_depth = 2
+                stack.append(c)
+                expect_key = c == ord("{") and len(stack) == 1
+                continue
+            if c in b"}]":
+                stack.pop()
+                if len(stack) < target_depth:
+                    return
+                continue
+            if c == ord(","):
+                expect_key = len(stack) == 1
+                continue
+            # ':' and scalar literals (numbers, true, false, null) need no handling
+
+
+def iter_b64_strings(chunks: Iterable[bytes], key: str) -> Iterator[bytes]:
+    """
+    Decodes the base64 string items of the array under 'key', one item at a time.
+    """
+    decoded = bytearray()
+    remainder = b""
+    for event, data in iter_array_strings(chunks, key):
+        if event == "data":
+            data = remainder + data
+            aligned = len(data) // 4 * 4
+            decoded += base64.b64decode(data[:aligned])
+            remainder = data[aligned:]
+            continue
+
+        if remainder:
+            decoded += base64.b64decode(remainder)
+        yield decoded
+        decoded = bytearray()
+        remainder = b""
+
+
+def iter_response_images(response, key: str = "images") -> Iterator[bytes]:
+    """
+    Streams the decoded images out of a txt2img/img2img response opened with stream=True.
+    """
+    yield from iter_b64_strings(response.iter_content(chunk_size=CHUNK_SIZE), key)
@@ -1,5 +1,5 @@
 from functools import reduce
-from random import choices
+import random
 from typing import Callable, List, Set, Union
 import json
 import re
@@ -45,9 +45,10 @@ class TemplateConsumer:
     template_dict: dict
     resolve_saved_prompts: Callable
 
-    def __init__(self, templates: dict, resolve: Callable) -> None:
+    def __init__(self, templates: dict, resolve: Callable, rng=None) -> None:
         self.template_dict = templates or dict()
         self.resolve_saved_prompts = resolve
+        self.rng = rng or random
 
     def _get_referenced_templates(self, preset: dict) -> List[Union[str, dict]]:
         templates = preset.get("templates", [])
@@ -79,7 +80,7 @@ class TemplateConsumer:
         return preset
 
     def handle_string_ref(self, template_ref: str):
-        template_ref = TemplateConsumer.randomize(template_ref)
+        template_ref = TemplateConsumer.randomize(template_ref, self.rng)
         return self.template_dict.get(template_ref, dict())
 
     def handle_tag_selector(self, template_ref: dict):
@@ -105,14 +106,14 @@ class TemplateConsumer:
         if len(candidates) == 0:
             return dict()
 
-        template_ref = choices(list(candidates), k=1)[0]
+        template_ref = self.rng.choices(sorted(candidates), k=1)[0]
         return self.get_template(template_ref)
 
     def handle_one_of(self, template_ref: dict):
         candidates: List[Union[str, dict]] = template_ref["one_of"]
         assert len(candidates) > 0, "at least 1 candidate is required."
         weights = [_get_template_weight(c) for c in candidates]
-        template_ref = choices(candidates, weights, k=1)[0]
+        template_ref = self.rng.choices(candidates, weights, k=1)[0]
         return self.get_template(template_ref)
 
     def get_template_ref_resolver(self, template_ref: Union[str, dict]) -> Callable:
@@ -143,8 +144,8 @@ class TemplateConsumer:
         target = {**target}
 
         for key in ("prompt", "negative_prompt"):
-            resolved_target = self.resolve_saved_prompts(target[key])
-            resolved_acc = self.resolve_saved_prompts(acc[key])
+            resolved_target = self.resolve_saved_prompts(target[key], self.rng)
+            resolved_acc = self.resolve_saved_prompts(acc[key], self.rng)
             combined_values = [s for s in [resolved_target, resolved_acc] if s]
             target[key] = ",".join(combined_values)
 
@@ -0,0 +1,157 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import io
+import logging
+import os
+import threading
+from typing import Callable, List, Set
+
+from PIL import Image, features
+
+from const import RENDITIONS_DIR
+from dedup import dedup_index, dhash
+from metrics import bytes_written, duplicates_dropped, record_image_saved, stage_seconds
+
+ENCODER_WORKERS = int(os.getenv("ENCODER_WORKERS", "2"))
+ENCODER_QUEUE_SIZE = int(os.getenv("ENCODER_QUEUE_SIZE", "8"))
+DEFAULT_ENCODER = dict(
+    format="jpeg",
+    quality=70,
+    optimize=True,
+    progressive=True
+)
+# Longest side in pixels of each downscaled copy, smallest first. Empty disables renditions
+RENDITION_SIZES = sorted(int(s) for s in os.getenv("RENDITION_SIZES", "1024").split(",") if s.strip())
+RENDITION_ENCODER = dict(format="webp", quality=75, method=4) if features.check("webp") else dict(DEFAULT_ENCODER, quality=75)
+
+logger = logging.getLogger("corganize")
+
+
+def get_encoder(overrides: dict = None) -> dict:
+    overrides = overrides or dict()
+    assert isinstance(overrides, dict), f"'encoder' must be a dictionary {overrides=}"
+    return {**DEFAULT_ENCODER, **overrides}
+
+
+def get_rendition_path(filename: str, size: int) -> str:
+    return os.path.join(RENDITIONS_DIR, str(size), filename)
+
+
+def save_image(img_bytes: bytes, img_path: str, encoder: dict) -> int:
+    return write_image(Image.open(io.BytesIO(img_bytes)), img_path, encoder)
+
+
+def write_image(pillow_image: Image.Image, img_path: str, encoder: dict) -> int:
+    """
+    Re-encodes the image straight into a temporary file next to 'img_path' and renames it into
+    place, so a partially written image is never visible. Returns the number of bytes written.
+    """
+    if encoder["format"].lower() in ("jpeg", "jpg") and pillow_image.mode != "RGB":
+        pillow_image = pillow_image.convert("RGB")
+
+    tmp_path = f"{img_path}.part"
+    try:
+        with open(tmp_path, "wb") as fp:
+            pillow_image.save(fp, **encoder)
+            size = fp.tell()
+        os.replace(tmp_path, img_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return size
+
+
+def save_renditions(pillow_image: Image.Image, filename: str, sizes: List[int] = RENDITION_SIZES) -> int:
+    """
+    Writes a downscaled copy per size, each one derived from the next larger one.
+    Returns the number of bytes written.
+    """
+    total = 0
+    for size in sorted(sizes, reverse=True):
+        pillow_image = pillow_image.copy()
+        pillow_image.thumbnail((size, size), Image.LANCZOS)
+        path = get_rendition_path(filename, size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        total += write_image(pillow_image, path, RENDITION_ENCODER)
+    return total
+
+
+class ImageWriter:
+    """
+    Re-encodes and writes images on a small thread pool (Pillow releases the GIL while
+    coding) so the diffusion thread can send the next request right away.
+    submit() blocks once 'queue_size' images are waiting, which bounds the memory held in the queue.
+    """
+
+    def __init__(self, workers: int = ENCODER_WORKERS, queue_size: int = ENCODER_QUEUE_SIZE):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-writer")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._pending: Set[Future] = set()
+        self._lock = threading.Lock()
+
+    def _write(self, img_bytes: bytes, img_path: str, encoder: dict, on_saved: Callable[[str], None] = None,
+               dedup: bool = True):
+        filename = os.path.basename(img_path)
+        pillow_image = Image.open(io.BytesIO(img_bytes))
+        pillow_image.load()
+
+        duplicate_of = None
+        with stage_seconds.time(stage="dedup"):
+            if dedup:
+                duplicate_of = dedup_index.check_and_add(filename, dhash(pillow_image))
+            else:
+                dedup_index.add(filename, dhash(pillow_image))
+        if duplicate_of:
+            duplicates_dropped.inc()
+            logger.info(f"Dropping duplicate image. {filename=} {duplicate_of=}")
+            return
+
+        try:
+            with stage_seconds.time(stage="save"):
+                size = write_image(pillow_image, img_path, encoder)
+        except BaseException:
+            dedup_index.remove(filename)
+            raise
+        record_image_saved(size)
+
+        if RENDITION_SIZES:
+            with stage_seconds.time(stage="renditions"):
+                bytes_written.inc(save_renditions(pillow_image, filename))
+
+        content_length = size // 1000
+        logger.info(f"Image saved. {content_length=} kB, {img_path=}")
+        if on_saved:
+            on_saved(filename)
+
+    def _on_done(self, future: Future):
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+        e = future.exception()
+        if e:
+            logger.error(f"Failed to write image: {e}")
+
+    def submit(self, img_bytes: bytes, img_path: str, encoder: dict = None, on_saved: Callable[[str], None] = None,
+               dedup: bool = True) -> Future:
+        """
+        dedup=False writes the image even if it's a near-duplicate, e.g. when replaying a job on purpose.
+        """
+        self._slots.acquire()
+        future = self._executor.submit(self._write, img_bytes, img_path, get_encoder(encoder), on_saved, dedup)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def flush(self):
+        """
+        Waits for everything submitted so far to be written.
+        """
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+
+
+image_writer = ImageWriter()
@@ -0,0 +1,63 @@
+from typing import Callable, Dict, List, Tuple
+
+from library import LibraryEntry
+
+NO_EVICTION = "none"
+
+
+def _oldest_first(entry: LibraryEntry) -> tuple:
+    return entry.ctime, entry.filename
+
+
+def _least_recently_viewed(entry: LibraryEntry) -> tuple:
+    # Never viewed counts as viewed when it was created
+    return entry.last_viewed or entry.ctime, entry.filename
+
+
+def _lowest_rated(entry: LibraryEntry) -> tuple:
+    return entry.rating or 0, entry.ctime, entry.filename
+
+
+# Sort keys, the first entries get evicted first
+POLICIES: Dict[str, Callable[[LibraryEntry], tuple]] = dict(
+    oldest=_oldest_first,
+    lru=_least_recently_viewed,
+    rating=_lowest_rated
+)
+
+
+def validate_policy(name: str):
+    assert name == NO_EVICTION or name in POLICIES, f"unknown eviction policy {name=} {list(POLICIES)=}"
+
+
+def is_over_capacity(count: int, size: int, max_count: int, max_bytes: int) -> bool:
+    return count >= max_count or (max_bytes > 0 and size >= max_bytes)
+
+
+def plan_eviction(entries: List[LibraryEntry], policy: str, max_count: int, max_bytes: int = 0,
+                  low_water: float = 0.9) -> Tuple[List[LibraryEntry], int]:
+    """
+    Picks the entries to evict so that both the count and the byte budget (0 means unlimited)
+    drop to 'low_water' of their limits, leaving room for a few rounds before the next eviction.
+    Returns the victims and the number of bytes they free up.
+    """
+    validate_policy(policy)
+    assert 0 <= low_water <= 1, f"low water mark must be between 0 and 1 {low_water=}"
+
+    count = len(entries)
+    size = sum(e.size for e in entries)
+    if policy == NO_EVICTION or not is_over_capacity(count, size, max_count, max_bytes):
+        return [], 0
+
+    target_count = int(max_count * low_water)
+    target_bytes = int(max_bytes * low_water) if max_bytes > 0 else float("inf")
+    victims = []
+    freed = 0
+    for entry in sorted(entries, key=POLICIES[policy]):
+        if count <= target_count and size <= target_bytes:
+            break
+        victims.append(entry)
+        count -= 1
+        size -= entry.size
+        freed += entry.size
+    return victims, freed
@@ -0,0 +1,107 @@
+import asyncio
+from collections import deque
+import json
+import logging
+import os
+from typing import Deque, Optional, Set
+
+from fastapi import WebSocket
+
+from metrics import ws_dropped_messages
+
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "64"))
+SEND_TIMEOUT_SECONDS = 10
+
+logger = logging.getLogger("corganize")
+
+
+class Subscriber:
+    """
+    A websocket with its own bounded send queue. When a client can't keep up, the oldest
+    messages are dropped rather than holding up everyone else.
+    """
+
+    def __init__(self, websocket: WebSocket, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.websocket = websocket
+        self.queue: Deque[str] = deque(maxlen=queue_size)
+        self.ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def put(self, text: str):
+        if len(self.queue) == self.queue.maxlen:
+            ws_dropped_messages.inc()
+        self.queue.append(text)
+        self.ready.set()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                await asyncio.wait_for(self.websocket.send_text(self.queue.popleft()), SEND_TIMEOUT_SECONDS)
+
+
+class BroadcastHub:
+    """
+    Pub/sub for websocket clients. Lives on the server's event loop; any thread may publish().
+    Each message is serialized once and handed to every subscriber's queue.
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: Set[Subscriber] = set()
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def publish(self, topic: str, payload: dict):
+        """
+        Thread safe. Never blocks on the clients.
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        text = json.dumps(dict(
+            topic=topic,
+            payload=payload
+        ))
+        loop.call_soon_threadsafe(self._fan_out, text)
+
+    def _fan_out(self, text: str):
+        for subscriber in self._subscribers:
+            subscriber.put(text)
+
+    async def subscribe(self, websocket: WebSocket) -> Subscriber:
+        subscriber = Subscriber(websocket)
+        subscriber.task = asyncio.create_task(self._send_loop(subscriber))
+        self._subscribers.add(subscriber)
+        logger.info(f"Subscribed. {len(self._subscribers)=}")
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        if subscriber not in self._subscribers:
+            return
+        self._subscribers.discard(subscriber)
+        if subscriber.task and subscriber.task is not asyncio.current_task():
+            subscriber.task.cancel()
+        logger.info(f"Unsubscribed. {len(self._subscribers)=}")
+
+    async def _send_loop(self, subscriber: Subscriber):
+        try:
+            await subscriber.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Dead or stalled socket
+            logger.warning(f"Dropping websocket subscriber. {e=}")
+            self.unsubscribe(subscriber)
+            try:
+                await subscriber.websocket.close()
+            except Exception:
+                pass
+
+
+hub = BroadcastHub()
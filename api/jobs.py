@@ -0,0 +1,241 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Collection, List, Optional, Set
+
+from const import DB_PATH
+
+logger = logging.getLogger("corganize")
+
+# A claimed job goes back to the queue if its worker stops renewing the lease, e.g. after a crash or a reload
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_CLAIMS = int(os.getenv("JOB_MAX_CLAIMS", "3"))  # A job that keeps failing or crashing its worker is given up on
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(24 * 3600)))  # Finished jobs stay around for lookups
+
+DIFFUSION = "diffusion"
+DELETION = "deletion"
+
+# Lower lanes get claimed first
+LANE_MANUAL = 0
+LANE_BACKGROUND = 1
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+TABLES = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    lane INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (kind, state, lane, id);
+CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (state, updated);
+"""
+CLAIMABLE = f"(state = '{PENDING}' OR (state = '{LEASED}' AND lease_expires < ?))"
+
+
+class QueuedJob:
+    id: int
+    kind: str
+    lane: int
+    payload: dict
+    attempts: int  # Including the current one
+
+    def __init__(self, id: int, kind: str, lane: int, payload: dict, attempts: int):
+        self.id = id
+        self.kind = kind
+        self.lane = lane
+        self.payload = payload
+        self.attempts = attempts
+
+
+class JobQueue:
+    """
+    Generation and deletion jobs, persisted in SQLite so that a restart only replays the unfinished ones.
+    Claiming a job leases it to this process. The lease has to be renewed while the job runs,
+    and the job becomes claimable again once the lease expires.
+    A claimed job counts as running until it's completed or failed, only running jobs get their lease renewed.
+    """
+
+    def __init__(self, path: str = DB_PATH, lease_seconds: int = JOB_LEASE_SECONDS, max_claims: int = JOB_MAX_CLAIMS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_claims = max_claims
+        self.owner = uuid.uuid4().hex  # Per process, a restarted worker doesn't inherit the old leases
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+        self._running: Set[int] = set()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.executescript(TABLES)
+                self._conn = conn
+            return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def enqueue(self, kind: str, payloads: List[dict], lane: int = LANE_BACKGROUND, claim: bool = False) -> List[int]:
+        """
+        With claim=True the jobs are leased to this process right away, for jobs that are about to run.
+        """
+        now = time.time()
+        state, owner, expires, attempts = (LEASED, self.owner, now + self.lease_seconds, 1) if claim else (PENDING, None, None, 0)
+        ids = []
+        with self._transaction() as conn:
+            for payload in payloads:
+                cursor = conn.execute(
+                    "INSERT INTO jobs (kind, lane, state, payload, attempts, lease_owner, lease_expires, created, updated)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (kind, lane, state, json.dumps(payload), attempts, owner, expires, now, now)
+                )
+                ids.append(cursor.lastrowid)
+            if claim:
+                self._running.update(ids)
+        return ids
+
+    def claim(self, kind: str, limit: int = None) -> List[QueuedJob]:
+        """
+        Leases the next claimable jobs, highest priority lane first, oldest first within a lane.
+        Jobs that have used up their claims are marked failed instead.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                f"SELECT id, kind, lane, payload, attempts FROM jobs WHERE kind = ? AND {CLAIMABLE}"
+                " ORDER BY lane, id LIMIT ?",
+                (kind, now, -1 if limit is None else limit)
+            ).fetchall()
+
+            claimed = []
+            for id, kind, lane, payload, attempts in rows:
+                if attempts >= self.max_claims:
+                    logger.error(f"Giving up on job. {id=} {kind=} {attempts=}")
+                    conn.execute(
+                        "UPDATE jobs SET state = ?, error = COALESCE(error, 'lease expired'), lease_owner = NULL, updated = ?"
+                        " WHERE id = ?",
+                        (FAILED, now, id)
+                    )
+                    continue
+                conn.execute(
+                    "UPDATE jobs SET state = ?, attempts = attempts + 1, lease_owner = ?, lease_expires = ?, updated = ?"
+                    " WHERE id = ?",
+                    (LEASED, self.owner, now + self.lease_seconds, now, id)
+                )
+                claimed.append(QueuedJob(id, kind, lane, json.loads(payload), attempts + 1))
+            self._running.update(job.id for job in claimed)
+        return claimed
+
+    @property
+    def running(self) -> Set[int]:
+        with self._lock:
+            return set(self._running)
+
+    def renew(self):
+        """
+        Extends the leases of the running jobs. Needs to run well within the lease period.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND state = ? AND lease_owner = ?",
+                [(now + self.lease_seconds, id, LEASED, self.owner) for id in self._running]
+            )
+
+    def complete(self, ids: Collection[int]):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, error = NULL, updated = ? WHERE id = ?",
+                [(DONE, now, id) for id in ids]
+            )
+            self._running.difference_update(ids)
+
+    def fail(self, id: int, error: str, retry: bool = True) -> bool:
+        """
+        Puts the job back in the queue, or marks it failed once it has used up its claims or if retry=False.
+        Returns whether it is going to be retried.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT attempts FROM jobs WHERE id = ?", (id,)).fetchone()
+            retry = retry and bool(row) and row[0] < self.max_claims
+            conn.execute(
+                "UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, error = ?, updated = ? WHERE id = ?",
+                (PENDING if retry else FAILED, error, now, id)
+            )
+            self._running.discard(id)
+        return retry
+
+    def count(self, kind: str, lane: int = None) -> int:
+        """
+        Unfinished jobs, including the ones leased to other workers.
+        """
+        sql = "SELECT COUNT(*) FROM jobs WHERE kind = ? AND state IN (?, ?)"
+        params = [kind, PENDING, LEASED]
+        if lane is not None:
+            sql += " AND lane = ?"
+            params.append(lane)
+        with self._lock:
+            return self.conn.execute(sql, params).fetchone()[0]
+
+    def unfinished(self, kind: str) -> List[QueuedJob]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id, kind, lane, payload, attempts FROM jobs WHERE kind = ? AND state IN (?, ?) ORDER BY lane, id",
+                (kind, PENDING, LEASED)
+            ).fetchall()
+        return [QueuedJob(id, kind, lane, json.loads(payload), attempts) for id, kind, lane, payload, attempts in rows]
+
+    def get(self, id: int) -> Optional[dict]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT id, kind, lane, state, payload, attempts, error, created, updated FROM jobs WHERE id = ?", (id,)
+            ).fetchone()
+        if not row:
+            return None
+        id, kind, lane, state, payload, attempts, error, created, updated = row
+        return dict(id=id, kind=kind, lane=lane, state=state, payload=json.loads(payload), attempts=attempts,
+                    error=error, created=created, updated=updated)
+
+    def prune(self, before: float) -> int:
+        """
+        Forgets the jobs that finished before 'before'.
+        """
+        with self._lock:
+            cursor = self.conn.execute(
+                "DELETE FROM jobs WHERE state IN (?, ?) AND updated < ?", (DONE, FAILED, before)
+            )
+        return cursor.rowcount
+
+
+job_queue = JobQueue()
@@ -0,0 +1,416 @@
+import bisect
+import heapq
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import Collection, Dict, List, Optional, Set, Tuple
+
+from const import IMG_DIR, RENDITIONS_DIR
+
+IMG_EXT = ".crgimg"
+SIDECAR_EXT = ".json"
+FEISTEL_ROUNDS = 4
+
+logger = logging.getLogger("corganize")
+
+
+def get_basename(filename: str) -> Optional[str]:
+    """
+    'my-preset-1712345678901-1a2b3c4d-10.crgimg' -> 'my-preset-1712345678901-1a2b3c4d'
+    """
+    matches = re.findall(r"^(.+)\-[0-9]+\.crgimg$", filename)
+    return matches[0] if matches else None
+
+
+def get_preset_name(basename: str) -> str:
+    # The timestamp and nonce suffixes are added by DiffuseApiPayload.basename, older basenames lack the nonce
+    return re.sub(r"\-[0-9]+(\-[0-9a-f]{8})?$", "", basename)
+
+
+class LibraryEntry:
+    filename: str
+    ctime: float
+    mtime: float
+    size: int
+    preset_name: str
+    json_path: str  # Metadata sidecar shared by every image of the same batch
+    last_viewed: Optional[float] = None
+    rating: Optional[int] = None
+    renditions: Tuple[int, ...] = ()  # Sizes of the downscaled copies on disk
+
+    def __init__(self, filename: str, ctime: float, size: int, preset_name: str = None, mtime: float = None):
+        basename = get_basename(filename) or filename[:-len(IMG_EXT)]
+        self.filename = filename
+        self.ctime = ctime
+        self.mtime = ctime if mtime is None else mtime
+        self.size = size
+        self.preset_name = preset_name or get_preset_name(basename)
+        self.json_path = f"{basename}{SIDECAR_EXT}"
+
+    @property
+    def sort_key(self) -> Tuple[float, str]:
+        return self.ctime, self.filename
+
+    def carry_over(self, previous: Optional["LibraryEntry"]) -> "LibraryEntry":
+        """
+        Keeps what can't be read from the disk when the entry gets re-indexed.
+        """
+        if previous:
+            self.last_viewed = previous.last_viewed
+            self.rating = previous.rating
+        return self
+
+
+class FeistelPermutation:
+    """
+    Seeded bijection over range(size) that's evaluated one index at a time,
+    so walking a shuffled order never requires materializing it.
+    """
+
+    def __init__(self, size: int, seed: int):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        self.half_bits = (bits + 1) // 2
+        self.mask = (1 << self.half_bits) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(32) for _ in range(FEISTEL_ROUNDS)]
+
+    def _round(self, value: int, key: int) -> int:
+        x = (value * 0x9E3779B1 + key) & 0xFFFFFFFF
+        x ^= x >> 15
+        x = (x * 0x85EBCA6B) & 0xFFFFFFFF
+        x ^= x >> 13
+        return x & self.mask
+
+    def _encrypt(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.mask
+        for key in self.keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, index: int) -> int:
+        # Cycle-walks until the result lands within range(size), which keeps it a bijection
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+
+class ImageLibrary:
+    """
+    In-process index of the image directory so that the gallery endpoints don't have to
+    list and stat the whole (possibly network mounted) directory on every request.
+    Kept up to date by the diffusion and cleanup code paths; rescan() catches anything else.
+    """
+    directory: str
+    _entries: Dict[str, LibraryEntry]
+    _order: List[Tuple[float, str]]  # sorted by (ctime, filename), oldest first
+    _by_mtime: List[Tuple[float, str]]  # min-heap for cleanup, may hold stale items of removed entries
+    _sidecar_refs: Dict[str, int]  # json_path -> number of images sharing it
+    _orphan_sidecars: Dict[str, float]  # json_path -> mtime, for sidecars found without any image
+    _strays: Dict[str, float]  # path -> mtime, for leftovers that aren't indexed, like .part files
+    _total_size: int
+    _slots: List[Optional[str]]  # Filenames in insertion order, None where removed. Shuffled pages index into it
+    _slot_of: Dict[str, int]
+    _epoch: int  # Bumped whenever _slots get compacted, which invalidates shuffled cursors. Random per process
+
+    def __init__(self, directory: str = IMG_DIR, renditions_directory: str = RENDITIONS_DIR, rendition_sizes: Collection[int] = ()):
+        self.directory = directory
+        self.renditions_directory = renditions_directory
+        self.rendition_sizes = set(rendition_sizes)  # The configured sizes plus any found on disk by rescan()
+        self._lock = threading.Lock()
+        self._entries = dict()
+        self._order = []
+        self._by_mtime = []
+        self._sidecar_refs = dict()
+        self._orphan_sidecars = dict()
+        self._strays = dict()
+        self._total_size = 0
+        self._slots = []
+        self._slot_of = dict()
+        self._epoch = random.getrandbits(32)  # A cursor from before a restart mustn't index into the new slots
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self._entries
+
+    def _stat(self, filename: str, preset_name: str = None) -> Optional[LibraryEntry]:
+        try:
+            stat = os.stat(os.path.join(self.directory, filename))
+        except FileNotFoundError:
+            return None
+        return LibraryEntry(filename, stat.st_ctime, stat.st_size, preset_name, mtime=stat.st_mtime)
+
+    def _rendition_sizes(self) -> List[int]:
+        if not os.path.isdir(self.renditions_directory):
+            return []
+        return sorted(int(size) for size in os.listdir(self.renditions_directory) if size.isdigit())
+
+    def _list_renditions(self) -> Dict[int, Set[str]]:
+        return {size: set(os.listdir(os.path.join(self.renditions_directory, str(size)))) for size in self._rendition_sizes()}
+
+    def get_rendition_path(self, filename: str, size: int) -> str:
+        """
+        Relative to the image directory, which is also how the web server serves it.
+        """
+        return os.path.join(os.path.relpath(self.renditions_directory, self.directory), str(size), filename)
+
+    def get_rendition_paths(self, filename: str) -> List[str]:
+        """
+        Every rendition the image could have, whether or not it's indexed.
+        """
+        return [self.get_rendition_path(filename, size) for size in sorted(self.rendition_sizes)]
+
+    def _insert(self, entry: LibraryEntry):
+        self._remove(entry.filename, keep_slot=True)
+        self._entries[entry.filename] = entry
+        self._total_size += entry.size
+        bisect.insort(self._order, entry.sort_key)
+        heapq.heappush(self._by_mtime, (entry.mtime, entry.filename))
+        self._sidecar_refs[entry.json_path] = self._sidecar_refs.get(entry.json_path, 0) + 1
+        self._orphan_sidecars.pop(entry.json_path, None)
+        self._add_slot(entry.filename)
+
+    def _remove(self, filename: str, keep_slot: bool = False) -> Optional[LibraryEntry]:
+        entry = self._entries.pop(filename, None)
+        if entry:
+            self._total_size -= entry.size
+            i = bisect.bisect_left(self._order, entry.sort_key)
+            if i < len(self._order) and self._order[i] == entry.sort_key:
+                del self._order[i]
+            refs = self._sidecar_refs.get(entry.json_path, 0) - 1
+            if refs > 0:
+                self._sidecar_refs[entry.json_path] = refs
+            else:
+                self._sidecar_refs.pop(entry.json_path, None)
+            if len(self._by_mtime) > 2 * len(self._entries) + 1000:
+                self._by_mtime = [(e.mtime, e.filename) for e in self._entries.values()]
+                heapq.heapify(self._by_mtime)
+            if not keep_slot:
+                self._remove_slot(filename)
+        return entry
+
+    def _add_slot(self, filename: str):
+        if filename not in self._slot_of:
+            self._slot_of[filename] = len(self._slots)
+            self._slots.append(filename)
+
+    def _remove_slot(self, filename: str):
+        i = self._slot_of.pop(filename, None)
+        if i is None:
+            return
+        self._slots[i] = None
+        if len(self._slots) > 1000 and len(self._slot_of) < len(self._slots) // 2:
+            self._slots = [f for f in self._slots if f]
+            self._slot_of = {f: i for i, f in enumerate(self._slots)}
+            self._epoch += 1
+
+    def _unreferenced(self, entries: List[LibraryEntry]) -> List[str]:
+        return sorted({e.json_path for e in entries if e.json_path not in self._sidecar_refs})
+
+    def rescan(self):
+        started = time.time()
+        entries = dict()
+        sidecars = dict()
+        others = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(SIDECAR_EXT):
+                sidecars[filename] = None
+                continue
+            if not filename.endswith(IMG_EXT):
+                others.append(filename)
+                continue
+            existing = self._entries.get(filename)
+            entry = self._stat(filename, existing and existing.preset_name)
+            if entry:
+                entries[filename] = entry.carry_over(existing)
+
+        renditions = self._list_renditions()
+        self.rendition_sizes.update(renditions)
+        for entry in entries.values():
+            sidecars.pop(entry.json_path, None)
+            entry.renditions = tuple(sorted(size for size, filenames in renditions.items() if entry.filename in filenames))
+        orphan_sidecars = self._get_mtimes(sidecars)
+        others += [self.get_rendition_path(filename, size)
+                   for size, filenames in renditions.items() for filename in filenames if filename not in entries]
+        strays = self._get_mtimes(others)
+
+        with self._lock:
+            # Keep whatever got added while the directory was being listed.
+            for filename, entry in self._entries.items():
+                if filename not in entries and entry.ctime >= started:
+                    entries[filename] = entry
+            for filename in self._entries.keys() - entries.keys():
+                self._remove_slot(filename)
+            for filename in sorted(entries, key=lambda f: entries[f].sort_key):
+                self._add_slot(filename)
+            self._entries = entries
+            self._total_size = sum(e.size for e in entries.values())
+            self._order = sorted(e.sort_key for e in entries.values())
+            self._by_mtime = [(e.mtime, e.filename) for e in entries.values()]
+            heapq.heapify(self._by_mtime)
+            self._sidecar_refs = dict()
+            for entry in entries.values():
+                self._sidecar_refs[entry.json_path] = self._sidecar_refs.get(entry.json_path, 0) + 1
+            self._orphan_sidecars = {f: m for f, m in orphan_sidecars.items() if f not in self._sidecar_refs}
+            self._strays = strays
+
+        logger.info(f"Library rescanned. {len(entries)=} {len(self._orphan_sidecars)=} {len(self._strays)=}")
+
+    def _get_mtimes(self, paths: Collection[str]) -> Dict[str, float]:
+        mtimes = dict()
+        for path in paths:
+            full_path = os.path.join(self.directory, path)
+            try:
+                if os.path.isfile(full_path):
+                    mtimes[path] = os.path.getmtime(full_path)
+            except FileNotFoundError:
+                pass
+        return mtimes
+
+    def add(self, filename: str, preset_name: str = None) -> Optional[LibraryEntry]:
+        entry = self._stat(filename, preset_name)
+        if not entry:
+            logger.warning(f"Cannot index a file that doesn't exist. {filename=}")
+            return None
+        entry.renditions = tuple(
+            size for size in sorted(self.rendition_sizes)
+            if os.path.exists(os.path.join(self.renditions_directory, str(size), filename))
+        )
+
+        with self._lock:
+            self._insert(entry.carry_over(self._entries.get(filename)))
+        return entry
+
+    def remove(self, filename: str) -> Optional[LibraryEntry]:
+        with self._lock:
+            return self._remove(filename)
+
+    def remove_many(self, filenames: Collection[str]) -> Tuple[List[LibraryEntry], List[str]]:
+        """
+        Returns the removed entries and the sidecars that no remaining image refers to.
+        """
+        with self._lock:
+            removed = [e for e in map(self._remove, filenames) if e]
+            return removed, self._unreferenced(removed)
+
+    def pop_expired(self, cutoff: float) -> Tuple[List[LibraryEntry], List[str]]:
+        """
+        Removes the images last modified before 'cutoff', oldest first, only ever looking at those.
+        Returns them along with the sidecars left without an image, including orphans found by rescan().
+        """
+        expired = []
+        with self._lock:
+            while self._by_mtime and self._by_mtime[0][0] < cutoff:
+                mtime, filename = heapq.heappop(self._by_mtime)
+                entry = self._entries.get(filename)
+                if entry and entry.mtime == mtime:
+                    self._remove(filename)
+                    expired.append(entry)
+
+            sidecars = self._unreferenced(expired)
+            for filename, mtime in list(self._orphan_sidecars.items()):
+                if mtime < cutoff:
+                    del self._orphan_sidecars[filename]
+                    sidecars.append(filename)
+        return expired, sidecars
+
+    def pop_strays(self, cutoff: float) -> List[str]:
+        """
+        The leftovers found by rescan() that were last modified before 'cutoff', as paths relative to the image directory.
+        """
+        with self._lock:
+            strays = sorted(path for path, mtime in self._strays.items() if mtime < cutoff)
+            for path in strays:
+                del self._strays[path]
+        return strays
+
+    def get(self, filename: str) -> Optional[LibraryEntry]:
+        return self._entries.get(filename)
+
+    def entries(self, exclude: Collection[str] = ()) -> List[LibraryEntry]:
+        with self._lock:
+            return [e for e in self._entries.values() if e.filename not in exclude]
+
+    def count(self, exclude: Collection[str] = ()) -> int:
+        return len(self._entries) - len([f for f in exclude if f in self._entries])
+
+    def size(self, exclude: Collection[str] = ()) -> int:
+        """
+        Total bytes of the indexed images.
+        """
+        excluded = [self._entries.get(f) for f in exclude]
+        return self._total_size - sum(e.size for e in excluded if e)
+
+    def mark_viewed(self, filenames: Collection[str], viewed: float = None):
+        viewed = viewed or time.time()
+        with self._lock:
+            for filename in filenames:
+                entry = self._entries.get(filename)
+                if entry:
+                    entry.last_viewed = viewed
+
+    def restore_usage(self, usage: Dict[str, Tuple[Optional[float], Optional[int]]]):
+        """
+        Brings back the view times and ratings persisted by the metadata store, see MetadataStore.get_usage()
+        """
+        with self._lock:
+            for filename, (last_viewed, rating) in usage.items():
+                entry = self._entries.get(filename)
+                if entry:
+                    entry.last_viewed = max(last_viewed or 0, entry.last_viewed or 0) or None
+                    entry.rating = rating
+
+    def set_rating(self, filename: str, rating: Optional[int]) -> Optional[LibraryEntry]:
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry:
+                entry.rating = rating
+            return entry
+
+    def recent(self, limit: int, exclude: Collection[str] = (),
+               before: Tuple[float, str] = None) -> Tuple[List[str], Optional[Tuple[float, str]]]:
+        """
+        Newest first, starting right after the 'before' sort key if given.
+        Returns the page and the sort key to continue from, None once there's nothing left.
+        """
+        filenames = []
+        with self._lock:
+            i = bisect.bisect_left(self._order, tuple(before)) if before else len(self._order)
+            while i > 0 and len(filenames) < limit:
+                i -= 1
+                filename = self._order[i][1]
+                if filename not in exclude:
+                    filenames.append(filename)
+            last = self._order[i] if i > 0 else None
+        return filenames, last
+
+    def shuffled(self, limit: int, seed: int, exclude: Collection[str] = (),
+                 state: Tuple[int, int, int] = None) -> Tuple[List[str], Optional[Tuple[int, int, int]]]:
+        """
+        A page of the library in an order that's fixed by 'seed', so consecutive pages never repeat.
+        'state' is the (epoch, size, position) returned with the previous page. Images added after
+        the first page don't show up until the next shuffle.
+        """
+        filenames = []
+        with self._lock:
+            if state:
+                epoch, size, position = state
+                assert epoch == self._epoch and 0 <= position <= size <= len(self._slots), \
+                    f"shuffled cursor expired, start over without one {epoch=} {size=} {position=}"
+            else:
+                size, position = len(self._slots), 0
+
+            permutation = FeistelPermutation(size, seed)
+            while position < size and len(filenames) < limit:
+                filename = self._slots[permutation[position]]
+                position += 1
+                if filename and filename not in exclude:
+                    filenames.append(filename)
+            next_state = (self._epoch, size, position) if position < size else None
+        return filenames, next_state
@@ -1,27 +1,30 @@
 # Python builtin deps
 import asyncio
 from datetime import timedelta
-import json
 import logging
-from typing import Callable, List
+import os
+from typing import Callable, Optional
 
 # 3rd party deps
 import jwt
 
 from fastapi import FastAPI, UploadFile, WebSocket, status, Depends, HTTPException, Query, WebSocketDisconnect
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from fastapi.security import OAuth2PasswordBearer
-from fastapi_jwt_auth import AuthJWT
-from fastapi_jwt_auth.exceptions import AuthJWTException
 
 # Local deps
 from conf import backup_config, get_config, save_config
-from app import Corganize
-from auth import JWT_KEY, decode_jwt, get_jwt
-from models import DeleteRequest, ConfigSaveRequest, Token
-from utils import get_shuffled_copy, run_on_interval, run_back_to_back
+from app import Corganize, invalidate_preset_collection
+from auth import decode_jwt, get_jwt
+from hub import hub
+from jobs import JOB_LEASE_SECONDS, job_queue
+from metrics import render as render_metrics
+from models import DeleteRequest, ConfigSaveRequest, DiffusionJobRequest, MetadataRequest, RatingRequest, ReplayRequest, Token, ViewRequest
+from utils import run_on_interval, run_back_to_back
 
 FETCH_LIMIT = 250
+JOB_COUNT_LIMIT = 32
+LIBRARY_RESCAN_SECONDS = int(os.getenv("LIBRARY_RESCAN_SECONDS", "600"))
 
 logger = logging.getLogger("corganize")
 logger.setLevel(logging.INFO)
@@ -34,39 +37,25 @@ uvicorn_logger.addHandler(logging.FileHandler("/var/log/corganize/api/uvicorn.lo
 
 fastapi_app = FastAPI()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-sockets: List[WebSocket] = []
-
-
-@AuthJWT.load_config
-def get_ws_auth_config():
-    from pydantic import BaseModel
-
-    class Settings(BaseModel):
-        authjwt_secret_key: str = JWT_KEY
-
-    return Settings()
 
 
 def get_broadcast_function(topic: str) -> Callable[[dict], None]:
     def broadcast(payload: dict) -> None:
-        async def broadcast_async():
-            for socket in sockets:
-                await socket.send_text(json.dumps(dict(
-                    topic=topic,
-                    payload=payload
-                )))
-        asyncio.run(broadcast_async())
+        hub.publish(topic, payload)
     return broadcast
 
 
 corganize = Corganize()
 corganize._broadcast_cleanup = get_broadcast_function("cleanup")
 corganize._broadcast_diffusion = get_broadcast_function("diffusion")
+corganize.rescan_library()
+corganize.restore_deletions()
 
 run_back_to_back(
     corganize.diffuse,
-    pause_seconds=30,  # Let server cool down for 30 s before the next request
-    initial_delay_seconds=5
+    pause_seconds=corganize.get_next_pause,
+    initial_delay_seconds=5,
+    wake=corganize.wake
 )
 
 run_on_interval(
@@ -75,6 +64,26 @@ run_on_interval(
     initial_delay_seconds=30
 )
 
+# Keeps the leases on the queued jobs of this process, the ones of a dead process expire
+run_on_interval(
+    job_queue.renew,
+    interval_seconds=max(JOB_LEASE_SECONDS // 3, 1),
+    initial_delay_seconds=0
+)
+
+if LIBRARY_RESCAN_SECONDS > 0:
+    # Picks up files that were added or removed outside of this process
+    run_on_interval(
+        corganize.rescan_library,
+        interval_seconds=LIBRARY_RESCAN_SECONDS,
+        initial_delay_seconds=LIBRARY_RESCAN_SECONDS
+    )
+
+
+@fastapi_app.on_event("startup")
+async def start_hub():
+    hub.start(asyncio.get_running_loop())
+
 
 def verify_jwt_token(token: str = Depends(oauth2_scheme)):
     try:
@@ -88,26 +97,28 @@ def verify_jwt_token(token: str = Depends(oauth2_scheme)):
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid JWT token")
 
 
-# @fastapi_app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, token: str = Query(...), Authorize: AuthJWT = Depends()):
+@fastapi_app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket, token: str = Query(...)):
     await websocket.accept()
     logger.info("Socket open")
 
     try:
-        Authorize.jwt_required("websocket", token=token)
-    except AuthJWTException as err:
-        logger.error(err)
-        await websocket.close()
+        payload = decode_jwt(token)
+    except jwt.PyJWTError as err:
+        logger.error(f"Websocket auth failed. {err=}")
+        payload = None
+    if not payload or "sub" not in payload:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
 
-    sockets.append(websocket)
-
+    subscriber = await hub.subscribe(websocket)
     try:
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
-        sockets.remove(websocket)
         logger.info("Socket closed")
+    finally:
+        hub.unsubscribe(subscriber)
 
 
 @fastapi_app.exception_handler(AssertionError)
@@ -127,23 +138,66 @@ def unicorn_exception_handler(*args, **kwargs):
 
 
 @fastapi_app.get("/images/shuffled")
-def get_images(_: dict = Depends(verify_jwt_token)):
-    filenames = get_shuffled_copy(corganize.get_image_filenames())
-    logger.info(f"{len(filenames)=}")
-    return dict(filenames=filenames[:FETCH_LIMIT])
+def get_images(
+    cursor: Optional[str] = None,
+    seed: Optional[int] = None,
+    limit: int = Query(FETCH_LIMIT, gt=0, le=FETCH_LIMIT),
+    _: dict = Depends(verify_jwt_token)
+):
+    filenames, next_cursor = corganize.get_shuffled_image_filenames(limit, cursor=cursor, seed=seed)
+    logger.info(f"{len(corganize.library)=}")
+    return dict(filenames=filenames, images=corganize.get_image_renditions(filenames), next_cursor=next_cursor)
 
 
 @fastapi_app.get("/images/recent")
-def get_recent_images(_: dict = Depends(verify_jwt_token)):
-    filenames = corganize.get_recent_image_filenames()
-    logger.info(f"{len(filenames)=}")
-    return dict(filenames=filenames[:FETCH_LIMIT])
+def get_recent_images(
+    cursor: Optional[str] = None,
+    limit: int = Query(FETCH_LIMIT, gt=0, le=FETCH_LIMIT),
+    _: dict = Depends(verify_jwt_token)
+):
+    filenames, next_cursor = corganize.get_recent_image_filenames(limit, cursor=cursor)
+    logger.info(f"{len(corganize.library)=}")
+    return dict(filenames=filenames, images=corganize.get_image_renditions(filenames), next_cursor=next_cursor)
+
+@fastapi_app.get("/images/search")
+def search_images(
+    preset_name: Optional[str] = None,
+    model: Optional[str] = None,
+    lora: Optional[str] = None,
+    sampler_name: Optional[str] = None,
+    since: Optional[float] = Query(None, description="Epoch seconds, inclusive"),
+    until: Optional[float] = Query(None, description="Epoch seconds, exclusive"),
+    q: Optional[str] = Query(None, description="Prompt substring"),
+    cursor: Optional[str] = None,
+    limit: int = Query(FETCH_LIMIT, gt=0, le=FETCH_LIMIT),
+    _: dict = Depends(verify_jwt_token)
+):
+    images, next_cursor = corganize.search_images(
+        limit,
+        cursor=cursor,
+        preset_name=preset_name,
+        model=model,
+        lora=lora,
+        sampler_name=sampler_name,
+        since=since,
+        until=until,
+        q=q
+    )
+    filenames = [image["filename"] for image in images]
+    renditions = corganize.get_image_renditions(filenames)
+    return dict(
+        filenames=filenames,
+        images=[{**image, **rendition} for image, rendition in zip(images, renditions)],
+        next_cursor=next_cursor
+    )
+
 
 @fastapi_app.get("/images/{filename}/metadata")
 def get_image_metadata(filename: str):
     metadata = corganize.get_metadata_by_filename(filename)
     
     if metadata:
+        corganize.mark_viewed([filename])
         return metadata
     
     return JSONResponse(
@@ -152,6 +206,51 @@ def get_image_metadata(filename: str):
     )
 
 
+@fastapi_app.post("/images/metadata")
+def get_images_metadata(body: MetadataRequest, _: dict = Depends(verify_jwt_token)):
+    assert len(body.filenames) <= FETCH_LIMIT, f"too many filenames {len(body.filenames)=} {FETCH_LIMIT=}"
+    return dict(metadata=corganize.get_metadata_by_filenames(body.filenames))
+
+
+@fastapi_app.post("/images/views")
+def record_image_views(body: ViewRequest, _: dict = Depends(verify_jwt_token)):
+    corganize.mark_viewed(body.filenames)
+    return dict(message="success")
+
+
+@fastapi_app.put("/images/{filename}/rating")
+def rate_image(filename: str, body: RatingRequest, _: dict = Depends(verify_jwt_token)):
+    if corganize.set_rating(filename, body.rating):
+        return dict(message="success")
+
+    return JSONResponse(
+        status_code=404,
+        content=dict(message="Filename not found")
+    )
+
+
+@fastapi_app.post("/images/{filename}/replay")
+def replay_image(filename: str, body: ReplayRequest, _: dict = Depends(verify_jwt_token)):
+    blocker = corganize.get_blocker()
+    if blocker:
+        return JSONResponse(
+            status_code=409,
+            content=dict(message=f"Jobs would not run, {blocker}")
+        )
+
+    job = corganize.replay(filename, body.overrides)
+    if job:
+        return JSONResponse(
+            status_code=202,
+            content=dict(message="submitted", **job)
+        )
+
+    return JSONResponse(
+        status_code=404,
+        content=dict(message="No recorded job for the filename")
+    )
+
+
 @fastapi_app.delete("/images")
 def delete_images(body: DeleteRequest, _: dict = Depends(verify_jwt_token)):
     corganize.delete(body.filenames)
@@ -161,6 +260,51 @@ def delete_images(body: DeleteRequest, _: dict = Depends(verify_jwt_token)):
     )
 
 
+@fastapi_app.get("/diffusion/backends")
+def get_diffusion_backends(_: dict = Depends(verify_jwt_token)):
+    return dict(backends=corganize.get_backends())
+
+
+@fastapi_app.post("/diffusion/jobs")
+def submit_diffusion_jobs(body: DiffusionJobRequest, _: dict = Depends(verify_jwt_token)):
+    assert 0 < body.count <= JOB_COUNT_LIMIT, f"count must be between 1 and {JOB_COUNT_LIMIT} {body.count=}"
+    blocker = corganize.get_blocker()
+    if blocker:
+        return JSONResponse(
+            status_code=409,
+            content=dict(message=f"Jobs would not run, {blocker}")
+        )
+
+    ids = corganize.submit_jobs(body.count, preset_name=body.preset_name, preset=body.preset)
+    return JSONResponse(
+        status_code=202,
+        content=dict(message="submitted", id=ids[0], ids=ids)
+    )
+
+
+@fastapi_app.get("/diffusion/jobs/{id}")
+def get_diffusion_job(id: int, _: dict = Depends(verify_jwt_token)):
+    job = corganize.get_job(id)
+    if job:
+        return job
+
+    return JSONResponse(
+        status_code=404,
+        content=dict(message="Job not found")
+    )
+
+
+@fastapi_app.post("/diffusion/models/refresh")
+def refresh_diffusion_models(_: dict = Depends(verify_jwt_token)):
+    models = corganize.refresh_models()
+    return dict(message="success", models=models)
+
+
+@fastapi_app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @fastapi_app.get("/envvars")
 def get_envvars(_: dict = Depends(verify_jwt_token)):
     return corganize.envvars
@@ -180,6 +324,7 @@ def _get_config(_: dict = Depends(verify_jwt_token)):
 @fastapi_app.put("/config")
 def _save_config(body: dict, _: dict = Depends(verify_jwt_token)):
     save_config(body)
+    invalidate_preset_collection()
     return dict(message="success")
 
 
@@ -0,0 +1,190 @@
+"""
+Minimal in-process metrics rendered in the Prometheus text exposition format.
+"""
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+from typing import Callable, Deque, Dict, List, Tuple
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> LabelValues:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: LabelValues, extra: dict = None) -> str:
+    pairs = list(labels) + list((extra or dict()).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[LabelValues, float] = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_labels(labels), 0)
+
+    def total(self) -> float:
+        with self._lock:
+            return sum(self._values.values())
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(k)} {_format_value(v)}" for k, v in values]
+
+
+class Gauge:
+    """
+    A value computed on demand at render time.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, func: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.func = func
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {_format_value(self.func())}"]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._counts: Dict[LabelValues, List[int]] = dict()
+        self._sums: Dict[LabelValues, float] = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def sums(self) -> Dict[str, float]:
+        """
+        Total observed value per label set, keyed by the first label's value. Handy for summaries.
+        """
+        with self._lock:
+            return {(k[0][1] if k else ""): v for k, v in self._sums.items()}
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            counts_by_key = sorted((k, list(v)) for k, v in self._counts.items())
+            sums = dict(self._sums)
+        lines = []
+        for key, counts in counts_by_key:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(key, dict(le=le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(sums[key])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class RateWindow:
+    """
+    Number of events within the last 'window_seconds'.
+    """
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        self._events: Deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float):
+        while self._events and self._events[0] < now - self.window_seconds:
+            self._events.popleft()
+
+    def add(self, count: int = 1):
+        now = time.time()
+        with self._lock:
+            self._events.extend([now] * count)
+            self._expire(now)
+
+    def count(self) -> int:
+        with self._lock:
+            self._expire(time.time())
+            return len(self._events)
+
+
+_images_last_hour = RateWindow(3600)
+
+stage_seconds = Histogram("corganize_stage_seconds", "Wall time spent per diffusion pipeline stage")
+images_generated = Counter("corganize_images_generated_total", "Images written to the library")
+checkpoint_swaps = Counter("corganize_checkpoint_swaps_total", "Checkpoint changes requested from the backend")
+diffusion_failures = Counter("corganize_diffusion_failures_total", "Failed diffusion requests by HTTP status")
+bytes_written = Counter("corganize_bytes_written_total", "Image bytes written to the library")
+cleanup_deletions = Counter("corganize_cleanup_deletions_total", "Files deleted by cleanup")
+duplicates_dropped = Counter("corganize_duplicates_dropped_total", "Generated images dropped as near-duplicates")
+evictions = Counter("corganize_evictions_total", "Images evicted to make room, by policy")
+ws_dropped_messages = Counter("corganize_ws_dropped_messages_total", "Websocket messages dropped for slow clients")
+stuck_jobs = Counter("corganize_stuck_jobs_total", "Generations interrupted for not making progress")
+images_per_hour = Gauge("corganize_images_per_hour", "Images written within the last hour", _images_last_hour.count)
+
+REGISTRY = [
+    stage_seconds,
+    images_generated,
+    checkpoint_swaps,
+    diffusion_failures,
+    bytes_written,
+    cleanup_deletions,
+    evictions,
+    duplicates_dropped,
+    ws_dropped_messages,
+    stuck_jobs,
+    images_per_hour,
+]
+
+
+def record_image_saved(size: int):
+    images_generated.inc()
+    bytes_written.inc(size)
+    _images_last_hour.add()
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
 
 # Define the Pydantic model
@@ -8,6 +8,28 @@ class DeleteRequest(BaseModel):
     filenames: List[str]
 
 
+class ViewRequest(BaseModel):
+    filenames: List[str]
+
+
+class MetadataRequest(BaseModel):
+    filenames: List[str]
+
+
+class RatingRequest(BaseModel):
+    rating: Optional[int]
+
+
+class ReplayRequest(BaseModel):
+    overrides: dict = dict()
+
+
+class DiffusionJobRequest(BaseModel):
+    preset_name: Optional[str] = None
+    preset: Optional[dict] = None  # Inline, instead of one from the config
+    count: int = 1
+
+
 class ConfigSaveRequest(BaseModel):
     diffusion_enabled: bool
     notes: str
@@ -15,6 +37,9 @@ class ConfigSaveRequest(BaseModel):
     max_images_allowed: int
     diffusion_url: str
     diffusion_sample_size: int
+    eviction_policy: str = "none"
+    max_library_mb: int = 0
+    eviction_low_water: float = 0.9
 
 
 class Token(BaseModel):
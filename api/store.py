@@ -0,0 +1,346 @@
+from contextlib import contextmanager
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from typing import Collection, Dict, Iterable, List, Optional, Tuple
+
+from const import DB_PATH
+from utils import decode_cursor, encode_cursor
+
+logger = logging.getLogger("corganize")
+
+TABLES = """
+CREATE TABLE IF NOT EXISTS metadata (
+    basename TEXT PRIMARY KEY,
+    preset_name TEXT,
+    created REAL NOT NULL,
+    body TEXT NOT NULL,
+    model TEXT,
+    sampler_name TEXT,
+    prompt TEXT,
+    job TEXT
+);
+CREATE TABLE IF NOT EXISTS metadata_loras (
+    alias TEXT NOT NULL,
+    basename TEXT NOT NULL,
+    PRIMARY KEY (alias, basename)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS images (
+    filename TEXT PRIMARY KEY,
+    basename TEXT NOT NULL,
+    created REAL NOT NULL,
+    dhash INTEGER
+);
+"""
+INDEXES = """
+CREATE INDEX IF NOT EXISTS metadata_preset_name ON metadata (preset_name);
+CREATE INDEX IF NOT EXISTS metadata_model ON metadata (model);
+CREATE INDEX IF NOT EXISTS metadata_sampler_name ON metadata (sampler_name);
+CREATE INDEX IF NOT EXISTS metadata_loras_basename ON metadata_loras (basename);
+CREATE INDEX IF NOT EXISTS images_created ON images (created, filename);
+CREATE INDEX IF NOT EXISTS images_basename ON images (basename);
+"""
+# Columns added after the first version of each table
+ADDED_COLUMNS = dict(
+    metadata=dict(model="TEXT", sampler_name="TEXT", prompt="TEXT", job="TEXT"),
+    images=dict(dhash="INTEGER", rating="INTEGER", last_viewed="REAL")
+)
+SCHEMA_VERSION = 7
+REINDEX_BELOW_VERSION = 7  # Versions whose metadata rows lack the derived columns, or only index the final prompt
+FTS_ROWID_VERSION = 6  # The first version whose full-text rows share the rowid of their metadata row
+MAX_VARIABLES = 500  # Stays well under SQLite's limit on bound parameters per statement
+MIN_FTS_QUERY_LEN = 3  # Trigrams can't match anything shorter
+LORA_PATTERN = re.compile(r"<lora:([^:>]+)")
+
+
+def get_loras(prompt: str) -> List[str]:
+    """
+    '<lora:foo:0.6><lora:bar:1>' -> ['foo', 'bar']
+    """
+    return sorted(set(LORA_PATTERN.findall(prompt or "")))
+
+
+def get_searchable_prompt(body: dict, job: dict = None) -> str:
+    """
+    The final stage's prompt, preceded by the first stage's when the batch went through img2img stages.
+    The first one describes the image, the later ones tend to be short refinement prompts.
+    """
+    prompts = [((job or dict()).get("req_body") or dict()).get("prompt"), body.get("prompt")]
+    return "\n".join(dict.fromkeys(p for p in prompts if p))
+
+
+def _to_signed(value: Optional[int]) -> Optional[int]:
+    # SQLite integers are signed 64 bit
+    return value - (1 << 64) if value is not None and value >= 1 << 63 else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def _chunks(values: list) -> Iterable[list]:
+    for i in range(0, len(values), MAX_VARIABLES):
+        yield values[i:i + MAX_VARIABLES]
+
+
+class MetadataStore:
+    """
+    Generation metadata (the request body of each batch) keyed by basename, in an embedded SQLite database.
+    Written at generation time so that lookups never have to find and parse the .json sidecars.
+    Also indexes the images of each batch along with the preset, model, sampler, loras
+    and prompt (full-text) of their batch for searching.
+    """
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._fts = False  # Whether prompts get a trigram full-text index
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                self._migrate(conn)
+                self._conn = conn
+            return self._conn
+
+    @property
+    def fts(self) -> bool:
+        return self.conn is not None and self._fts
+
+    def _migrate(self, conn: sqlite3.Connection):
+        conn.executescript(TABLES)
+        for table, added_columns in ADDED_COLUMNS.items():
+            columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for column, column_type in added_columns.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        conn.executescript(INDEXES)
+
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS metadata_fts USING fts5(basename UNINDEXED, prompt, tokenize='trigram')")
+            self._fts = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Prompt search falls back to LIKE, FTS5 trigrams are not available. {sqlite3.sqlite_version=} {e=}")
+
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < REINDEX_BELOW_VERSION:
+            rows = conn.execute("SELECT basename, body, job FROM metadata").fetchall()
+            logger.info(f"Reindexing metadata. {version=} {SCHEMA_VERSION=} {len(rows)=}")
+            conn.execute("BEGIN")
+            for basename, body, job in rows:
+                self._index(conn, basename, json.loads(body), job and json.loads(job))
+            conn.execute("COMMIT")
+        if version < FTS_ROWID_VERSION and self._fts:
+            logger.info(f"Rebuilding the prompt index. {version=} {SCHEMA_VERSION=}")
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM metadata_fts")
+            conn.execute("INSERT INTO metadata_fts (rowid, basename, prompt) SELECT rowid, basename, prompt FROM metadata")
+            conn.execute("COMMIT")
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            conn = self.conn
+            conn.execute("BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _index(self, conn: sqlite3.Connection, basename: str, body: dict, job: dict = None):
+        prompt = get_searchable_prompt(body, job)
+        conn.execute(
+            "UPDATE metadata SET model = ?, sampler_name = ?, prompt = ? WHERE basename = ?",
+            (body.get("model"), body.get("sampler_name"), prompt, basename)
+        )
+        conn.execute("DELETE FROM metadata_loras WHERE basename = ?", (basename,))
+        conn.executemany("INSERT INTO metadata_loras (alias, basename) VALUES (?, ?)",
+                         [(alias, basename) for alias in get_loras(prompt)])
+        if self._fts:
+            # Keyed by rowid, the basename column isn't indexed
+            rowid = conn.execute("SELECT rowid FROM metadata WHERE basename = ?", (basename,)).fetchone()[0]
+            conn.execute("DELETE FROM metadata_fts WHERE rowid = ?", (rowid,))
+            conn.execute("INSERT INTO metadata_fts (rowid, basename, prompt) VALUES (?, ?, ?)", (rowid, basename, prompt))
+
+    def put(self, basename: str, body: dict, preset_name: str = None, job: dict = None):
+        """
+        'job' is what it takes to replay the batch, see DiffuseApiPayload.job
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO metadata (basename, preset_name, created, body, job) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (basename) DO UPDATE SET preset_name = excluded.preset_name, created = excluded.created,"
+                " body = excluded.body, job = excluded.job",
+                (basename, preset_name, time.time(), json.dumps(body), job and json.dumps(job))
+            )
+            self._index(conn, basename, body, job)
+
+    def get(self, basename: str) -> Optional[dict]:
+        with self._lock:
+            row = self.conn.execute("SELECT body FROM metadata WHERE basename = ?", (basename,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_job(self, basename: str) -> Optional[dict]:
+        with self._lock:
+            row = self.conn.execute("SELECT job FROM metadata WHERE basename = ?", (basename,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def get_many(self, basenames: Collection[str]) -> Dict[str, dict]:
+        found = dict()
+        for chunk in _chunks(list(set(basenames))):
+            placeholders = ",".join("?" * len(chunk))
+            with self._lock:
+                rows = self.conn.execute(
+                    f"SELECT basename, body FROM metadata WHERE basename IN ({placeholders})", chunk
+                ).fetchall()
+            found.update((basename, json.loads(body)) for basename, body in rows)
+        return found
+
+    def delete_many(self, basenames: Collection[str]):
+        basenames = list(basenames)
+        fts = self.fts
+        with self._transaction() as conn:
+            for chunk in _chunks(basenames):
+                placeholders = ",".join("?" * len(chunk))
+                if fts:
+                    conn.execute(
+                        f"DELETE FROM metadata_fts WHERE rowid IN (SELECT rowid FROM metadata WHERE basename IN ({placeholders}))",
+                        chunk
+                    )
+                for table in ("metadata", "metadata_loras", "images"):
+                    conn.execute(f"DELETE FROM {table} WHERE basename IN ({placeholders})", chunk)
+
+    def add_image(self, filename: str, basename: str, created: float, dhash: int = None):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO images (filename, basename, created, dhash) VALUES (?, ?, ?, ?)",
+                (filename, basename, created, _to_signed(dhash))
+            )
+
+    def get_hashes(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self.conn.execute("SELECT filename, dhash FROM images WHERE dhash IS NOT NULL").fetchall()
+        return {filename: _to_unsigned(dhash) for filename, dhash in rows}
+
+    def set_rating(self, filename: str, rating: Optional[int]):
+        with self._lock:
+            self.conn.execute("UPDATE images SET rating = ? WHERE filename = ?", (rating, filename))
+
+    def mark_viewed(self, filenames: Collection[str], viewed: float):
+        with self._transaction() as conn:
+            conn.executemany("UPDATE images SET last_viewed = ? WHERE filename = ?", [(viewed, f) for f in filenames])
+
+    def get_usage(self) -> Dict[str, Tuple[Optional[float], Optional[int]]]:
+        """
+        filename -> (last_viewed, rating) of the images that were viewed or rated, for the eviction policies.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT filename, last_viewed, rating FROM images WHERE last_viewed IS NOT NULL OR rating IS NOT NULL"
+            ).fetchall()
+        return {filename: (last_viewed, rating) for filename, last_viewed, rating in rows}
+
+    def remove_images(self, filenames: Collection[str]):
+        with self._transaction() as conn:
+            for chunk in _chunks(list(filenames)):
+                conn.execute(f"DELETE FROM images WHERE filename IN ({','.join('?' * len(chunk))})", chunk)
+
+    def sync_images(self, images: List[Tuple[str, str, float]]) -> List[str]:
+        """
+        Replaces the searchable images with (filename, basename, created) from the library,
+        keeping the hashes of the ones already known.
+        Returns the basenames that have images but no metadata yet.
+        """
+        with self._transaction() as conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS live_images (filename TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM live_images")
+            conn.executemany("INSERT OR IGNORE INTO live_images (filename) VALUES (?)", [(image[0],) for image in images])
+            conn.execute("DELETE FROM images WHERE filename NOT IN (SELECT filename FROM live_images)")
+            conn.executemany(
+                "INSERT INTO images (filename, basename, created) VALUES (?, ?, ?)"
+                " ON CONFLICT (filename) DO UPDATE SET basename = excluded.basename, created = excluded.created",
+                images
+            )
+            rows = conn.execute(
+                "SELECT DISTINCT i.basename FROM images i LEFT JOIN metadata m ON m.basename = i.basename"
+                " WHERE m.basename IS NULL"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def search(self,
+               preset_name: str = None,
+               model: str = None,
+               lora: str = None,
+               sampler_name: str = None,
+               since: float = None,
+               until: float = None,
+               q: str = None,
+               cursor: str = None,
+               limit: int = 50) -> Tuple[List[dict], Optional[str]]:
+        """
+        Images matching every given filter, newest first. Pass the returned cursor back
+        to get the next page; it is None on the last page.
+        """
+        assert limit > 0, f"limit must be positive {limit=}"
+        clauses = []
+        params = []
+        for column, value in (("m.preset_name", preset_name), ("m.model", model), ("m.sampler_name", sampler_name)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if lora is not None:
+            clauses.append("EXISTS (SELECT 1 FROM metadata_loras l WHERE l.alias = ? AND l.basename = m.basename)")
+            params.append(lora)
+        if since is not None:
+            clauses.append("i.created >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("i.created < ?")
+            params.append(until)
+        if q:
+            if self.fts and len(q) >= MIN_FTS_QUERY_LEN:
+                clauses.append("m.rowid IN (SELECT rowid FROM metadata_fts WHERE metadata_fts MATCH ?)")
+                params.append('"' + q.replace('"', '""') + '"')
+            else:
+                clauses.append("m.prompt LIKE ? ESCAPE '\\'")
+                params.append("%" + re.sub(r"([%_\\])", r"\\\1", q) + "%")
+        if cursor:
+            values = decode_cursor(cursor)
+            assert len(values) == 2, f"invalid cursor {cursor=}"
+            created, filename = values
+            clauses.append("(i.created < ? OR (i.created = ? AND i.filename < ?))")
+            params.extend((created, created, filename))
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = (
+            "SELECT i.filename, i.basename, i.created, m.preset_name, m.model, m.sampler_name"
+            " FROM images i JOIN metadata m ON m.basename = i.basename"
+            f" {where} ORDER BY i.created DESC, i.filename DESC LIMIT ?"
+        )
+        with self._lock:
+            rows = self.conn.execute(sql, params + [limit + 1]).fetchall()
+
+        images = [
+            dict(filename=filename, basename=basename, created=created, preset_name=preset_name, model=model,
+                 sampler_name=sampler_name)
+            for filename, basename, created, preset_name, model, sampler_name in rows[:limit]
+        ]
+        next_cursor = None
+        if len(rows) > limit:
+            last = images[-1]
+            next_cursor = encode_cursor([last["created"], last["filename"]])
+        return images, next_cursor
+
+
+metadata_store = MetadataStore()
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# The api modules import each other as top-level modules, the way uvicorn runs them from this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def img_dir(tmp_path, monkeypatch) -> str:
+    """
+    Generations write their images, sidecars and metadata under tmp_path, with a fresh dedup index.
+    """
+    from dedup import DedupIndex
+    from diffuse import api, writer
+    from store import MetadataStore
+
+    monkeypatch.setattr(api, "IMG_DIR", str(tmp_path))
+    monkeypatch.setattr(api, "metadata_store", MetadataStore(str(tmp_path / "test.db")))
+    monkeypatch.setattr(writer, "dedup_index", DedupIndex(max_distance=4))
+    monkeypatch.setattr(writer, "RENDITION_SIZES", [])
+    return str(tmp_path)
@@ -0,0 +1,53 @@
+import base64
+from contextlib import contextmanager
+import io
+import json
+from typing import List
+
+from PIL import Image
+
+
+def get_image_bytes(shift: int = 0) -> bytes:
+    pillow_image = Image.new("RGB", (64, 64))
+    pillow_image.putdata([((x * 4 + shift) % 256, y * 4, (x * y + shift) % 256) for y in range(64) for x in range(64)])
+    buffer = io.BytesIO()
+    pillow_image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeResponse:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def iter_content(self, chunk_size: int):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+class FakeClient:
+    """
+    A backend that renders the same images for the same request, like a seeded txt2img,
+    and one image per init image for img2img.
+    """
+
+    def __init__(self, txt2img_count: int = 1):
+        self.txt2img_count = txt2img_count
+        self.posts: List[tuple] = []  # (path, request body)
+
+    def get_checkpoint_title(self, model: str) -> str:
+        return model
+
+    def get_checkpoint(self) -> str:
+        return "sdxl"
+
+    @contextmanager
+    def post(self, path: str, json: dict, stream: bool):
+        self.posts.append((path, json))
+        count = len(json["init_images"]) if "init_images" in json else self.txt2img_count
+        images = [base64.b64encode(get_image_bytes(shift=i)).decode() for i in range(count)]
+        yield FakeResponse(encode_json(dict(images=images)))
+
+
+def encode_json(value) -> bytes:
+    # post() takes the request body as 'json', like requests, which shadows the module in there
+    return json.dumps(value).encode()
@@ -0,0 +1,90 @@
+import random
+
+from PIL import Image
+import pytest
+
+from dedup import DedupIndex, MultiIndexHash, dhash, hamming
+
+
+def flip(value: int, bits: int) -> int:
+    # Flips the lowest bit of each of the first 'bits' bytes, so the flips spread over every chunk
+    for i in range(bits):
+        value ^= 1 << (i * 8)
+    return value
+
+
+def gradient(width: int = 64, height: int = 64, shift: int = 0) -> Image.Image:
+    pillow_image = Image.new("L", (width, height))
+    pillow_image.putdata([(x * 4 + shift + (y % 7) * 9) % 256 for y in range(height) for x in range(width)])
+    return pillow_image
+
+
+def test_dhash_survives_resizing():
+    assert hamming(dhash(gradient()), dhash(gradient().resize((256, 256)))) <= 2
+
+
+def test_dhash_tells_different_images_apart():
+    assert hamming(dhash(gradient()), dhash(gradient().transpose(Image.FLIP_LEFT_RIGHT))) > 10
+
+
+@pytest.mark.parametrize("distance, duplicate", [(0, True), (4, True), (5, False)])
+def test_threshold_is_inclusive(distance, duplicate):
+    index = DedupIndex(max_distance=4)
+    value = random.Random(1).getrandbits(64)
+    assert index.check_and_add("a.crgimg", value) is None
+
+    assert (index.check_and_add("b.crgimg", flip(value, distance)) == "a.crgimg") is duplicate
+    assert ("b.crgimg" in index._hashes) is not duplicate
+
+
+def test_closest_duplicate_wins():
+    index = DedupIndex(max_distance=4)
+    value = random.Random(2).getrandbits(64)
+    index.add("far.crgimg", flip(value, 3))
+    index.add("near.crgimg", flip(value, 1))  # add() skips the check, these two are duplicates of each other
+
+    assert index.check_and_add("new.crgimg", value) == "near.crgimg"
+
+
+def test_disabled_index_keeps_everything():
+    index = DedupIndex(max_distance=-1)
+    assert index.check_and_add("a.crgimg", 42) is None
+    assert index.check_and_add("b.crgimg", 42) is None
+    assert len(index) == 2
+
+
+def test_removed_images_no_longer_match():
+    index = DedupIndex(max_distance=4)
+    index.check_and_add("a.crgimg", 42)
+    index.remove("a.crgimg")
+    assert index.check_and_add("b.crgimg", 42) is None
+
+
+def test_rebuild_keeps_the_hashes_not_stored_yet():
+    index = DedupIndex(max_distance=4)
+    index.check_and_add("stored.crgimg", (1 << 32) - 1)
+    index.mark_stored("stored.crgimg")
+    index.check_and_add("writing.crgimg", 0)
+
+    index.rebuild({"on-disk.crgimg": (1 << 64) - 1})  # The store doesn't have 'stored' anymore, e.g. deleted
+
+    assert index.get("stored.crgimg") is None
+    assert index.get("writing.crgimg") == 0
+    assert index.check_and_add("copy.crgimg", 1) == "writing.crgimg"
+    assert index.check_and_add("copy2.crgimg", (1 << 64) - 2) == "on-disk.crgimg"
+
+
+def test_multi_index_finds_every_hash_within_distance():
+    rng = random.Random(3)
+    max_distance = 6
+    index = MultiIndexHash(max_distance)
+    values = {f"{i}": rng.getrandbits(64) for i in range(300)}
+    for key, value in values.items():
+        index.add(key, value)
+
+    for _ in range(200):
+        query = rng.getrandbits(64)
+        if rng.random() < 0.5:
+            query = rng.choice(list(values.values())) ^ sum(1 << rng.randrange(64) for _ in range(max_distance))
+        near = {key for key, value in values.items() if hamming(value, query) <= max_distance}
+        assert near <= index.candidates(query)
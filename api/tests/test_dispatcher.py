@@ -0,0 +1,123 @@
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from diffuse import dispatcher
+from diffuse.dispatcher import Backend, Dispatcher, _PendingJob, parse_backends
+
+LOADED = {"http://gpu1": "sdxl", "http://gpu2": "pony"}
+
+
+@pytest.fixture(autouse=True)
+def loaded_models(monkeypatch):
+    monkeypatch.setattr(dispatcher, "get_client", lambda url: SimpleNamespace(current_model=LOADED.get(url)))
+
+
+def test_parse_backends():
+    assert parse_backends("http://gpu1/*2, http://gpu2,") == [("http://gpu1", 2), ("http://gpu2", 1)]
+
+
+def pick(backend: Backend, backends: list, pending: list, others_available: bool = False):
+    p = Dispatcher()._pick(backend, backends, pending, others_available)
+    return p and p.job
+
+
+def test_backend_prefers_its_loaded_model():
+    gpu1, gpu2 = Backend("http://gpu1"), Backend("http://gpu2")
+    pending = [_PendingJob("a", "pony"), _PendingJob("b", "sdxl")]
+    assert pick(gpu1, [gpu1, gpu2], pending) == "b"
+    assert pick(gpu2, [gpu1, gpu2], pending) == "a"
+
+
+def test_backend_leaves_models_loaded_elsewhere():
+    gpu1, gpu2 = Backend("http://gpu1"), Backend("http://gpu2")
+    pending = [_PendingJob("a", "pony"), _PendingJob("b", "flux")]
+    assert pick(gpu1, [gpu1, gpu2], pending) == "b"
+
+
+def test_priority_goes_before_affinity():
+    gpu1 = Backend("http://gpu1")
+    pending = [_PendingJob("a", "sdxl", priority=1), _PendingJob("b", "pony", priority=0)]
+    assert pick(gpu1, [gpu1], pending) == "b"
+
+
+def test_busy_backend_takes_only_its_active_model():
+    gpu1 = Backend("http://gpu1", concurrency=2)
+    gpu1.active, gpu1.active_model = 1, "pony"
+    assert pick(gpu1, [gpu1], [_PendingJob("a", "sdxl")]) is None
+    assert pick(gpu1, [gpu1], [_PendingJob("a", "sdxl"), _PendingJob("b", "pony")]) == "b"
+
+
+def test_retry_is_left_to_other_backends():
+    gpu1 = Backend("http://gpu1")
+    p = _PendingJob("a", "sdxl")
+    p.failed_on.add(gpu1.url)
+    assert pick(gpu1, [gpu1], [p], others_available=True) is None
+    assert pick(gpu1, [gpu1], [p], others_available=False) == "a"
+
+
+def test_backend_cools_down_after_consecutive_failures(monkeypatch):
+    monkeypatch.setattr(dispatcher, "BACKEND_MAX_FAILURES", 3)
+    backend = Backend("http://gpu1")
+    backend.record_failure()
+    backend.record_failure()
+    backend.record_success(1)
+    backend.record_failure()
+    backend.record_failure()
+    assert backend.healthy
+
+    backend.record_failure()
+    assert not backend.healthy and backend.failures == 0
+
+
+def test_slow_job_counts_as_a_failure(monkeypatch):
+    monkeypatch.setattr(dispatcher, "BACKEND_MAX_FAILURES", 1)
+    backend = Backend("http://gpu1")
+    backend.record_success(dispatcher.BACKEND_SLOW_SECONDS + 1)
+    assert not backend.healthy
+
+
+def run(urls: str, jobs: list, func, **kwargs):
+    d = Dispatcher()
+    d.configure(urls)
+    return d, d.run(jobs, lambda job: "sdxl", func, **kwargs)
+
+
+def test_failed_job_is_retried_on_another_backend():
+    ran = []
+
+    def func(backend, job):
+        ran.append(backend.url)
+        if backend.url == ran[0] and len(ran) == 1:
+            raise requests.ConnectionError("refused")
+
+    d, failed = run("http://gpu1,http://gpu2", ["a"], func)
+
+    assert failed == []
+    assert len(ran) == 2 and ran[0] != ran[1]
+    assert [b.failures for b in d.backends if b.url == ran[0]] == [1]
+
+
+def test_job_errors_dont_count_against_the_backend():
+    def func(backend, job):
+        raise ValueError("broken preset")
+
+    d, failed = run("http://gpu1", ["a"], func)
+
+    assert [(job, type(e)) for job, e in failed] == [("a", ValueError)]
+    assert d.backends[0].failures == 0
+
+
+def test_fed_jobs_go_ahead_by_priority():
+    ran = []
+    fed = [["urgent"]]
+
+    def feed():
+        return fed.pop() if fed else []
+
+    _, failed = run("http://gpu1", ["a", "b"], lambda backend, job: ran.append(job),
+                    get_priority=lambda job: 0 if job == "urgent" else 1, feed=feed)
+
+    assert failed == []
+    assert ran == ["urgent", "a", "b"]
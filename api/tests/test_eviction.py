@@ -0,0 +1,62 @@
+import pytest
+
+from eviction import NO_EVICTION, is_over_capacity, plan_eviction
+from library import LibraryEntry
+
+
+def make_entries(count: int, size: int = 100) -> list:
+    return [LibraryEntry(f"p-{i}-00000001-0.crgimg", ctime=float(i), size=size) for i in range(count)]
+
+
+def test_under_capacity_evicts_nothing():
+    assert plan_eviction(make_entries(9), "oldest", max_count=10) == ([], 0)
+
+
+def test_count_drops_to_the_low_water_mark():
+    victims, freed = plan_eviction(make_entries(10), "oldest", max_count=10, low_water=0.8)
+    assert [e.ctime for e in victims] == [0.0, 1.0]
+    assert freed == 200
+
+
+def test_low_water_rounds_the_target_down():
+    victims, _ = plan_eviction(make_entries(7), "oldest", max_count=7, low_water=0.9)  # 6.3 -> 6
+    assert len(victims) == 1
+
+
+def test_byte_budget_alone_triggers_eviction():
+    entries = make_entries(4, size=300)
+    assert is_over_capacity(4, 1200, max_count=100, max_bytes=1000)
+
+    victims, freed = plan_eviction(entries, "oldest", max_count=100, max_bytes=1000, low_water=0.5)
+    assert (len(victims), freed) == (3, 900)  # Down to 300 bytes, under 500
+
+
+def test_both_budgets_have_to_be_met():
+    entries = make_entries(10, size=100)
+    victims, _ = plan_eviction(entries, "oldest", max_count=10, max_bytes=2000, low_water=0.5)
+    assert len(victims) == 5  # The bytes are already within their low water mark, the count decides
+
+
+def test_zero_bytes_means_unlimited():
+    assert not is_over_capacity(5, 10 ** 12, max_count=10, max_bytes=0)
+
+
+def test_policies_order_the_victims():
+    entries = make_entries(4)
+    entries[0].last_viewed = 100.0
+    entries[2].rating = 5
+    entries[3].rating = 1
+
+    lru, _ = plan_eviction(entries, "lru", max_count=4, low_water=0.5)
+    rating, _ = plan_eviction(entries, "rating", max_count=4, low_water=0.5)
+    assert [e.ctime for e in lru] == [1.0, 2.0]
+    assert [e.ctime for e in rating] == [0.0, 1.0]
+
+
+def test_no_eviction_keeps_everything():
+    assert plan_eviction(make_entries(20), NO_EVICTION, max_count=10) == ([], 0)
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(AssertionError):
+        plan_eviction(make_entries(1), "random", max_count=1)
@@ -0,0 +1,135 @@
+import pytest
+
+import jobs
+from jobs import DELETION, DIFFUSION, DONE, FAILED, LANE_BACKGROUND, LANE_MANUAL, LEASED, PENDING, JobQueue
+
+LEASE_SECONDS = 10
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(jobs.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def db_path(tmp_path) -> str:
+    return str(tmp_path / "jobs.db")
+
+
+def make_queue(db_path: str, max_claims: int = 3) -> JobQueue:
+    return JobQueue(db_path, lease_seconds=LEASE_SECONDS, max_claims=max_claims)
+
+
+def test_claims_manual_lane_first(clock, db_path):
+    queue = make_queue(db_path)
+    background = queue.enqueue(DIFFUSION, [dict(n=1)], LANE_BACKGROUND)
+    manual = queue.enqueue(DIFFUSION, [dict(n=2)], LANE_MANUAL)
+    queue.enqueue(DELETION, [dict(filenames=["a.crgimg"])])
+
+    assert [job.id for job in queue.claim(DIFFUSION)] == manual + background
+    assert queue.claim(DIFFUSION) == []
+
+
+def test_expired_lease_is_claimed_again(clock, db_path):
+    crashed, restarted = make_queue(db_path), make_queue(db_path)
+    [id] = crashed.enqueue(DIFFUSION, [dict(n=1)], claim=True)
+
+    clock.advance(LEASE_SECONDS - 1)
+    assert restarted.claim(DIFFUSION) == []
+
+    clock.advance(2)
+    [job] = restarted.claim(DIFFUSION)
+    assert (job.id, job.attempts, job.payload) == (id, 2, dict(n=1))
+
+
+def test_renew_keeps_running_jobs_leased(clock, db_path):
+    queue, other = make_queue(db_path), make_queue(db_path)
+    [running, finished] = queue.enqueue(DIFFUSION, [dict(n=1), dict(n=2)], claim=True)
+    queue.complete([finished])
+    assert queue.running == {running}
+
+    clock.advance(LEASE_SECONDS - 1)
+    queue.renew()
+    clock.advance(LEASE_SECONDS - 1)
+    assert other.claim(DIFFUSION) == []
+    assert queue.get(running)["state"] == LEASED
+    assert queue.get(finished)["state"] == DONE
+
+
+def test_renew_skips_jobs_handed_back(clock, db_path):
+    queue, other = make_queue(db_path), make_queue(db_path)
+    [id] = queue.enqueue(DIFFUSION, [dict(n=1)], claim=True)
+    assert queue.fail(id, "round aborted")
+    assert queue.running == set()
+
+    queue.renew()
+    assert queue.get(id)["state"] == PENDING
+    assert [job.id for job in other.claim(DIFFUSION)] == [id]
+
+
+def test_gives_up_after_max_claims(clock, db_path):
+    queue = make_queue(db_path, max_claims=2)
+    [id] = queue.enqueue(DIFFUSION, [dict(n=1)])
+
+    for _ in range(2):
+        assert [job.id for job in queue.claim(DIFFUSION)] == [id]
+        clock.advance(LEASE_SECONDS + 1)
+
+    assert queue.claim(DIFFUSION) == []
+    job = queue.get(id)
+    assert (job["state"], job["error"], job["attempts"]) == (FAILED, "lease expired", 2)
+
+
+def test_fail_retries_until_max_claims(clock, db_path):
+    queue = make_queue(db_path, max_claims=2)
+    [id] = queue.enqueue(DIFFUSION, [dict(n=1)])
+
+    queue.claim(DIFFUSION)
+    assert queue.fail(id, "boom")
+    queue.claim(DIFFUSION)
+    assert not queue.fail(id, "boom")
+    assert queue.claim(DIFFUSION) == []
+    assert queue.get(id)["state"] == FAILED
+
+
+def test_restart_replays_unfinished_jobs(clock, db_path):
+    crashed = make_queue(db_path)
+    [done, leased, pending] = crashed.enqueue(DIFFUSION, [dict(n=1), dict(n=2), dict(n=3)])
+    crashed.claim(DIFFUSION, limit=2)
+    crashed.complete([done])
+
+    restarted = make_queue(db_path)
+    assert [job.id for job in restarted.unfinished(DIFFUSION)] == [leased, pending]
+    assert restarted.count(DIFFUSION) == 2
+    assert [job.id for job in restarted.claim(DIFFUSION)] == [pending]
+
+    clock.advance(LEASE_SECONDS - 1)
+    restarted.renew()  # Only the job this process claimed, the crashed process's lease runs out
+    clock.advance(2)
+    assert [job.id for job in restarted.claim(DIFFUSION)] == [leased]
+    restarted.complete([leased, pending])
+    assert restarted.unfinished(DIFFUSION) == []
+
+
+def test_prune_keeps_unfinished_jobs(clock, db_path):
+    queue = make_queue(db_path)
+    [done, pending] = queue.enqueue(DELETION, [dict(filenames=["a.crgimg"]), dict(filenames=["b.crgimg"])])
+    queue.complete([done])
+
+    clock.advance(1)
+    assert queue.prune(clock.now) == 1
+    assert queue.get(done) is None
+    assert queue.get(pending)["state"] == PENDING
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from library import FeistelPermutation, ImageLibrary
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 65, 1000])
+def test_feistel_is_a_permutation(size):
+    permutation = FeistelPermutation(size, seed=7)
+    assert sorted(permutation[i] for i in range(size)) == list(range(size))
+
+
+def test_feistel_depends_on_the_seed():
+    orders = {tuple(FeistelPermutation(100, seed)[i] for i in range(100)) for seed in range(5)}
+    assert len(orders) == 5
+
+
+@pytest.fixture
+def library(tmp_path) -> ImageLibrary:
+    for i in range(25):
+        path = tmp_path / f"p-{i}-00000001-0.crgimg"
+        path.write_bytes(b"x")
+        os.utime(path, (1000 + i, 1000 + i))
+    library = ImageLibrary(str(tmp_path), str(tmp_path / "renditions"))
+    library.rescan()
+    return library
+
+
+def shuffled_pages(library: ImageLibrary, limit: int, seed: int, exclude=()) -> list:
+    pages = []
+    state = None
+    while True:
+        filenames, state = library.shuffled(limit, seed, exclude=exclude, state=state)
+        pages.append(filenames)
+        if state is None:
+            return pages
+
+
+def test_shuffled_pages_cover_the_library_once(library):
+    pages = shuffled_pages(library, limit=4, seed=3)
+    filenames = [f for page in pages for f in page]
+    assert sorted(filenames) == sorted(e.filename for e in library.entries())
+    assert filenames != sorted(filenames)
+    assert shuffled_pages(library, limit=4, seed=3) == pages
+
+
+def test_shuffled_pages_skip_excluded_images(library):
+    excluded = {e.filename for e in library.entries()[:5]}
+    filenames = [f for page in shuffled_pages(library, limit=6, seed=1, exclude=excluded) for f in page]
+    assert len(filenames) == 20 and not excluded.intersection(filenames)
+
+
+def test_removed_images_leave_no_duplicates_in_later_pages(library):
+    first, state = library.shuffled(5, seed=9)
+    library.remove_many([e.filename for e in library.entries() if e.filename not in first][:3])
+    rest = []
+    while state:
+        page, state = library.shuffled(5, seed=9, state=state)
+        rest += page
+    assert len(first) + len(rest) == 22 and not set(first).intersection(rest)
+
+
+def test_shuffled_cursor_expires_after_compaction(library):
+    _, state = library.shuffled(5, seed=9)
+    library._epoch += 1  # What compacting the slots does
+    with pytest.raises(AssertionError):
+        library.shuffled(5, seed=9, state=state)
+
+
+def test_shuffled_cursor_of_another_process_is_rejected(library, tmp_path):
+    _, state = library.shuffled(5, seed=9)
+    restarted = ImageLibrary(str(tmp_path), str(tmp_path / "renditions"))
+    restarted.rescan()
+    with pytest.raises(AssertionError):
+        restarted.shuffled(5, seed=9, state=state)
+
+
+def test_recent_pages_newest_first(library):
+    pages = []
+    before = None
+    while True:
+        filenames, before = library.recent(10, before=before)
+        pages.append(filenames)
+        if before is None:
+            break
+    filenames = [f for page in pages for f in page]
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert filenames == [e.filename for e in sorted(library.entries(), key=lambda e: e.sort_key, reverse=True)]
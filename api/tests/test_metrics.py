@@ -0,0 +1,12 @@
+import metrics
+from metrics import REGISTRY, Counter, Gauge, Histogram, render
+
+
+def test_every_metric_is_registered():
+    defined = [value for value in vars(metrics).values() if isinstance(value, (Counter, Gauge, Histogram))]
+    assert {metric.name for metric in defined} == {metric.name for metric in REGISTRY}
+
+
+def test_render_includes_stuck_jobs():
+    metrics.stuck_jobs.inc()
+    assert "# TYPE corganize_stuck_jobs_total counter" in render()
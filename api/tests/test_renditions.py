@@ -0,0 +1,63 @@
+import os
+
+from PIL import Image
+
+from diffuse import writer
+from library import ImageLibrary
+
+FILENAME = "p-1-00000001-0.crgimg"
+
+
+def test_renditions_are_downscaled_per_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(writer, "RENDITIONS_DIR", str(tmp_path))
+
+    written = writer.save_renditions(Image.new("RGB", (2000, 1000)), FILENAME, sizes=[256, 1024])
+
+    paths = [tmp_path / str(size) / FILENAME for size in (256, 1024)]
+    assert written == sum(os.path.getsize(path) for path in paths)
+    with Image.open(paths[0]) as small, Image.open(paths[1]) as large:
+        assert small.size == (256, 128)
+        assert large.size == (1024, 512)
+
+
+def write_rendition(tmp_path, size: int, filename: str = FILENAME):
+    path = tmp_path / "renditions" / str(size) / filename
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x")
+    return path
+
+
+def test_rescan_finds_the_sizes_on_disk(tmp_path):
+    (tmp_path / FILENAME).write_bytes(b"x")
+    write_rendition(tmp_path, 512)
+    library = ImageLibrary(str(tmp_path), str(tmp_path / "renditions"), rendition_sizes=[1024])
+
+    library.rescan()
+
+    assert library.rendition_sizes == {512, 1024}
+    assert library.get(FILENAME).renditions == (512,)
+    assert library.get_rendition_paths(FILENAME) == [os.path.join("renditions", "512", FILENAME),
+                                                     os.path.join("renditions", "1024", FILENAME)]
+
+
+def test_added_image_picks_up_its_renditions(tmp_path):
+    library = ImageLibrary(str(tmp_path), str(tmp_path / "renditions"), rendition_sizes=[256, 1024])
+    (tmp_path / FILENAME).write_bytes(b"x")
+    write_rendition(tmp_path, 1024)
+
+    assert library.add(FILENAME).renditions == (1024,)
+
+
+def test_renditions_without_an_image_are_strays(tmp_path):
+    (tmp_path / FILENAME).write_bytes(b"x")
+    write_rendition(tmp_path, 1024)
+    old = write_rendition(tmp_path, 1024, "gone-1-00000001-0.crgimg")
+    new = write_rendition(tmp_path, 1024, "gone-2-00000001-0.crgimg")
+    os.utime(old, (1000, 1000))
+    os.utime(new, (3000, 3000))
+    library = ImageLibrary(str(tmp_path), str(tmp_path / "renditions"))
+    library.rescan()
+
+    assert library.pop_strays(cutoff=2000) == [os.path.join("renditions", "1024", old.name)]
+    assert library.pop_strays(cutoff=2000) == []
+    assert library.pop_strays(cutoff=4000) == [os.path.join("renditions", "1024", new.name)]
@@ -0,0 +1,42 @@
+import os
+
+from diffuse import api, writer
+from diffuse.api import DiffuseApiPayload, get_static_req_body_provider
+from diffuse.planner import DiffusionJob
+from diffuse.preset import DiffusePreset
+from fakes import FakeClient
+from library import get_basename
+
+REQ_BODY = dict(model="sdxl", prompt="a lighthouse", seed=42)
+
+
+def run(replay: bool = False, overrides: dict = None) -> list:
+    saved = []
+    preset = DiffusePreset(dict(preset_name="lighthouse"), dict())
+    payload = DiffuseApiPayload(preset, get_static_req_body_provider({**REQ_BODY, **(overrides or {})}), job_seed=7,
+                                replay=replay)
+    api._diffuse(FakeClient(), payload, saved.append)
+    writer.image_writer.flush()
+    return saved
+
+
+def test_duplicate_is_dropped(img_dir):
+    [original] = run()
+    assert run() == []
+    assert os.listdir(img_dir).count(original) == 1
+
+
+def test_replay_of_an_existing_image_is_written(img_dir):
+    [original] = run()
+    [replayed] = run(replay=True, overrides=dict(enable_hr=True))
+
+    assert replayed != original
+    assert os.path.exists(os.path.join(img_dir, replayed))
+    assert writer.dedup_index.get(replayed) == writer.dedup_index.get(original)
+    assert api.metadata_store.get_job(get_basename(replayed))["req_body"]["enable_hr"] is True
+
+
+def test_replay_flag_survives_the_queue():
+    preset = DiffusePreset(dict(preset_name="lighthouse"), dict())
+    assert "replay" not in DiffusionJob(preset, REQ_BODY, 7).to_payload()
+    assert DiffusionJob(preset, REQ_BODY, 7, replay=True).to_payload()["replay"] is True
@@ -0,0 +1,60 @@
+import os
+
+from diffuse import api, writer
+from diffuse.api import DiffuseApiPayload, IMG2IMG_PATH, TXT2IMG_PATH, get_static_req_body_provider
+from diffuse.preset import DiffusePreset
+from fakes import FakeClient
+
+REQ_BODY = dict(model="sdxl", prompt="a lighthouse", seed=42)
+NEXT = dict(model="sdxl", prompt="a lighthouse, detailed", denoising_strength=0.4)
+
+
+def get_payload(preset_spec: dict, init_images: list = None) -> DiffuseApiPayload:
+    return DiffuseApiPayload(DiffusePreset(preset_spec, dict()), get_static_req_body_provider(REQ_BODY),
+                             init_images=init_images, job_seed=7, preset_spec=preset_spec)
+
+
+def test_init_images_are_sent_in_batches(monkeypatch):
+    monkeypatch.setattr(api, "I2I_MAX_BATCH_SIZE", 4)
+    payload = get_payload(dict(preset_name="lighthouse"), init_images=[str(i) for i in range(9)])
+
+    batches = list(payload.iter_req_bodies())
+
+    assert [b["init_images"] for b in batches] == [["0", "1", "2", "3"], ["4", "5", "6", "7"], ["8"]]
+    assert [b["batch_size"] for b in batches] == [4, 4, 1]
+    assert all(b["prompt"] == "a lighthouse" for b in batches)
+
+
+def test_without_init_images_the_body_is_sent_once():
+    payload = get_payload(dict(preset_name="lighthouse"))
+    assert list(payload.iter_req_bodies()) == [payload.req_body]
+
+
+def test_following_stage_carries_the_job():
+    spec = dict(preset_name="lighthouse", next=NEXT)
+    payload = get_payload(spec)
+
+    following = payload.get_following_payload(["a", "b"])
+
+    assert following.api_path == IMG2IMG_PATH
+    assert following.init_images == ["a", "b"]
+    assert following.stage == payload.stage + 1
+    assert following.job == payload.job
+    assert following.is_final
+    assert get_payload(dict(preset_name="lighthouse")).get_following_payload(["a"]) is None
+
+
+def test_every_first_stage_image_reaches_the_last_stage(img_dir, monkeypatch):
+    monkeypatch.setattr(api, "I2I_MAX_BATCH_SIZE", 4)
+    # Tell the images apart by their content only, so none is dropped as a near-duplicate
+    monkeypatch.setattr(writer.dedup_index, "max_distance", -1)
+    client = FakeClient(txt2img_count=6)
+    saved = []
+
+    api._diffuse(client, get_payload(dict(preset_name="lighthouse", next=NEXT)), saved.append)
+    writer.image_writer.flush()
+
+    assert [path for path, _ in client.posts] == [TXT2IMG_PATH, IMG2IMG_PATH, IMG2IMG_PATH]
+    assert [len(body["init_images"]) for _, body in client.posts[1:]] == [4, 2]
+    assert len(saved) == 6
+    assert all(os.path.exists(os.path.join(img_dir, filename)) for filename in saved)
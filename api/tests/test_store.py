@@ -0,0 +1,111 @@
+import pytest
+
+from store import MetadataStore, get_searchable_prompt
+
+
+@pytest.fixture
+def store(tmp_path) -> MetadataStore:
+    return MetadataStore(str(tmp_path / "test.db"))
+
+
+def put_batch(store: MetadataStore, basename: str, prompt: str, created: float, first_prompt: str = None, **body):
+    job = dict(preset_name="p1", seed=1, req_body=dict(prompt=first_prompt or prompt))
+    store.put(basename, dict(prompt=prompt, **body), preset_name="p1", job=job)
+    store.add_image(f"{basename}-0.crgimg", basename, created)
+
+
+def search(store: MetadataStore, **filters) -> list:
+    return [image["filename"] for image in store.search(**filters)[0]]
+
+
+def test_searchable_prompt_leads_with_the_first_stage():
+    assert get_searchable_prompt(dict(prompt="n"), dict(req_body=dict(prompt="a hello"))) == "a hello\nn"
+    assert get_searchable_prompt(dict(prompt="same"), dict(req_body=dict(prompt="same"))) == "same"
+    assert get_searchable_prompt(dict(prompt="only")) == "only"
+
+
+@pytest.mark.parametrize("q", ["hello", "x c", "n"])
+def test_first_stage_prompt_is_searchable(store, q):
+    put_batch(store, "p1-1-00000001", "n", 1.0, first_prompt="a hello, x cat <lora:stage1:0.5>")
+    assert search(store, q=q) == ["p1-1-00000001-0.crgimg"]
+
+
+def test_first_stage_loras_are_filterable(store):
+    put_batch(store, "p1-1-00000001", "refine", 1.0, first_prompt="cat <lora:stage1:0.5>")
+    assert search(store, lora="stage1") == ["p1-1-00000001-0.crgimg"]
+
+
+def page_through(store: MetadataStore, limit: int, **filters) -> list:
+    pages = []
+    cursor = None
+    while True:
+        images, cursor = store.search(cursor=cursor, limit=limit, **filters)
+        pages.append([image["filename"] for image in images])
+        if cursor is None:
+            return pages
+
+
+def test_cursor_pages_newest_first_without_gaps(store):
+    for i in range(5):
+        put_batch(store, f"p1-{i}-00000001", f"prompt {i}", created=float(i // 2))  # Ties on created
+
+    assert page_through(store, limit=2) == [
+        ["p1-4-00000001-0.crgimg", "p1-3-00000001-0.crgimg"],
+        ["p1-2-00000001-0.crgimg", "p1-1-00000001-0.crgimg"],
+        ["p1-0-00000001-0.crgimg"],
+    ]
+
+
+def test_cursor_is_none_on_an_exactly_full_last_page(store):
+    for i in range(4):
+        put_batch(store, f"p1-{i}-00000001", "x", created=float(i))
+    assert [len(page) for page in page_through(store, limit=2)] == [2, 2]
+
+
+def test_filters_combine(store):
+    put_batch(store, "p1-1-00000001", "red car", 1.0, model="a")
+    put_batch(store, "p1-2-00000001", "red car", 2.0, model="b")
+    put_batch(store, "p1-3-00000001", "blue car", 3.0, model="b")
+
+    assert search(store, model="b", q="red") == ["p1-2-00000001-0.crgimg"]
+    assert search(store, since=2.0, until=3.0) == ["p1-2-00000001-0.crgimg"]
+    assert search(store, preset_name="other") == []
+
+
+def test_short_queries_fall_back_to_like(store):
+    assert store.fts
+    put_batch(store, "p1-1-00000001", "an ox", 1.0)
+    put_batch(store, "p1-2-00000001", "a cat", 2.0)
+
+    assert search(store, q="ox") == ["p1-1-00000001-0.crgimg"]  # Shorter than a trigram
+    assert search(store, q="cat") == ["p1-2-00000001-0.crgimg"]
+
+
+def test_like_escapes_wildcards(store):
+    store.search(limit=1)  # Opens the connection, which decides on FTS
+    store._fts = False
+    put_batch(store, "p1-1-00000001", "100% cotton", 1.0)
+    put_batch(store, "p1-2-00000001", "1000 cotton", 2.0)
+
+    assert search(store, q="0%") == ["p1-1-00000001-0.crgimg"]
+    assert search(store, q="_") == []
+
+
+def test_fts_matches_the_query_as_a_phrase(store):
+    put_batch(store, "p1-1-00000001", 'a "quoted" word', 1.0)
+    put_batch(store, "p1-2-00000001", "word a quoted", 2.0)
+
+    assert search(store, q='"quoted" w') == ["p1-1-00000001-0.crgimg"]
+
+
+def test_deleted_batches_leave_the_index(store):
+    put_batch(store, "p1-1-00000001", "lighthouse", 1.0)
+    store.delete_many(["p1-1-00000001"])
+
+    assert search(store, q="lighthouse") == []
+    assert store.conn.execute("SELECT COUNT(*) FROM metadata_fts").fetchone()[0] == 0
+
+
+def test_invalid_cursor_is_rejected(store):
+    with pytest.raises(AssertionError):
+        store.search(cursor="e30", limit=1)
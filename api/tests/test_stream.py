@@ -0,0 +1,55 @@
+import base64
+import json
+import os
+
+import pytest
+
+from diffuse.stream import iter_array_strings, iter_b64_strings
+
+
+def chunked(data: bytes, size: int) -> list:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def decode(document: dict, chunk_size: int, key: str = "images") -> list:
+    return [bytes(b) for b in iter_b64_strings(chunked(json.dumps(document).encode(), chunk_size), key)]
+
+
+IMAGES = [os.urandom(n) for n in (0, 1, 2, 3, 100, 4096)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 64, 10 ** 6])
+def test_images_decode_across_any_chunking(chunk_size):
+    document = dict(
+        parameters=dict(images=["not this one"], prompt='a "quoted" \\ prompt'),
+        images=[base64.b64encode(image).decode() for image in IMAGES],
+        info=json.dumps(dict(images=[1, 2])),
+    )
+    assert decode(document, chunk_size) == IMAGES
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1000])
+def test_escaped_slashes_are_unescaped(chunk_size):
+    image = bytes(range(256)) * 3
+    body = '{"images": ["' + base64.b64encode(image).decode().replace("/", "\\/") + '"]}'
+    assert [bytes(b) for b in iter_b64_strings(chunked(body.encode(), chunk_size), "images")] == [image]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 1000])
+def test_unicode_escapes_split_across_chunks(chunk_size):
+    body = b'{"other": "x", "names": ["caf\\u00e9", "a\\"b"]}'
+    events = list(iter_array_strings(chunked(body, chunk_size), "names"))
+    strings = b"".join(data if event == "data" else b"|" for event, data in events).split(b"|")[:-1]
+    assert strings == ["café".encode(), b'a"b']
+
+
+def test_missing_key_yields_nothing():
+    assert decode(dict(info="images", other=[["images"]]), 7) == []
+
+
+def test_stops_after_the_array_closes():
+    def chunks():
+        yield b'{"images": ["AAAA"], '
+        raise AssertionError("read past the images")
+
+    assert [bytes(b) for b in iter_b64_strings(chunks(), "images")] == [b"\0\0\0"]
@@ -1,13 +1,17 @@
+import base64
+import json
 import logging
 from random import sample
 import threading
 import os
 import time
-from typing import List
+from typing import Callable, List, Optional, Union
 from collections import Counter
 
 logger = logging.getLogger("corganize")
 
+FALLBACK_PAUSE_SECONDS = 60  # When working out the pause fails
+
 
 def run_on_interval(func, interval_seconds, initial_delay_seconds=0):
     logger.info(f"Scheduling... {func.__name__=}")
@@ -22,16 +26,41 @@ def run_on_interval(func, interval_seconds, initial_delay_seconds=0):
     threading.Timer(initial_delay_seconds, run_func).start()
 
 
-def run_back_to_back(func, pause_seconds: int, initial_delay_seconds=0):
+def run_back_to_back(func, pause_seconds: Union[float, Callable[[Optional[Exception]], float]], initial_delay_seconds=0,
+                     wake: threading.Event = None):
+    """
+    pause_seconds: Either a fixed pause, or a function of the last run's error (None on success)
+    that returns the pause before the next run
+    wake: Setting it ends the current pause early. Set during a run, it skips the following pause.
+    """
     logger.info(f"Scheduling... {func.__name__=}")
 
     def run_func():
+        if wake:
+            wake.clear()
+        error = None
         try:
             func()
         except Exception as e:
             logger.error(f"Error with {func.__name__=}", e)
+            error = e
+
+        try:
+            pause = pause_seconds(error) if callable(pause_seconds) else pause_seconds
+        except Exception as e:
+            # Not rescheduling would quietly stop the loop until a restart
+            logger.error(f"Failed to get the pause. {func.__name__=} {FALLBACK_PAUSE_SECONDS=} {e=}")
+            pause = FALLBACK_PAUSE_SECONDS
+        if wake is None:
+            threading.Timer(pause, run_func).start()
+            return
+
+        def wait_and_run():
+            if wake.wait(pause):
+                logger.info(f"Pause cut short. {func.__name__=}")
+            run_func()
 
-        threading.Timer(pause_seconds, run_func).start()
+        threading.Thread(target=wait_and_run).start()
 
     threading.Timer(initial_delay_seconds, run_func).start()
 
@@ -53,6 +82,22 @@ def get_old_files(directory_path: str, age_seconds: int) -> List[str]:
     return old_files
 
 
+def encode_cursor(values: list) -> str:
+    """
+    Opaque pagination cursor for a list of JSON values.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        values = None
+    assert isinstance(values, list), f"invalid cursor {cursor=}"
+    return values
+
+
 def get_epoch_millis() -> int:
     current_time_seconds = time.time()
     return int(current_time_seconds * 1000)
@@ -17,9 +17,17 @@ import "@/components/gallery.scss";
 
 type Image = {
   filename: string;
+  preview: string;
   isActive: boolean;
 };
 
+type ImageRenditions = {
+  filename: string;
+  thumbnail: string;
+  preview: string;
+  original: string;
+};
+
 type ImageMetadata = {
   loras: {
     alias: string;
@@ -30,6 +38,12 @@ type ImageMetadata = {
   model: string;
 };
 
+type ImagePage = {
+  filenames: string[];
+  images?: ImageRenditions[];
+  next_cursor: string | null;
+};
+
 type WebSocketPayload = {
   message: string;
   metadata: object;
@@ -41,8 +55,13 @@ const newTabDecorator = (decoratedHref, decoratedText, key) => (
   </a>
 );
 
+// How close to the end of the loaded images the next page gets fetched
+const PREFETCH_AHEAD = 10;
+
 const Gallery = ({ fileFetchUrl }: { fileFetchUrl: string }) => {
   const [images, setImages] = useState<Image[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const fetchingRef = useRef(false);
   const [mode, setMode] = useState<"lightbox" | "scroll">("scroll");
   const [newImagesExist, setNewImagesExist] = useState(false);
   const [index, setIndex] = useState(0);
@@ -83,18 +102,44 @@ const Gallery = ({ fileFetchUrl }: { fileFetchUrl: string }) => {
     }
   }, [newImagesExist]);
 
-  useEffect(() => {
-    containerRef?.current?.focus();
-    setTimeout(() => {
-      // one-time data load
+  const fetchPage = useCallback(
+    (cursor: string | null) => {
+      if (fetchingRef.current) {
+        return;
+      }
+      fetchingRef.current = true;
       axios
-        .get(fileFetchUrl)
+        .get(fileFetchUrl, { params: cursor ? { cursor } : {} })
         .then((r) => r.data)
-        .then(({ filenames }: { filenames: string[] }) => {
-          setImages(filenames.map((filename) => ({ filename, isActive: true })));
+        .then(({ filenames, images, next_cursor }: ImagePage) => {
+          const page = images
+            ? images.map(({ filename, preview }) => ({ filename, preview, isActive: true }))
+            : filenames.map((filename) => ({ filename, preview: filename, isActive: true }));
+          setImages((prevImages) => (cursor ? [...prevImages, ...page] : page));
+          setNextCursor(next_cursor);
+        })
+        .catch(() => {
+          // e.g. a shuffled cursor that expired when the library got compacted; keep what's loaded
+          setNextCursor(null);
+        })
+        .finally(() => {
+          fetchingRef.current = false;
         });
-    }, 100);
-  }, [fileFetchUrl]);
+    },
+    [fileFetchUrl],
+  );
+
+  useEffect(() => {
+    containerRef?.current?.focus();
+    setNextCursor(null);
+    setTimeout(() => fetchPage(null), 100);
+  }, [fetchPage]);
+
+  useEffect(() => {
+    if (nextCursor && index >= images.length - PREFETCH_AHEAD) {
+      fetchPage(nextCursor);
+    }
+  }, [index, images, nextCursor, fetchPage]);
 
   useEffect(() => {
     if (mode === "scroll") {
@@ -192,7 +237,7 @@ const Gallery = ({ fileFetchUrl }: { fileFetchUrl: string }) => {
                   ref={index === i && visibleImageRef}
                   id={image.filename}
                   key={image.filename}
-                  src={`/${image.filename}`}
+                  src={`/${image.preview}`}
                   style={{ opacity: image.isActive ? 1 : 0.1 }}
                 />
               );